@@ -1,5 +1,167 @@
 import { ChatSettings } from "@/types"
 import { spawn } from "child_process"
+import net from "net"
+
+// `chat.py --stream` writes one JSON event per line:
+//   {"type":"route","intent":...}  {"type":"delta","text":...}
+//   {"type":"chart","format":"json","chart":{...}}  {"type":"done","stages":...}
+// Turn an event into the text appended to the assistant message; route and
+// done are only logged.
+function chatEventText(event: any) {
+  switch (event.type) {
+    case "delta":
+      return event.text
+    case "chart":
+      // message-chart.tsx renders messages that start with {"chart":
+      return event.format === "json" ? JSON.stringify(event.chart) : event.path
+    case "route":
+      console.log(`chat.py route: ${event.intent}`)
+      return ""
+    case "done":
+      console.log(
+        `chat.py done, first delta ${event.first_delta_ms} ms, stages ${JSON.stringify(event.stages)}`
+      )
+      return ""
+    default:
+      return ""
+  }
+}
+
+// Text for one stdout line of `chat.py --stream`. Lines that are not events
+// (stray prints) pass through.
+function chatLineText(line: string) {
+  let event: any
+  try {
+    event = JSON.parse(line)
+  } catch (error) {
+    return line + "\n"
+  }
+  if (!event || typeof event !== "object" || !event.type) return line + "\n"
+  return chatEventText(event)
+}
+
+// Call onLine for every complete line of a utf8 stream; flush() emits the
+// remainder when the stream ends without a trailing newline.
+function lineSplitter(onLine: (line: string) => void) {
+  let buffer = ""
+  return {
+    push(data: string) {
+      buffer += data
+      let newline
+      while ((newline = buffer.indexOf("\n")) !== -1) {
+        const line = buffer.slice(0, newline)
+        buffer = buffer.slice(newline + 1)
+        if (line.trim()) onLine(line)
+      }
+    },
+    flush() {
+      if (buffer.trim()) onLine(buffer)
+      buffer = ""
+    }
+  }
+}
+
+// Send one request to a long-lived `chat.py --serve unix` worker (or
+// chat_pool.py), so the Python imports and model setup are paid only once.
+// The history travels in the request line instead of argv. Event lines
+// ({"id","event"}) are forwarded as they arrive; the final reply line ends
+// the stream.
+function streamChatDaemon(socketPath: string, argv: string[], history: any[]) {
+  const encoder = new TextEncoder()
+  let socket: net.Socket
+
+  return new ReadableStream({
+    start(controller) {
+      socket = net.createConnection(socketPath)
+      socket.setEncoding("utf8")
+      let finished = false
+      const lines = lineSplitter(line => {
+        if (finished) return
+        let reply: any
+        try {
+          reply = JSON.parse(line)
+        } catch (error) {
+          finished = true
+          socket.end()
+          controller.error(new Error("Failed to parse Python output"))
+          return
+        }
+        if (reply.event) {
+          const text = chatEventText(reply.event)
+          if (text) controller.enqueue(encoder.encode(text))
+          return
+        }
+        // Whatever was not sent as events (errors, stray prints)
+        finished = true
+        console.log(`chat.py worker latency: ${reply.latency_ms} ms`)
+        if (reply.output) controller.enqueue(encoder.encode(reply.output))
+        socket.end()
+        controller.close()
+      })
+
+      socket.on("connect", () => {
+        socket.write(JSON.stringify({ argv, history }) + "\n")
+      })
+      socket.on("data", (data: string) => lines.push(data))
+      socket.on("error", error => {
+        if (finished) return
+        finished = true
+        controller.error(error)
+      })
+      // The worker died or dropped the connection before the final reply line
+      socket.on("close", () => {
+        lines.flush()
+        if (finished) return
+        finished = true
+        controller.error(new Error("chat.py worker closed the connection"))
+      })
+    },
+    cancel() {
+      socket?.destroy()
+    }
+  })
+}
+
+// Spawn `chat.py --stream` and forward its events as they are printed. The
+// history is written to stdin (--history_file -) so long conversations are
+// not limited by the size of the command line.
+function streamChatProcess(argv: string[], history: any[]) {
+  const encoder = new TextEncoder()
+  let pythonProcess: ReturnType<typeof spawn>
+
+  return new ReadableStream({
+    start(controller) {
+      pythonProcess = spawn("python", [
+        "python_backend/chat.py",
+        ...argv,
+        "--history_file",
+        "-"
+      ])
+      pythonProcess.stdin!.end(JSON.stringify(history))
+      const lines = lineSplitter(line => {
+        const text = chatLineText(line)
+        if (text) controller.enqueue(encoder.encode(text))
+      })
+
+      pythonProcess.stdout!.setEncoding("utf8")
+      pythonProcess.stdout!.on("data", (data: string) => lines.push(data))
+      pythonProcess.stderr!.on("data", data => {
+        console.error(`Python Error: ${data}`)
+      })
+      pythonProcess.on("close", code => {
+        lines.flush()
+        if (code !== 0) {
+          controller.error(new Error(`Python process exited with code ${code}`))
+          return
+        }
+        controller.close()
+      })
+    },
+    cancel() {
+      pythonProcess?.kill()
+    }
+  })
+}
 
 export async function POST(request: Request) {
   const json = await request.json()
@@ -25,42 +187,48 @@ export async function POST(request: Request) {
     const lastMessage = messages.pop()
     const prompt = lastMessage.parts // adjust if parts is not exactly a string
     // Execute Python script
-    const messagesJson = JSON.stringify(messages)
-    const pythonProcess = isSumMode ?
-      spawn("python", [
-        "python_backend/summarize.py",
-        "--company",
-        sumModeCompany,
-        "--year",
-        sumModeYear,
-        "--quarter",
-        sumModeQuarter,
-      ])
-      :
-      spawn("python", [
-        "python_backend/chat.py",
-        "--prompt",
-        prompt[0].text,
-        "--history",
-        messagesJson,
-        "--user_role",
-        userRole,
-        "--is_sum_mode",
-        isSumMode,
-        "--sum_mode_company",
-        sumModeCompany,
-        "--sum_mode_year",
-        sumModeYear,
-        "--sum_mode_quarter",
-        sumModeQuarter,
-        "--temperature",
-        chatSettings.temperature,
-        "--max_tokens",
-        chatSettings.contextLength,
-        "--model_name",
-        chatSettings.model
-      ]) 
-      
+    const chatArgs = [
+      "--prompt",
+      prompt[0].text,
+      "--user_role",
+      userRole,
+      "--is_sum_mode",
+      isSumMode,
+      "--sum_mode_company",
+      sumModeCompany,
+      "--sum_mode_year",
+      sumModeYear,
+      "--sum_mode_quarter",
+      sumModeQuarter,
+      "--temperature",
+      chatSettings.temperature,
+      "--max_tokens",
+      chatSettings.contextLength,
+      "--model_name",
+      chatSettings.model,
+      "--stream"
+    ].map(String)
+
+    if (!isSumMode) {
+      const chatSocket = process.env.PYTHON_CHAT_SOCKET
+      const stream = chatSocket
+        ? streamChatDaemon(chatSocket, chatArgs, messages)
+        : streamChatProcess(chatArgs, messages)
+      return new Response(stream, {
+        headers: { "Content-Type": "application/json" }
+      })
+    }
+
+    const pythonProcess = spawn("python", [
+      "python_backend/summarize.py",
+      "--company",
+      sumModeCompany,
+      "--year",
+      sumModeYear,
+      "--quarter",
+      sumModeQuarter,
+    ])
+
 
     let pythonData = ""
 
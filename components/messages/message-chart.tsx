@@ -0,0 +1,187 @@
+import { FC } from "react"
+
+// Chart data printed by python_backend (chat.py / summarize.py --chart_format json)
+export interface ChartSpec {
+  chart: "line" | "bar" | "table"
+  title: string
+  x_label?: string
+  y_label?: string
+  unit?: string
+  x?: string[]
+  series?: { name: string; values: (number | null)[] }[]
+  columns?: string[]
+  rows?: (string | number | null)[][]
+}
+
+export const parseChartSpec = (content: string): ChartSpec | null => {
+  const text = content.trim()
+  if (!text.startsWith('{"chart":')) return null
+  try {
+    const spec = JSON.parse(text)
+    return ["line", "bar", "table"].includes(spec.chart) ? spec : null
+  } catch {
+    // The message is still streaming or is not chart data
+    return null
+  }
+}
+
+const COLORS = ["#1f77b4", "#ff7f0e", "#2ca02c", "#d62728", "#9467bd"]
+const WIDTH = 720
+const HEIGHT = 400
+const PAD = { top: 32, right: 16, bottom: 72, left: 72 }
+
+const formatValue = (value: number) =>
+  Math.abs(value) >= 1000
+    ? value.toLocaleString(undefined, { maximumFractionDigits: 0 })
+    : value.toLocaleString(undefined, { maximumFractionDigits: 2 })
+
+interface MessageChartProps {
+  spec: ChartSpec
+}
+
+export const MessageChart: FC<MessageChartProps> = ({ spec }) => {
+  if (spec.chart === "table") {
+    return (
+      <div className="overflow-x-auto">
+        <div className="mb-2 font-bold">{spec.title}</div>
+        <table className="border-collapse text-sm">
+          <thead>
+            <tr>
+              {spec.columns?.map(column => (
+                <th key={column} className="border px-3 py-1">
+                  {column}
+                </th>
+              ))}
+            </tr>
+          </thead>
+          <tbody>
+            {spec.rows?.map((row, i) => (
+              <tr key={i}>
+                {row.map((cell, j) => (
+                  <td key={j} className="border px-3 py-1 text-center">
+                    {cell ?? "-"}
+                  </td>
+                ))}
+              </tr>
+            ))}
+          </tbody>
+        </table>
+      </div>
+    )
+  }
+
+  const labels = spec.x ?? []
+  const series = spec.series ?? []
+  const values = series.flatMap(s =>
+    s.values.filter((v): v is number => v !== null)
+  )
+  const min = Math.min(0, ...values)
+  const max = Math.max(0, ...values)
+  const span = max - min || 1
+  const plotWidth = WIDTH - PAD.left - PAD.right
+  const plotHeight = HEIGHT - PAD.top - PAD.bottom
+  const slot = plotWidth / Math.max(labels.length, 1)
+  const xAt = (i: number) => PAD.left + slot * (i + 0.5)
+  const yAt = (v: number) => PAD.top + plotHeight * (1 - (v - min) / span)
+  const ticks = Array.from({ length: 5 }, (_, i) => min + (span * i) / 4)
+  const barWidth = (slot * 0.8) / Math.max(series.length, 1)
+
+  return (
+    <div>
+      <svg
+        viewBox={`0 0 ${WIDTH} ${HEIGHT}`}
+        className="w-full max-w-[720px] bg-white text-black"
+      >
+        <text x={WIDTH / 2} y={20} textAnchor="middle" fontSize={14}>
+          {spec.title}
+        </text>
+        {ticks.map(tick => (
+          <g key={tick}>
+            <line
+              x1={PAD.left}
+              x2={WIDTH - PAD.right}
+              y1={yAt(tick)}
+              y2={yAt(tick)}
+              stroke="#ddd"
+            />
+            <text
+              x={PAD.left - 6}
+              y={yAt(tick) + 4}
+              textAnchor="end"
+              fontSize={10}
+            >
+              {formatValue(tick)}
+            </text>
+          </g>
+        ))}
+        {labels.map((label, i) => (
+          <text
+            key={label}
+            x={xAt(i)}
+            y={HEIGHT - PAD.bottom + 14}
+            textAnchor="end"
+            fontSize={10}
+            transform={`rotate(-45 ${xAt(i)} ${HEIGHT - PAD.bottom + 14})`}
+          >
+            {label}
+          </text>
+        ))}
+        <text
+          x={14}
+          y={PAD.top + plotHeight / 2}
+          textAnchor="middle"
+          fontSize={11}
+          transform={`rotate(-90 14 ${PAD.top + plotHeight / 2})`}
+        >
+          {spec.y_label}
+        </text>
+        {series.map((s, k) => {
+          const color = COLORS[k % COLORS.length]
+          if (spec.chart === "bar") {
+            return s.values.map((v, i) =>
+              v === null ? null : (
+                <rect
+                  key={`${k}-${i}`}
+                  x={xAt(i) - slot * 0.4 + barWidth * k}
+                  y={Math.min(yAt(v), yAt(0))}
+                  width={barWidth}
+                  height={Math.abs(yAt(0) - yAt(v))}
+                  fill={color}
+                />
+              )
+            )
+          }
+          // Missing quarters (null) break the line instead of being joined
+          const path = s.values
+            .map((v, i) => {
+              if (v === null) return ""
+              const command = i > 0 && s.values[i - 1] !== null ? "L" : "M"
+              return `${command}${xAt(i)},${yAt(v)}`
+            })
+            .join("")
+          return (
+            <g key={s.name}>
+              <path d={path} fill="none" stroke={color} strokeWidth={2} />
+              {s.values.map((v, i) =>
+                v === null ? null : (
+                  <circle key={i} cx={xAt(i)} cy={yAt(v)} r={3} fill={color} />
+                )
+              )}
+            </g>
+          )
+        })}
+      </svg>
+      <div className="mt-1 flex flex-wrap gap-3 text-sm">
+        {series.map((s, k) => (
+          <span key={s.name} className="flex items-center gap-1">
+            <span
+              className="inline-block size-3"
+              style={{ backgroundColor: COLORS[k % COLORS.length] }}
+            />
+            {s.name}
+          </span>
+        ))}
+      </div>
+    </div>
+  )
+}
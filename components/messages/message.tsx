@@ -22,6 +22,7 @@ import { FilePreview } from "../ui/file-preview"
 import { TextareaAutosize } from "../ui/textarea-autosize"
 import { WithTooltip } from "../ui/with-tooltip"
 import { MessageActions } from "./message-actions"
+import { MessageChart, parseChartSpec } from "./message-chart"
 import { MessageMarkdown } from "./message-markdown"
 import { TestImage } from "./message-test"
 
@@ -191,6 +192,7 @@ export const Message: FC<MessageProps> = ({
   // const regex = /^Line_Chart.*\.png$/;
   // const isLineChart = regex.test(message.content);
   const isLineChart = message.content.includes("Line_Chart") && message.content.includes(".png");
+  const chartSpec = parseChartSpec(message.content)
   // console.log("isLineChart", isLineChart);
   // console.log("message.content", message.content);
 
@@ -322,7 +324,7 @@ export const Message: FC<MessageProps> = ({
               onValueChange={setEditedMessage}
               maxRows={20}
             />
-          ) : isLineChart ? (
+          ) : isLineChart || chartSpec ? (
             <></>
           ) : (
             <MessageMarkdown content={message.content} />
@@ -399,6 +401,7 @@ export const Message: FC<MessageProps> = ({
 
         {/* Message images */}
         <div className="mt-3 flex flex-wrap gap-2">
+          {chartSpec && <MessageChart spec={chartSpec} />}
           {isLineChart && (
             <img
               src={"/api/image?img_path=" + message.content}
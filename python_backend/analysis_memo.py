@@ -0,0 +1,153 @@
+import os
+import sys
+import json
+import time
+import sqlite3
+import hashlib
+import argparse
+import threading
+
+from fin_store import STORE_DIR
+
+MEMO_PATH = os.environ.get("MARKETAGENT_MEMO_PATH", os.path.join(STORE_DIR, "analysis_memo.sqlite"))
+MEMO_MAX_BYTES = int(float(os.environ.get("MARKETAGENT_MEMO_MB", 64)) * (1 << 20))
+
+
+def prompt_version(*parts):
+    """prompt 模板與 response schema 的內容 hash，任何一個改變時舊的結果自動失效"""
+    text = "\n".join(part if isinstance(part, str) else json.dumps(part, sort_keys=True, ensure_ascii=False) for part in parts)
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()[:12]
+
+
+class AnalysisMemo:
+    """
+    逐字稿分析結果的持久化快取 (SQLite)，key 為 (逐字稿內容 hash, 模型名稱, prompt/schema 版本)。
+    相同逐字稿在任何一份報告中分析過後，之後的報告不再呼叫 LLM。
+    超過容量上限時刪除最久未使用的結果。
+
+    :param path: SQLite 檔案路徑
+    :param max_bytes: 結果 JSON 的總大小上限
+    """
+
+    def __init__(self, path=MEMO_PATH, max_bytes=MEMO_MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        # 批次模式下多個 thread 共用同一個連線，以 lock 保護；WAL 讓其他 process 讀取時不被寫入擋住
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS memo (
+                    transcript_sha TEXT NOT NULL,
+                    model TEXT NOT NULL,
+                    prompt_version TEXT NOT NULL,
+                    result TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    created_at REAL NOT NULL,
+                    last_used REAL NOT NULL,
+                    hits INTEGER NOT NULL DEFAULT 0,
+                    PRIMARY KEY (transcript_sha, model, prompt_version)
+                )
+                """
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS memo_last_used ON memo (last_used)")
+        self.counters = {"hits": 0, "misses": 0, "evictions": 0}
+
+    def get(self, transcript_sha, model, version):
+        """回傳先前存下的結果，沒有時回傳 None"""
+        with self._lock, self._conn:
+            row = self._conn.execute(
+                "SELECT result FROM memo WHERE transcript_sha = ? AND model = ? AND prompt_version = ?",
+                (transcript_sha, model, version),
+            ).fetchone()
+            if row is None:
+                self.counters["misses"] += 1
+                return None
+            self._conn.execute(
+                "UPDATE memo SET last_used = ?, hits = hits + 1 WHERE transcript_sha = ? AND model = ? AND prompt_version = ?",
+                (time.time(), transcript_sha, model, version),
+            )
+            self.counters["hits"] += 1
+        return json.loads(row[0])
+
+    def put(self, transcript_sha, model, version, result):
+        result = json.dumps(result, ensure_ascii=False)
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO memo (transcript_sha, model, prompt_version, result, size, created_at, last_used) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (transcript_sha, model, version, result, len(result.encode("utf-8")), now, now),
+            )
+            self._evict()
+
+    def _evict(self):
+        """依最後使用時間刪除結果，直到總大小不超過上限"""
+        total = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM memo").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        for transcript_sha, model, version, size in self._conn.execute(
+            "SELECT transcript_sha, model, prompt_version, size FROM memo ORDER BY last_used"
+        ).fetchall():
+            if total <= self.max_bytes:
+                break
+            self._conn.execute(
+                "DELETE FROM memo WHERE transcript_sha = ? AND model = ? AND prompt_version = ?",
+                (transcript_sha, model, version),
+            )
+            total -= size
+            self.counters["evictions"] += 1
+
+    def invalidate(self, transcript_sha=None, model=None, version=None):
+        """刪除符合條件的結果 (未指定的條件不限制，全部未指定時清空)，回傳刪除的筆數"""
+        conditions = [(column, value) for column, value in [("transcript_sha", transcript_sha), ("model", model), ("prompt_version", version)] if value is not None]
+        where = " AND ".join(f"{column} = ?" for column, _ in conditions) or "1"
+        with self._lock, self._conn:
+            return self._conn.execute(f"DELETE FROM memo WHERE {where}", [value for _, value in conditions]).rowcount
+
+    def stats(self):
+        with self._lock:
+            entries, total, hits = self._conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0), COALESCE(SUM(hits), 0) FROM memo").fetchone()
+        lookups = self.counters["hits"] + self.counters["misses"]
+        return {
+            **self.counters,
+            "hit_rate": self.counters["hits"] / lookups if lookups else None,
+            "entries": entries,
+            "bytes": total,
+            "max_bytes": self.max_bytes,
+            "lifetime_hits": hits,
+        }
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Inspect or invalidate the transcript analysis memo.")
+    parser.add_argument("command", choices=["stats", "list", "invalidate"], help="stats: size and hit counts; list: stored keys; invalidate: delete matching results")
+    parser.add_argument("--path", type=str, default=MEMO_PATH, help="SQLite file of the memo")
+    parser.add_argument("--sha", type=str, help="Only results of this transcript content hash")
+    parser.add_argument("--model", type=str, help="Only results of this model")
+    parser.add_argument("--prompt_version", type=str, help="Only results of this prompt/schema version")
+    parser.add_argument("--all", action="store_true", help="Allow invalidate without any filter (clears the memo)")
+    args = parser.parse_args()
+
+    memo = AnalysisMemo(args.path)
+    if args.command == "stats":
+        print(json.dumps(memo.stats(), ensure_ascii=False))
+    elif args.command == "list":
+        for row in memo._conn.execute("SELECT transcript_sha, model, prompt_version, size, hits, last_used FROM memo ORDER BY last_used DESC"):
+            print(json.dumps(dict(zip(["transcript_sha", "model", "prompt_version", "size", "hits", "last_used"], row)), ensure_ascii=False))
+    else:
+        if not (args.sha or args.model or args.prompt_version or args.all):
+            parser.error("invalidate needs --sha, --model, --prompt_version or --all")
+        deleted = memo.invalidate(args.sha, args.model, args.prompt_version)
+        print(f"[memo] deleted {deleted} results", file=sys.stderr)
+    memo.close()
+
+
+if __name__ == "__main__":
+    main()
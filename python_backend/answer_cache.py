@@ -0,0 +1,163 @@
+import os
+import re
+import sys
+import json
+import time
+import sqlite3
+import hashlib
+import argparse
+import threading
+import unicodedata
+
+from fin_store import STORE_DIR
+
+ANSWER_CACHE_PATH = os.environ.get("MARKETAGENT_ANSWER_CACHE_PATH", os.path.join(STORE_DIR, "answer_cache.sqlite"))
+# 答案的有效時間 (秒) 與每個角色最多保留的筆數
+ANSWER_TTL = float(os.environ.get("MARKETAGENT_ANSWER_TTL", 6 * 3600))
+ANSWER_MAX_ENTRIES = int(os.environ.get("MARKETAGENT_ANSWER_MAX_ENTRIES", 5000))
+
+
+def normalize_prompt(prompt):
+    """比對用的問題：全形半形統一、忽略大小寫、多餘空白與結尾的標點"""
+    text = unicodedata.normalize("NFKC", prompt).casefold()
+    text = " ".join(text.split())
+    # NFKC 已將全形標點轉成半形，句號 "。" 另外處理
+    return re.sub(r"[\s?!.,;:\u3002]+$", "", text)
+
+
+def cache_key(*parts):
+    return hashlib.sha256(json.dumps(parts, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+
+class AnswerCache:
+    """
+    檢索結果與 RAG 答案的持久化快取 (SQLite)，常駐 worker 與命令列共用。
+    每筆資料屬於一個 user_role，查詢只會比對同一個角色的資料，各角色的容量也分開計算，
+    超過 ttl 的資料視為不存在，超過 max_entries 時刪除該角色最久未使用的資料。
+
+    :param path: SQLite 檔案路徑
+    :param ttl: 有效時間 (秒)
+    :param max_entries: 每個角色最多保留的筆數
+    """
+
+    def __init__(self, path=ANSWER_CACHE_PATH, ttl=ANSWER_TTL, max_entries=ANSWER_MAX_ENTRIES):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS answers (
+                    role TEXT NOT NULL,
+                    kind TEXT NOT NULL,
+                    key TEXT NOT NULL,
+                    value TEXT NOT NULL,
+                    created_at REAL NOT NULL,
+                    last_used REAL NOT NULL,
+                    hits INTEGER NOT NULL DEFAULT 0,
+                    PRIMARY KEY (role, kind, key)
+                )
+                """
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS answers_last_used ON answers (role, last_used)")
+        # 本 process 的命中統計: (role, kind) -> {hits, misses, expired}
+        self.counters = {}
+        self.evictions = 0
+
+    def _count(self, role, kind, name):
+        counter = self.counters.setdefault((role, kind), {"hits": 0, "misses": 0, "expired": 0})
+        counter[name] += 1
+
+    def get(self, role, kind, key):
+        """回傳未過期的資料，沒有或已過期時回傳 None"""
+        now = time.time()
+        with self._lock, self._conn:
+            row = self._conn.execute("SELECT value, created_at FROM answers WHERE role = ? AND kind = ? AND key = ?", (role, kind, key)).fetchone()
+            if row is None:
+                self._count(role, kind, "misses")
+                return None
+            if now - row[1] > self.ttl:
+                self._conn.execute("DELETE FROM answers WHERE role = ? AND kind = ? AND key = ?", (role, kind, key))
+                self._count(role, kind, "expired")
+                self._count(role, kind, "misses")
+                return None
+            self._conn.execute("UPDATE answers SET last_used = ?, hits = hits + 1 WHERE role = ? AND kind = ? AND key = ?", (now, role, kind, key))
+            self._count(role, kind, "hits")
+        return json.loads(row[0])
+
+    def put(self, role, kind, key, value):
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO answers (role, kind, key, value, created_at, last_used) VALUES (?, ?, ?, ?, ?, ?)",
+                (role, kind, key, json.dumps(value, ensure_ascii=False), now, now),
+            )
+            self._evict(role, now)
+
+    def _evict(self, role, now):
+        """刪除該角色已過期的資料，仍超過上限時依最後使用時間刪除"""
+        self._conn.execute("DELETE FROM answers WHERE role = ? AND created_at < ?", (role, now - self.ttl))
+        count = self._conn.execute("SELECT COUNT(*) FROM answers WHERE role = ?", (role,)).fetchone()[0]
+        if count > self.max_entries:
+            deleted = self._conn.execute(
+                "DELETE FROM answers WHERE rowid IN (SELECT rowid FROM answers WHERE role = ? ORDER BY last_used LIMIT ?)",
+                (role, count - self.max_entries),
+            ).rowcount
+            self.evictions += deleted
+
+    def invalidate(self, role=None, kind=None):
+        """刪除指定角色 (與種類) 的資料，都未指定時清空，回傳刪除的筆數"""
+        conditions = [(column, value) for column, value in [("role", role), ("kind", kind)] if value is not None]
+        where = " AND ".join(f"{column} = ?" for column, _ in conditions) or "1"
+        with self._lock, self._conn:
+            return self._conn.execute(f"DELETE FROM answers WHERE {where}", [value for _, value in conditions]).rowcount
+
+    def stats(self):
+        """本 process 的命中率 (依角色與種類)，以及快取中每個角色的筆數"""
+        with self._lock:
+            rows = self._conn.execute("SELECT role, kind, COUNT(*), COALESCE(SUM(hits), 0) FROM answers GROUP BY role, kind").fetchall()
+        roles = {}
+        for (role, kind), counter in self.counters.items():
+            lookups = counter["hits"] + counter["misses"]
+            roles.setdefault(role, {})[kind] = {**counter, "hit_rate": round(counter["hits"] / lookups, 4) if lookups else None}
+        for role, kind, entries, hits in rows:
+            roles.setdefault(role, {}).setdefault(kind, {}).update(entries=entries, lifetime_hits=hits)
+        hits = sum(counter["hits"] for counter in self.counters.values())
+        lookups = hits + sum(counter["misses"] for counter in self.counters.values())
+        return {"hit_rate": round(hits / lookups, 4) if lookups else None, "lookups": lookups, "evictions": self.evictions, "roles": roles}
+
+
+# 每個 process 各自開啟連線 (chat_pool 的 worker 由 fork 產生，不能共用父 process 的連線)
+_CACHE = {}
+
+
+def get_answer_cache():
+    pid = os.getpid()
+    if pid not in _CACHE:
+        _CACHE.clear()
+        _CACHE[pid] = AnswerCache()
+    return _CACHE[pid]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Inspect or clear the retrieval and RAG answer cache.")
+    parser.add_argument("command", choices=["stats", "invalidate"], help="stats: entries per role; invalidate: delete entries")
+    parser.add_argument("--path", type=str, default=ANSWER_CACHE_PATH, help="SQLite file of the cache")
+    parser.add_argument("--user_role", type=str, help="Only entries of this role")
+    parser.add_argument("--kind", type=str, choices=["contexts", "answer"], help="Only retrieved contexts or only answers")
+    args = parser.parse_args()
+
+    cache = AnswerCache(args.path)
+    if args.command == "stats":
+        print(json.dumps(cache.stats(), ensure_ascii=False))
+    else:
+        deleted = cache.invalidate(args.user_role, args.kind)
+        print(f"[answer_cache] deleted {deleted} entries", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,291 @@
+import os
+import json
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+
+
+class GCSBackend:
+    """Google Cloud Storage 後端，storage.Client 只建立一次"""
+
+    def __init__(self):
+        self._client = None
+
+    @property
+    def client(self):
+        if self._client is None:
+            from google.cloud import storage
+            self._client = storage.Client()
+        return self._client
+
+    def generation(self, bucket_name, blob_name):
+        """只取 metadata，回傳物件目前的 generation；物件不存在時回傳 None"""
+        blob = self.client.bucket(bucket_name).get_blob(blob_name)
+        return str(blob.generation) if blob is not None else None
+
+    def download(self, bucket_name, blob_name):
+        """下載物件，回傳 (generation, bytes)"""
+        blob = self.client.bucket(bucket_name).get_blob(blob_name)
+        if blob is None:
+            raise FileNotFoundError(f"gs://{bucket_name}/{blob_name}")
+        return str(blob.generation), blob.download_as_bytes()
+
+    def download_range(self, bucket_name, blob_name, start, end=None):
+        """下載物件 [start, end) 位元組的內容，end 為 None 時到檔案結尾，回傳 (generation, bytes)"""
+        blob = self.client.bucket(bucket_name).get_blob(blob_name)
+        if blob is None:
+            raise FileNotFoundError(f"gs://{bucket_name}/{blob_name}")
+        # GCS 的 end 包含該位元組
+        return str(blob.generation), blob.download_as_bytes(start=start, end=None if end is None else end - 1)
+
+    def list(self, bucket_name, prefix=""):
+        """列出 prefix 底下的物件，回傳 {blob_name: generation}"""
+        return {blob.name: str(blob.generation) for blob in self.client.list_blobs(bucket_name, prefix=prefix)}
+
+
+class LocalDirBackend:
+    """
+    本機目錄後端，<root>/<bucket_name>/<blob_name> 對應 bucket 中的物件。
+    用於測試或離線開發，generation 以檔案的 mtime 與大小表示。
+    """
+
+    def __init__(self, root):
+        self.root = root
+
+    def _path(self, bucket_name, blob_name):
+        return os.path.join(self.root, bucket_name, blob_name)
+
+    def generation(self, bucket_name, blob_name):
+        try:
+            stat = os.stat(self._path(bucket_name, blob_name))
+        except FileNotFoundError:
+            return None
+        return f"{stat.st_mtime_ns}-{stat.st_size}"
+
+    def download(self, bucket_name, blob_name):
+        path = self._path(bucket_name, blob_name)
+        generation = self.generation(bucket_name, blob_name)
+        with open(path, "rb") as f:
+            return generation, f.read()
+
+    def download_range(self, bucket_name, blob_name, start, end=None):
+        path = self._path(bucket_name, blob_name)
+        generation = self.generation(bucket_name, blob_name)
+        with open(path, "rb") as f:
+            f.seek(start)
+            return generation, f.read(-1 if end is None else max(end - start, 0))
+
+    def list(self, bucket_name, prefix=""):
+        bucket_root = os.path.join(self.root, bucket_name)
+        blobs = {}
+        for dirpath, _, filenames in os.walk(bucket_root):
+            for filename in filenames:
+                blob_name = os.path.relpath(os.path.join(dirpath, filename), bucket_root).replace(os.sep, "/")
+                if blob_name.startswith(prefix):
+                    blobs[blob_name] = self.generation(bucket_name, blob_name)
+        return blobs
+
+
+class BlobCache:
+    """
+    bucket 物件的兩層快取：process 內的 LRU 與磁碟上以內容 sha256 定址的檔案。
+    每次讀取先以 generation 檢查物件是否變動 (只取 metadata)，未變動時不重新下載。
+
+    :param backend: GCSBackend 或 LocalDirBackend
+    :param cache_dir: 磁碟快取目錄
+    :param max_memory_bytes: 記憶體 LRU 的容量上限
+    :param max_disk_bytes: 磁碟快取的容量上限，超過時刪除最久未使用的物件
+    :param revalidate_seconds: 距上次檢查 generation 未超過此秒數時直接使用快取
+    """
+
+    def __init__(self, backend, cache_dir, max_memory_bytes=256 << 20, max_disk_bytes=2 << 30, revalidate_seconds=0):
+        self.backend = backend
+        self.cache_dir = cache_dir
+        self.max_memory_bytes = max_memory_bytes
+        self.max_disk_bytes = max_disk_bytes
+        self.revalidate_seconds = revalidate_seconds
+        self._memory = OrderedDict()
+        self._memory_bytes = 0
+        self._checked_at = {}
+        self._lock = threading.RLock()
+        self._index_path = os.path.join(cache_dir, "index.json")
+        self._index = self._read_index()
+        self.counters = {
+            "memory_hits": 0,
+            "disk_hits": 0,
+            "misses": 0,
+            "revalidations": 0,
+            "bytes_downloaded": 0,
+        }
+
+    def _read_index(self):
+        try:
+            with open(self._index_path, encoding="utf-8") as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
+
+    def _write_index(self):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        tmp_path = f"{self._index_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self._index, f)
+        os.replace(tmp_path, self._index_path)
+
+    def _object_path(self, digest):
+        return os.path.join(self.cache_dir, "objects", digest[:2], digest)
+
+    def generation(self, bucket_name, blob_name):
+        """回傳物件目前的 generation，在 revalidate_seconds 內沿用上次檢查的結果"""
+        key = f"{bucket_name}/{blob_name}"
+        with self._lock:
+            checked = self._checked_at.get(key)
+            if checked and time.monotonic() - checked[0] < self.revalidate_seconds:
+                return checked[1]
+        generation = self.backend.generation(bucket_name, blob_name)
+        with self._lock:
+            self.counters["revalidations"] += 1
+            self._checked_at[key] = (time.monotonic(), generation)
+        return generation
+
+    def fetch(self, bucket_name, blob_name):
+        """讀取物件，回傳 (generation, bytes)"""
+        key = f"{bucket_name}/{blob_name}"
+        generation = self.generation(bucket_name, blob_name)
+
+        with self._lock:
+            cached = self._memory.get(key)
+            if cached and cached[0] == generation:
+                self._memory.move_to_end(key)
+                self.counters["memory_hits"] += 1
+                return cached
+
+            entry = self._index.get(key)
+            if entry and entry["generation"] == generation:
+                try:
+                    with open(self._object_path(entry["digest"]), "rb") as f:
+                        data = f.read()
+                    os.utime(self._object_path(entry["digest"]))
+                    self.counters["disk_hits"] += 1
+                    self._remember(key, generation, data)
+                    return generation, data
+                except FileNotFoundError:
+                    pass
+
+        generation, data = self.backend.download(bucket_name, blob_name)
+        with self._lock:
+            self.counters["misses"] += 1
+            self.counters["bytes_downloaded"] += len(data)
+            self._checked_at[key] = (time.monotonic(), generation)
+            self._store(key, generation, data)
+            self._remember(key, generation, data)
+        return generation, data
+
+    def fetch_range(self, bucket_name, blob_name, start, end=None):
+        """
+        只下載物件 [start, end) 位元組的內容 (附加資料的增量讀取)，回傳 (generation, bytes)。
+        部分內容不放入快取，generation 檢查紀錄則一併更新。
+        """
+        generation, data = self.backend.download_range(bucket_name, blob_name, start, end)
+        with self._lock:
+            self.counters["bytes_downloaded"] += len(data)
+            self._checked_at[f"{bucket_name}/{blob_name}"] = (time.monotonic(), generation)
+        return generation, data
+
+    def list(self, bucket_name, prefix=""):
+        """列出 bucket 中 prefix 底下的物件，回傳 {blob_name: generation}"""
+        return self.backend.list(bucket_name, prefix)
+
+    def get_bytes(self, bucket_name, blob_name):
+        return self.fetch(bucket_name, blob_name)[1]
+
+    def _remember(self, key, generation, data):
+        old = self._memory.pop(key, None)
+        if old:
+            self._memory_bytes -= len(old[1])
+        if len(data) > self.max_memory_bytes:
+            return
+        self._memory[key] = (generation, data)
+        self._memory_bytes += len(data)
+        while self._memory_bytes > self.max_memory_bytes:
+            _, (_, evicted) = self._memory.popitem(last=False)
+            self._memory_bytes -= len(evicted)
+
+    def _store(self, key, generation, data):
+        digest = hashlib.sha256(data).hexdigest()
+        path = self._object_path(digest)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        self._index[key] = {"generation": generation, "digest": digest, "size": len(data)}
+        self._evict_disk()
+        self._write_index()
+
+    def _evict_disk(self):
+        """依最後使用時間刪除磁碟上的物件，直到總大小低於上限"""
+        objects = {}
+        for entry in self._index.values():
+            path = self._object_path(entry["digest"])
+            if entry["digest"] not in objects and os.path.exists(path):
+                objects[entry["digest"]] = (os.path.getatime(path), entry["size"], path)
+        total = sum(size for _, size, _ in objects.values())
+        for digest, (_, size, path) in sorted(objects.items(), key=lambda item: item[1][0]):
+            if total <= self.max_disk_bytes:
+                break
+            os.remove(path)
+            total -= size
+            self._index = {key: entry for key, entry in self._index.items() if entry["digest"] != digest}
+
+    def invalidate(self, bucket_name=None, blob_name=None):
+        """清除指定物件 (或全部) 的記憶體快取與檢查紀錄，磁碟物件仍會以 generation 驗證"""
+        with self._lock:
+            if bucket_name is None:
+                self._memory.clear()
+                self._memory_bytes = 0
+                self._checked_at.clear()
+                return
+            key = f"{bucket_name}/{blob_name}"
+            old = self._memory.pop(key, None)
+            if old:
+                self._memory_bytes -= len(old[1])
+            self._checked_at.pop(key, None)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.counters["memory_hits"] + self.counters["disk_hits"] + self.counters["misses"]
+            hits = self.counters["memory_hits"] + self.counters["disk_hits"]
+            return {
+                **self.counters,
+                "hit_rate": hits / lookups if lookups else None,
+                "memory_bytes": self._memory_bytes,
+                "memory_entries": len(self._memory),
+            }
+
+
+_DEFAULT_CACHE = None
+
+
+def default_cache():
+    """
+    依環境變數建立 process 共用的 BlobCache：
+      MARKETAGENT_BUCKET_ROOT: 設定時改用本機目錄後端
+      MARKETAGENT_CACHE_DIR: 磁碟快取目錄，預設 ~/.cache/marketagent/blobs
+      MARKETAGENT_CACHE_MEMORY_MB / MARKETAGENT_CACHE_DISK_MB: 兩層快取的容量
+      MARKETAGENT_CACHE_REVALIDATE_SECONDS: generation 檢查的間隔
+    """
+    global _DEFAULT_CACHE
+    if _DEFAULT_CACHE is None:
+        bucket_root = os.environ.get("MARKETAGENT_BUCKET_ROOT")
+        backend = LocalDirBackend(bucket_root) if bucket_root else GCSBackend()
+        _DEFAULT_CACHE = BlobCache(
+            backend,
+            os.environ.get("MARKETAGENT_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "marketagent", "blobs")),
+            max_memory_bytes=int(float(os.environ.get("MARKETAGENT_CACHE_MEMORY_MB", 256)) * (1 << 20)),
+            max_disk_bytes=int(float(os.environ.get("MARKETAGENT_CACHE_DISK_MB", 2048)) * (1 << 20)),
+            revalidate_seconds=float(os.environ.get("MARKETAGENT_CACHE_REVALIDATE_SECONDS", 0)),
+        )
+    return _DEFAULT_CACHE
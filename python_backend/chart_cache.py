@@ -0,0 +1,85 @@
+import os
+import json
+import time
+import hashlib
+
+
+class ChartStore:
+    """
+    以內容定址的圖表快取：檔名是 (圖表種類, 正規化後的查詢, 資料版本) 的 hash，
+    相同的查詢直接回傳既有的檔案，不需要重新呼叫 matplotlib。
+
+    :param root: 圖表目錄
+    :param prefix: 檔名前綴，例如 'Financial_line_chart_'
+    :param max_bytes: 目錄總大小上限，超過時刪除最久未使用的圖表
+    :param max_age_seconds: 超過此時間未使用的圖表會被刪除
+    """
+
+    def __init__(self, root, prefix="", max_bytes=200 << 20, max_age_seconds=30 * 24 * 3600):
+        self.root = root
+        self.prefix = prefix
+        self.max_bytes = max_bytes
+        self.max_age_seconds = max_age_seconds
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, kind, spec, dataset_version):
+        payload = json.dumps({"kind": kind, "spec": spec, "dataset_version": dataset_version}, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()[:32]
+
+    def path(self, key):
+        return os.path.join(self.root, f"{self.prefix}{key}.png")
+
+    def contains(self, key):
+        return os.path.exists(self.path(key))
+
+    def get_or_render(self, key, render):
+        """
+        回傳 key 對應的圖表路徑；不存在時呼叫 render(path) 繪製。
+        先寫入暫存檔再改名，同時繪製同一張圖時不會讀到寫到一半的檔案。
+        """
+        path = self.path(key)
+        if os.path.exists(path):
+            os.utime(path)
+            self.hits += 1
+            return path
+
+        os.makedirs(self.root, exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp.png"
+        render(tmp_path)
+        os.replace(tmp_path, path)
+        self.misses += 1
+        self.evict()
+        return path
+
+    def evict(self):
+        """刪除過期的圖表，再依最後使用時間刪除，直到總大小低於上限"""
+        now = time.time()
+        charts = []
+        for entry in os.scandir(self.root):
+            if not (entry.is_file() and entry.name.startswith(self.prefix) and entry.name.endswith(".png")) or ".tmp" in entry.name:
+                continue
+            stat = entry.stat()
+            if self.max_age_seconds and now - stat.st_mtime > self.max_age_seconds:
+                os.remove(entry.path)
+                continue
+            charts.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in charts)
+        for _, size, path in sorted(charts):
+            if total <= self.max_bytes:
+                break
+            os.remove(path)
+            total -= size
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses}
+
+
+def chart_store(root, prefix=""):
+    """依環境變數 MARKETAGENT_CHART_MAX_MB / MARKETAGENT_CHART_MAX_AGE_DAYS 建立 ChartStore"""
+    return ChartStore(
+        root,
+        prefix,
+        max_bytes=int(float(os.environ.get("MARKETAGENT_CHART_MAX_MB", 200)) * (1 << 20)),
+        max_age_seconds=float(os.environ.get("MARKETAGENT_CHART_MAX_AGE_DAYS", 30)) * 24 * 3600,
+    )
@@ -2,14 +2,30 @@ import os
 import sys
 import io
 import json
-import uuid
+import time
+import asyncio
 import argparse
+import contextlib
+import threading
+import socketserver
+import numpy as np
 import pandas as pd
-import matplotlib.pyplot as plt
-from google.cloud import aiplatform, storage
+from google.cloud import aiplatform
+from bucket_cache import default_cache
+from chart_cache import chart_store
+from intent_router import CSV_TOOL_RULES, MAIN_RULES, build_router
+from plot_slots import SlotExtractor
+from fin_cube import DERIVED_METRICS, RATIO_METRICS, load_cube
+from fin_query import QUERY_SPEC_SCHEMA, answer_query
+from lookup_tables import TRANSCRIPT_BLOB, TRANSCRIPT_BUCKET, answer_exchange, answer_fiscal, load_fiscal_calendar, load_fx_table
+from fin_store import load_frame, load_index, period_label, parse_period, read_meta, to_csv_layout
+from local_rag import VECTOR_DISTANCE_THRESHOLD, format_contexts, load_corpus as load_local_corpus, similarity_top_k
+from answer_cache import cache_key, get_answer_cache, normalize_prompt
+from chat_history import HISTORY_TOKENS, HistoryWindow, get_summary_store, prefix_digests, read_history, turn_text
+from stub_model import StubModel
 from langchain_google_vertexai import VertexAI
 from langchain.agents.agent_types import AgentType
-from langchain_experimental.agents.agent_toolkits import create_csv_agent
+from langchain_experimental.agents.agent_toolkits import create_pandas_dataframe_agent
 from vertexai.preview import rag
 from vertexai.generative_models import (
     Content,
@@ -34,21 +50,16 @@ def load_csv_from_bucket(bucket_name, blob_name):
     :param bucket_name: bucket 的名稱
     :param blob_name: CSV 檔案在 bucket 中的路徑或名稱
     """
-    # 建立 Storage client
-    client = storage.Client()
-    bucket = client.bucket(bucket_name)
-    blob = bucket.blob(blob_name)
-    
-    # 直接從 blob 讀取資料（bytes 格式），並解碼成字串
-    csv_bytes = blob.download_as_string()
+    # 透過共用的快取讀取，物件 generation 未變動時不重新下載
+    csv_bytes = default_cache().get_bytes(bucket_name, blob_name)
     csv_str = csv_bytes.decode('utf-8')
     
     # 使用 io.StringIO 將字串轉換成檔案物件，供 csv.reader 使用
     csv_file = io.StringIO(csv_str)
     return csv_file
 
-def load_and_categorize(file_path):
-    df = pd.read_csv(file_path)
+def load_and_categorize(bucket_name, blob_name):
+    df = load_frame(bucket_name, blob_name)
     
     #categories
     companies = df['Company Name'].unique()
@@ -66,24 +77,20 @@ def load_and_categorize(file_path):
     
     return df, categories
 
+def out_of_range_message(data_start, data_end):
+    """資料涵蓋的時間範圍由 FinIndex 取得，新的季度匯入後自動延伸"""
+    return f"Time range is out of data. Our data range is from {period_label(data_start, ' ')} to {period_label(data_end, ' ')}. Please input the correct time range query."
+
+
 def validate_time_format(time_str, default):
     """檢查 YYYY_QX 或 YYYY Q 格式，例如 '2023_Q3' 或 '2023 Q3'"""
-    if "_" in time_str:
-        parts = time_str.split("_")
-        if len(parts) == 2 and parts[0].isdigit() and parts[1][0] == 'Q' and parts[1][1].isdigit():
-            year, quarter = int(parts[0]), int(parts[1][1])
-            if 1 <= quarter <= 4:
-                return f"{year}_Q{quarter}"
-    elif " " in time_str:
-        parts = time_str.split(" ")
-        if len(parts) == 2 and parts[0].isdigit() and parts[1][0] == 'Q' and parts[1][1].isdigit():
-            year, quarter = int(parts[0]), int(parts[1][1])
-            if 1 <= quarter <= 4:
-                return f"{year}_Q{quarter}"
+    key = parse_period(time_str)
+    if key is not None:
+        return period_label(key)
     #print(f"Error: Invalid time format '{time_str}', expected 'YYYY_QX' or 'YYYY Q'. Using default: {default}")
     return default
 
-def parse_user_query_with_gemini(query, model, get_plot_args):
+def parse_user_query_with_gemini(query, model, get_plot_args, data_start, data_end):
     try:
         plot_tool = Tool(
             function_declarations=[get_plot_args],
@@ -121,13 +128,13 @@ def parse_user_query_with_gemini(query, model, get_plot_args):
 
 
             if "start_time" in function_args:
-                function_args["start_time"] = validate_time_format(function_args["start_time"], "2020_Q1")
+                function_args["start_time"] = validate_time_format(function_args["start_time"], period_label(data_start))
 
             if "end_time" in function_args:
-                function_args["end_time"] = validate_time_format(function_args["end_time"], "2024_Q3")
+                function_args["end_time"] = validate_time_format(function_args["end_time"], period_label(data_end))
             
-            if function_args['start_time'] < "2020_Q1" or function_args['end_time'] > "2024_Q3":
-                return "Time range is out of data. Our data range is from 2020 Q1 to 2024 Q3. Please input the correct time range query."
+            if parse_period(function_args['start_time']) < data_start or parse_period(function_args['end_time']) > data_end:
+                return out_of_range_message(data_start, data_end)
 
             # **儲存結果**
             with open("gemini_parsed_output.json", "w", encoding="utf-8") as json_file:
@@ -142,64 +149,200 @@ def parse_user_query_with_gemini(query, model, get_plot_args):
         return None
 
 
-def plot_financial_data(df, parsed_query):
+# 依資料集的公司與指標建立的 SlotExtractor
+_SLOT_EXTRACTORS = {}
+
+
+def get_slot_extractor(fin_index):
+    key = (tuple(fin_index.companies), tuple(fin_index.metrics), fin_index.min_period, fin_index.max_period)
+    if key not in _SLOT_EXTRACTORS:
+        _SLOT_EXTRACTORS[key] = SlotExtractor(fin_index.min_period, fin_index.max_period, fin_index.companies, fin_index.metrics)
+    return _SLOT_EXTRACTORS[key]
+
+
+def parse_plot_query(query, model, get_plot_args, fin_index):
+    """
+    解析折線圖參數，回傳格式與 parse_user_query_with_gemini 相同。
+    先以別名表與季度解析在本機取出公司、指標與起訖時間，只有解析不出的欄位才呼叫 LLM。
     """
-    繪製指定公司與財務指標的季度折線圖。
+    start = time.perf_counter()
+    parsed_query, missing = get_slot_extractor(fin_index).extract(query)
+    local_ms = (time.perf_counter() - start) * 1000
 
-    參數:
-    df (pd.DataFrame): 包含財務數據的 DataFrame。
-    company_name (str): 要篩選的公司名稱 (如 "Apple")。
-    index_name (str): 要繪製的財務指標 (如 "Revenue")。
+    if missing:
+        start = time.perf_counter()
+        llm_query = parse_user_query_with_gemini(query, model, get_plot_args, fin_index.min_period, fin_index.max_period)
+        print(f"[slots] local {sorted(parsed_query)} in {local_ms:.2f} ms, llm {missing} in {(time.perf_counter() - start) * 1000:.0f} ms", file=sys.stderr)
+        if not isinstance(llm_query, dict):
+            return llm_query
+        defaults = {"start_time": period_label(fin_index.min_period), "end_time": period_label(fin_index.max_period)}
+        for slot in missing:
+            parsed_query[slot] = llm_query.get(slot, defaults.get(slot))
+    else:
+        print(f"[slots] local {sorted(parsed_query)} in {local_ms:.2f} ms", file=sys.stderr)
+
+    if parse_period(parsed_query["start_time"]) < fin_index.min_period or parse_period(parsed_query["end_time"]) > fin_index.max_period:
+        return out_of_range_message(fin_index.min_period, fin_index.max_period)
+    return parsed_query
+
+
+def as_list(value):
+    """將 'Apple, Nvidia' 這類以逗號分隔的字串或 list 統一成 list"""
+    if isinstance(value, str):
+        return [item.strip() for item in value.split(",") if item.strip()]
+    return [str(item).strip() for item in value or [] if str(item).strip()]
+
+
+# 折線圖快取，檔名維持 Line_Chart/Financial_line_chart_*.png 讓前端辨識
+LINE_CHART_STORE = chart_store("Line_Chart", "Financial_line_chart_")
+
+
+def line_chart_spec(series, title, ylabel, unit="USD Million"):
     """
-    #print(parsed_query)
-    # 篩選數據
-    company_name = parsed_query.get("company" , "")
-    index = parsed_query.get("index" , "")
-    start_time = parsed_query.get("start_time", "")
-    end_time = parsed_query.get("end_time" , "")
-    t = df[["CALENDAR_YEAR", "CALENDAR_QTR"]].astype(str).agg("_".join, axis=1)
+    將 [(label, periods, values), ...] 轉成前端繪圖用的 JSON 結構，不需要載入 matplotlib。
+    所有序列共用同一組 x 標籤，序列缺少的季度以 null 表示。
+    """
+    all_periods = sorted({int(key) for _, periods, _ in series for key in periods})
+    position = {key: i for i, key in enumerate(all_periods)}
+    chart_series = []
+    for label, periods, values in series:
+        aligned = [None] * len(all_periods)
+        for key, value in zip(periods, values):
+            aligned[position[int(key)]] = round(float(value), 4)
+        chart_series.append({"name": label, "values": aligned})
+    return {
+        "chart": "line",
+        "title": title,
+        "x_label": "Year_Quarter",
+        "y_label": ylabel,
+        "unit": unit,
+        "x": [period_label(key) for key in all_periods],
+        "series": chart_series,
+    }
 
-    
-    company_name_series = pd.Series([company_name] * len(t))
-    index_series = pd.Series([index] * len(t))
-    end_time_series = pd.Series([end_time] * len(t))
-    start_time_series = pd.Series([start_time] * len(t))
 
-    #  & (t <= end_time_series) & (t >= start_time_series)
-    filtered_df = df[(df["Company Name"] == company_name) & (df["Index"] == index[0]) & (t <= end_time_series) & (t >= start_time_series)]
-    
-    if filtered_df.empty:
-        return None
-    
-    # 確保數據排序
-    filtered_df = filtered_df.sort_values(by=["CALENDAR_YEAR", "CALENDAR_QTR"])
+def render_line_chart(series, title, ylabel, filepath):
+    """將 [(label, periods, values), ...] 畫成折線圖並存到 filepath，matplotlib 只在實際繪圖時載入"""
+    import matplotlib.pyplot as plt
 
-    # 設定 x 軸標籤
-    x_labels = [f"{year}_{qtr}" for year, qtr in zip(filtered_df["CALENDAR_YEAR"], filtered_df["CALENDAR_QTR"])]
+    # 以 period key 當 x 座標，不同序列缺少的季度不會錯位
+    all_periods = sorted({int(key) for _, periods, _ in series for key in periods})
+    x_labels = [period_label(key) for key in all_periods]
 
-    save_dir = "Line_Chart"
-    
-    filepath = f"{save_dir}/Financial_line_chart_{uuid.uuid4().hex}.png"
-    os.makedirs(save_dir, exist_ok=True)
     # 繪製折線圖
     plt.figure(figsize=(10, 6))
-    plt.plot(x_labels, filtered_df["USD_Value"], marker="o", linestyle="-", label=index)
+    for label, periods, values in series:
+        plt.plot(periods, values, marker="o", linestyle="-", label=label)
 
     # 設定標籤與標題
     plt.xlabel("Year_Quarter")
-    plt.ylabel(f"{index[0]} (USD Million)")
-    plt.title(f"{company_name} {index[0]} from {start_time} to {end_time}")
-    plt.xticks(rotation=45)
+    plt.ylabel(ylabel)
+    plt.title(title)
+    plt.xticks(all_periods, x_labels, rotation=45)
     plt.grid(True)
     plt.legend()
     plt.savefig(filepath)
     plt.close()
 
-    return filepath
 
+def metric_series(fin_index, company, metric, start=None, end=None):
+    """
+    回傳 (periods, values)。衍生指標 (毛利率、營業利益率等) 以 fin_cube.DERIVED_METRICS 的公式
+    由 FinIndex 中的基本指標計算，同一季重複的資料列取平均。
+    """
+    if metric not in DERIVED_METRICS:
+        return fin_index.lookup(company, metric, start, end)
+    inputs, formula = DERIVED_METRICS[metric]
+    columns = {}
+    for name in inputs:
+        periods, values = fin_index.lookup(company, name, start, end)
+        columns[name] = pd.Series(values.astype("float64"), index=periods).groupby(level=0).mean()
+    with np.errstate(divide="ignore", invalid="ignore"):
+        derived = formula(pd.DataFrame(columns)).replace([np.inf, -np.inf], np.nan).dropna()
+    return derived.index.to_numpy(), derived.to_numpy()
+
+
+def plot_financial_data(fin_index, parsed_query, chart_format="json"):
+    """
+    繪製指定公司與財務指標的季度折線圖，可同時包含多間公司與多個指標。
+    chart_format 為 'json' 時回傳圖表資料 (dict) 交給前端繪製；
+    為 'png' 時回傳圖檔路徑，相同的查詢與資料版本直接回傳快取中的圖檔。
 
-def csv_agent(args, csv_file_path):
-    model = VertexAI(model_name=args.model_name)
+    參數:
+    fin_index (FinIndex): 財務數據的 (公司, 指標) 索引。
+    parsed_query (dict): company 為公司名稱或名稱 list (如 "Apple")，
+                         index 為財務指標 list (如 ["Revenue"])，start_time / end_time 為 'YYYY_QX'。
+    chart_format (str): 'json' 或 'png'。
+    沒有任何資料時回傳錯誤訊息 (str)；標題只列出圖中實際有資料的公司與指標。
+    """
+    #print(parsed_query)
+    # 篩選數據
+    companies = list(dict.fromkeys(as_list(parsed_query.get("company", ""))))
+    indices = list(dict.fromkeys(as_list(parsed_query.get("index", ""))))
+    start = parse_period(parsed_query.get("start_time", ""))
+    end = parse_period(parsed_query.get("end_time", ""))
+
+    series = []
+    plotted = {}
+    for company_name in companies:
+        for index in indices:
+            periods, values = metric_series(fin_index, company_name, index, start, end)
+            if len(periods):
+                label = index if len(companies) == 1 else f"{company_name} {index}"
+                series.append((label, periods, values))
+                plotted.setdefault(company_name, []).append(index)
+
+    start_time = period_label(start) if start is not None else ""
+    end_time = period_label(end) if end is not None else ""
+    if not series:
+        return f"Error : No data for {', '.join(companies)} {', '.join(indices)} from {start_time} to {end_time}"
+    missing = [f"{company_name} {index}" for company_name in companies for index in indices if index not in plotted.get(company_name, [])]
+    if missing:
+        print(f"[plot] no data for {', '.join(missing)}", file=sys.stderr)
+
+    companies = [company_name for company_name in companies if company_name in plotted]
+    indices = [index for index in indices if any(index in plotted_indices for plotted_indices in plotted.values())]
+    title = f"{', '.join(companies)} {', '.join(indices)} from {start_time} to {end_time}"
+    # 比率與金額的單位不同，只有比率時 y 軸為比率
+    if all(index in RATIO_METRICS for index in indices):
+        unit = "Ratio"
+    elif any(index in RATIO_METRICS for index in indices):
+        unit = "USD Million / Ratio"
+    else:
+        unit = "USD Million"
+    ylabel = f"{indices[0]} ({unit})" if len(indices) == 1 else unit
+    if chart_format == "json":
+        return line_chart_spec(series, title, ylabel, unit)
+    key = LINE_CHART_STORE.key("line", {"companies": companies, "indices": indices, "start": start, "end": end}, fin_index.version)
+    return LINE_CHART_STORE.get_or_render(key, lambda filepath: render_line_chart(series, title, ylabel, filepath))
+
+
+# 本機意圖判斷，確定的 prompt 不需要 LLM function calling 的來回
+MAIN_ROUTER = build_router("main", MAIN_RULES)
+CSV_TOOL_ROUTER = build_router("csv_tool", CSV_TOOL_RULES)
+
+
+def parse_query_spec_with_gemini(query, model, fin_index):
+    """以一次結構化輸出的 LLM 呼叫把財報問題轉成 fin_query 的 query spec"""
+    prompt = f"""
+    Convert the financial question into a query spec.
+    Companies: {fin_index.companies}
+    Metrics: {fin_index.metrics + ['Gross profit margin', 'Operating margin']}
+    Periods are 'YYYY_QX' between {period_label(fin_index.min_period)} and {period_label(fin_index.max_period)}.
+    aggregation: value (one row per quarter), sum / mean / max / min over the period range, qoq / yoy growth.
+    comparison: rank to order companies by the first metric, otherwise none.
+    Set expressible to false if the question needs anything else.
+    Question: {query}
+    """
+    response = model.client.generate_content(
+        prompt,
+        generation_config=GenerationConfig(response_mime_type="application/json", response_schema=QUERY_SPEC_SCHEMA),
+    )
+    return json.loads(response.text)
+
+
+def csv_agent(args, df):
+    model = get_llm(args.model_name)
     choose_tool_func = FunctionDeclaration(
             name="choose_tool",
             description="""判斷問題是匯率?歷年財年?(查TRANSCRIPT_data.csv)還是查資料?""",
@@ -214,218 +357,617 @@ def csv_agent(args, csv_file_path):
             },
         )
     tool_kit = Tool(function_declarations=[choose_tool_func])
-    tool_choise = model.client.generate_content(args.prompt, tools=[tool_kit], tool_config=ToolConfig(
-                function_calling_config=ToolConfig.FunctionCallingConfig(
-                    mode=ToolConfig.FunctionCallingConfig.Mode.ANY,
-                ))
-        )
-    tool_choise_part = tool_choise.candidates[0].content.parts[0]
-    # print(tool_choise_part)
-    # print("tool func call:::", tool_choise_part.function_call)
-    # print("tool func call args:::", tool_choise_part.function_call.args)
-    # print("tool func call args value:::", tool_choise_part.function_call.args['tool_name'])
-    prompt = ""
-    if hasattr(tool_choise_part, 'function_call') and tool_choise_part.function_call:
-        if tool_choise_part.function_call.name == "choose_tool":
-            tool_name = tool_choise_part.function_call.args['tool_name']
-            if tool_name == "convert_calendar_fiscal":
-                sys_prompt = """
-                請做歷年(calendar year)與財年(fiscal year)的轉換，以下為使用者輸入:
-                """
-                csv_file_path = load_csv_from_bucket("tsmccareerhack2025-bsid-grp6-bucket", "TRANSCRIPT_Data_with_FiscalYear.csv")
+
+    def choose_tool_with_llm():
+        tool_choise = model.client.generate_content(args.prompt, tools=[tool_kit], tool_config=ToolConfig(
+                    function_calling_config=ToolConfig.FunctionCallingConfig(
+                        mode=ToolConfig.FunctionCallingConfig.Mode.ANY,
+                    ))
+            )
+        tool_choise_part = tool_choise.candidates[0].content.parts[0]
+        if hasattr(tool_choise_part, 'function_call') and tool_choise_part.function_call and tool_choise_part.function_call.name == "choose_tool":
+            return tool_choise_part.function_call.args['tool_name']
+        return None
+
+    tool_name = CSV_TOOL_ROUTER.resolve(args.prompt, choose_tool_with_llm, args.router_threshold)
+    # 查指標、匯率與財年轉換的問題先以 query spec 與查詢表直接計算，無法表達時才交給 ReAct agent
+    if tool_name in ("search_finantial_index", "exchange_rate", "convert_calendar_fiscal"):
+        try:
+            fin_index = load_index(*dataset_location(args.user_role))
+            extractor = get_slot_extractor(fin_index)
+            if tool_name == "search_finantial_index":
+                cube = load_cube(*dataset_location(args.user_role))
+                answer = answer_query(args.prompt, fin_index, extractor, lambda query: parse_query_spec_with_gemini(query, model, fin_index), cube)
             elif tool_name == "exchange_rate":
-                sys_prompt = """
-                美金與台幣匯率以1 USD = 32.93 TWD 為基準
-                """
-            elif tool_name == "search_finantial_index":
-                sys_prompt = ""
-            prompt = sys_prompt + args.prompt
-    agent = create_csv_agent(
+                answer = answer_exchange(args.prompt, fin_index, extractor, load_fx_table())
+            else:
+                answer = answer_fiscal(args.prompt, load_fiscal_calendar(), extractor)
+        except Exception as e:
+            # 查詢表或 query spec 出錯時不讓整個 request 失敗，改由 ReAct agent 回答
+            print(f"[lookup] {tool_name} failed, falling back to the agent: {e!r}", file=sys.stderr)
+            answer = None
+        if answer is not None:
+            return answer
+
+    prompt = ""
+    if tool_name is not None:
+        sys_prompt = ""
+        if tool_name == "convert_calendar_fiscal":
+            sys_prompt = """
+            請做歷年(calendar year)與財年(fiscal year)的轉換，以下為使用者輸入:
+            """
+            df = load_frame(TRANSCRIPT_BUCKET, TRANSCRIPT_BLOB)
+        elif tool_name == "exchange_rate":
+            _, rate = load_fx_table().latest("USD", "TWD")
+            sys_prompt = f"""
+            美金與台幣匯率以1 USD = {rate:g} TWD 為基準
+            """
+        prompt = sys_prompt + args.prompt
+    # agent 會在 REPL 中執行任意 pandas 程式碼，傳入原始 CSV 格式的副本，避免改動常駐的資料集
+    agent = create_pandas_dataframe_agent(
         model,
-        csv_file_path,
+        to_csv_layout(df),
         verbose=False,
         agent_type=AgentType.ZERO_SHOT_REACT_DESCRIPTION,
         allow_dangerous_code=True,
     )
     return agent.run(prompt)
 
-def rag_agent(args, rag_retrieval_tool):
+def generate_text(model, prompt, on_delta=None, **kwargs):
+    """
+    產生回答並回傳完整文字。on_delta 不為 None 時以串流方式生成，每收到一段文字就呼叫 on_delta(text)。
+    """
+    if on_delta is None:
+        return model.generate_content(prompt, **kwargs).candidates[0].content.parts[0].text
+    parts = []
+    for chunk in model.generate_content(prompt, stream=True, **kwargs):
+        try:
+            text = chunk.text
+        except ValueError:
+            # 沒有文字的片段 (例如只有 grounding metadata 或被安全過濾)
+            continue
+        if text:
+            parts.append(text)
+            on_delta(text)
+    return "".join(parts)
+
+
+def with_history(history, text):
+    """在對話紀錄 (Content list) 之後加上這次的問題，沒有對話紀錄時直接使用文字"""
+    if not history:
+        return text
+    return history + [Content(role="user", parts=[Part.from_text(text)])]
+
+
+def rag_agent(args, rag_retrieval_tool, companies=None, on_delta=None, history=None):
+    """
+    回答法說會相關的問題。on_delta 不為 None 時以串流方式生成並逐段傳給 on_delta，
+    快取命中時整個答案只傳一次，發生錯誤時傳出錯誤訊息。history 為 build_history 回傳的 (contents, key)，回答時一併送給模型。
+    """
+    contents, history_key = history or ([], None)
+    # 相同角色、corpus、問題與生成設定的答案在 TTL 內直接重複使用，快取依 user_role 隔離；
+    # 有對話紀錄時答案與前文有關，key 包含對話紀錄
+    cache = None if args.no_answer_cache else get_answer_cache()
     try:
-        model = GenerativeModel(
+        if args.rag_backend == "local":
+            # 本機向量庫的版本隨逐字稿目錄改變，key 包含版本，fin_ingest 同步新的逐字稿後不會沿用舊的段落與答案
+            local_corpus = load_local_corpus(args.user_role, companies)
+            corpus = f"local:{local_corpus.embedder.name}:{local_corpus.version}:{args.rag_index}"
+        else:
+            corpus = CORPUS_DICT[args.user_role]
+        question = normalize_prompt(args.prompt)
+        answer_key = cache_key(corpus, question, args.model_name, args.temperature, args.max_tokens, *([history_key] if contents else []))
+        if cache is not None:
+            answer = cache.get(args.user_role, "answer", answer_key)
+            if answer is not None:
+                if on_delta is not None:
+                    on_delta(answer)
+                return answer
+
+        if args.rag_backend == "local":
+            # 在本機向量庫檢索逐字稿段落 (top_k 與距離門檻與 Vertex RAG 相同)，再連同問題交給模型回答
+            contexts_key = cache_key(corpus, question)
+            hits = cache.get(args.user_role, "contexts", contexts_key) if cache is not None else None
+            if hits is None:
+                start = time.perf_counter()
+                hits = local_corpus.search(args.prompt, similarity_top_k(args.user_role), VECTOR_DISTANCE_THRESHOLD, args.rag_index)
+                print(f"[rag] {len(hits)} local chunks in {(time.perf_counter() - start) * 1000:.1f} ms", file=sys.stderr)
+                if cache is not None:
+                    cache.put(args.user_role, "contexts", contexts_key, hits)
+            model = get_generative_model(args, None)
+            answer = generate_text(model, with_history(contents, LOCAL_RAG_PROMPT.format(contexts=format_contexts(hits), question=args.prompt)), on_delta)
+        else:
+            model = get_generative_model(args, rag_retrieval_tool)
+            answer = generate_text(model, with_history(contents, args.prompt), on_delta, tools=[rag_retrieval_tool])
+        if cache is not None and answer:
+            cache.put(args.user_role, "answer", answer_key, answer)
+        return answer
+
+    except Exception as e:
+        # 錯誤訊息與回答相同經由 on_delta (或回傳值) 輸出，stream 模式下 stdout 仍然都是 JSON 事件
+        message = f"生成RAG回答時發生錯誤: {e}"
+        if on_delta is not None:
+            on_delta(message)
+        return message
+
+
+# 本機檢索時的回答 prompt，contexts 為檢索到的逐字稿段落
+LOCAL_RAG_PROMPT = """
+Answer the question using the earnings call transcript excerpts below. If the excerpts do not contain the answer, say so.
+如果問題是中文，請以中文回答。
+
+Excerpts:
+{contexts}
+
+Question: {question}
+"""
+
+# 將較舊的對話併入滾動摘要的 prompt
+HISTORY_SUMMARY_PROMPT = """
+Update the running summary of a conversation between a user and a financial analysis assistant.
+Keep the companies, periods, metrics, figures and conclusions the user may refer back to; drop greetings and small talk.
+Write at most {max_words} words, in the language of the conversation.
+
+Current summary:
+{summary}
+
+New messages:
+{messages}
+"""
+HISTORY_SUMMARY_TOKENS = int(os.environ.get("MARKETAGENT_HISTORY_SUMMARY_TOKENS", 400))
+
+# 根據不同的 user_role 指定對應的 Corpus 資源名稱
+CORPUS_DICT = {
+    "Global": "projects/901172456759/locations/us-central1/ragCorpora/4467570830351532032",
+    "China": "projects/901172456759/locations/us-central1/ragCorpora/8142508126285856768",
+    "Korea": "projects/901172456759/locations/us-central1/ragCorpora/1224979098644774912",
+}
+
+# 以不連線的 StubModel 取代 GenerativeModel，用於測試串流輸出
+STUB_MODEL = os.environ.get("MARKETAGENT_STUB_MODEL") == "1"
+
+# 以下快取在常駐模式 (--serve) 下跨 request 共用，避免每次重新建立
+_TOOLKIT_CACHE = {}
+_MODEL_CACHE = {}
+
+
+def get_llm(model_name):
+    """取得 langchain 的 VertexAI 物件，同一個 process 內重複使用"""
+    key = ("langchain", model_name)
+    if key not in _MODEL_CACHE:
+        _MODEL_CACHE[key] = VertexAI(model_name=model_name)
+    return _MODEL_CACHE[key]
+
+
+def get_generative_model(args, tool):
+    """依模型名稱、生成參數與綁定的 tool 取得 GenerativeModel，同一個 process 內重複使用"""
+    key = (args.model_name, args.temperature, args.max_tokens, id(tool))
+    if key not in _MODEL_CACHE and STUB_MODEL:
+        _MODEL_CACHE[key] = StubModel()
+    if key not in _MODEL_CACHE:
+        _MODEL_CACHE[key] = GenerativeModel(
             model_name=args.model_name,
             generation_config=GenerationConfig(
                 temperature=args.temperature if args.temperature else 0.5,
                 max_output_tokens=args.max_tokens if args.max_tokens else 100,
             ),
-            tools=[rag_retrieval_tool]
+            tools=[tool] if tool is not None else None
         )
-        response = model.generate_content(args.prompt, tools=[rag_retrieval_tool])
-        response_part = response.candidates[0].content.parts[0]
-        return response_part.text
+    return _MODEL_CACHE[key]
 
-    except Exception as e:
-        print("生成RAG回答時發生錯誤:", e)
-        return
+
+def get_summary_model(model_name):
+    """產生對話摘要用的 GenerativeModel，輸出長度固定為 HISTORY_SUMMARY_TOKENS"""
+    key = ("history_summary", model_name)
+    if key not in _MODEL_CACHE:
+        _MODEL_CACHE[key] = StubModel() if STUB_MODEL else GenerativeModel(
+            model_name=model_name,
+            generation_config=GenerationConfig(temperature=0.2, max_output_tokens=HISTORY_SUMMARY_TOKENS),
+        )
+    return _MODEL_CACHE[key]
 
 
+def summarize_history(model_name):
+    """HistoryWindow 用的 summarize(previous_summary, turns)"""
+    def summarize(summary, turns):
+        messages = "\n\n".join(f"{turn.get('role', 'user')}: {turn_text(turn)}" for turn in turns)
+        prompt = HISTORY_SUMMARY_PROMPT.format(max_words=HISTORY_SUMMARY_TOKENS // 2, summary=summary or "(none)", messages=messages)
+        return generate_text(get_summary_model(model_name), prompt).strip()
+    return summarize
 
-def main_worker(args, history):
+
+def dataset_location(user_role):
+    """回傳 user_role 對應財報 CSV 的 (bucket_name, blob_name)"""
+    if user_role == "Global":
+        return "careerhack2025-bsid-resource-bucket", "FIN_Data.csv"
+    return "tsmccareerhack2025-bsid-grp6-bucket", f"{user_role}_Fin_data.csv"
+
+
+def build_toolkit(user_role, data_start, data_end):
     """
-    使用已部署的 Corpus 建立檢索工具、整合 RAG 模型並發送查詢。
-    參數:
-      prompt: 查詢內容
-      user_role: 使用者角色，決定使用哪個 Corpus。可選值有 "Global", "China", "Korea"
-      model_name: 使用的生成模型名稱
+    建立 user_role 對應的 RAG 檢索工具與 function declarations。
+    data_start / data_end 為資料涵蓋的 period key，寫入 plot_line_chart 的時間預設值。
+
+    :return: (rag_retrieval_tool, get_plot_func, tool_kit)
     """
-    # 根據不同的 user_role 指定對應的 Corpus 資源名稱
-    corpus_dict = {
-        "Global": "projects/901172456759/locations/us-central1/ragCorpora/4467570830351532032",
-        "China": "projects/901172456759/locations/us-central1/ragCorpora/8142508126285856768",
-        "Korea": "projects/901172456759/locations/us-central1/ragCorpora/1224979098644774912",
-    }
-    
-    if args.user_role not in corpus_dict:
-        raise ValueError("無效的 user_role，請選擇 Global、China 或 Korea") 
-    
-    existing_corpus = corpus_dict[args.user_role]
-    
     # 利用已部署的 Corpus 名稱建立一個簡單的對象，以便後續傳入 RAG SDK
-    corpus = type("Corpus", (), {"name": existing_corpus})
-    try:
-        topk = 20 if args.user_role == "Global" else 12
-        rag_retrieval_tool = Tool.from_retrieval(
-            retrieval=rag.Retrieval(
-                source=rag.VertexRagStore(
-                    rag_resources=[
-                        rag.RagResource(rag_corpus=corpus.name)
-                    ],
-                    similarity_top_k=topk,
-                    vector_distance_threshold=0.6,
-                ),
-            )
+    corpus = type("Corpus", (), {"name": CORPUS_DICT[user_role]})
+    topk = similarity_top_k(user_role)
+    rag_retrieval_tool = Tool.from_retrieval(
+        retrieval=rag.Retrieval(
+            source=rag.VertexRagStore(
+                rag_resources=[
+                    rag.RagResource(rag_corpus=corpus.name)
+                ],
+                similarity_top_k=topk,
+                vector_distance_threshold=VECTOR_DISTANCE_THRESHOLD,
+            ),
         )
-        get_plot_func = FunctionDeclaration(
-            name="plot_line_chart",
-            description="Draw a line chart of the financial index for a company according to the user's query, including the start and end time, which are in the format 'year_quarter, showing the financial index for each quarter.",
-            parameters={
-            "type": "object",
-            "properties": {
-                "company": {
-                    "type": "string",
-                    "description": "string of company name include ['Amazon', 'AMD', 'Amkor', 'Apple', 'Applied Material', 'Baidu', 'Broadcom', 'Cirrus Logic', 'Google', 'Himax', 'Intel', 'KLA', 'Marvell', 'Microchip', 'Microsoft', 'Nvidia', 'ON Semi', 'Qorvo', 'Qualcomm', 'Samsung', 'STM', 'Tencent', 'Texas Instruments', 'TSMC', 'Western Digital'],\
-                        如果使用者輸入的是中文，公司名稱範圍:[亞馬遜', '超微', '艾克爾國際科技', '蘋果', '應用材料', '百度', '博通', '思睿邏輯', '谷歌', '奇景光電', '英特爾', '科磊', '邁威爾科技', '微芯科技', '微軟', '輝達', '安森美', '威訊聯合半導體', '高通公司', '三星', '意法半導體', '騰訊', '德州儀器', '台灣積體電路製造', '威騰電子']. 請轉換成 ['Amazon', 'AMD', 'Amkor', 'Apple', 'Applied Material', 'Baidu', 'Broadcom', 'Cirrus Logic', 'Google', 'Himax', 'Intel', 'KLA', 'Marvell', 'Microchip', 'Microsoft', 'Nvidia', 'ON Semi', 'Qorvo', 'Qualcomm', 'Samsung', 'STM', 'Tencent', 'Texas Instruments', 'TSMC', 'Western Digital']\
-                        If user assign other company name, return out of data"
-                },
-                "index": {
-                    "type": "string",
-                    "description": "index arguement means the finacial index that you want to extract from the raw data frame\
-                        string of index include ['Cost of Goods Sold', 'Operating Expense', 'Operating Income', 'Revenue', 'Tax Expense', 'Total Asset' , 'Gross profit margin' , 'Operating margin']. \
-                        User can input more than one index. For example, user_query = '我想知道 Apple 在 2023 的 revenue 和 Cost of Goods Sold', you should return like this format ['Revenue' , 'Cost of Goods Sold']\
-                        So if user give multiple indeces input, return the list of indeces. \
-                        If user assign other index name, return out of data. \
-                        如果使用者輸入的是中文，指標名稱範圍['銷貨成本', '營業費用', '營業收入', '營收', '稅費', '總資產', '毛利率', '營業利益率']，將它轉化成  ['Cost of Goods Sold', 'Operating Expense', 'Operating Income', 'Revenue', 'Tax Expense', 'Total Asset' , 'Gross profit margin' , 'Operating margin']"
-                },
-                "start_time": {
-                    "type": "string",
-                    "description": "user can assign the start time of the data, the format should be 'year_quarter', for example '2020 Q1' means 2020 Q1, then you should return 2020_Q1.\
-                        If user assign 'all' or not assign, return 2020_Q1. \
-                        如果使用者輸入的是中文，請對應以下的時間格式，例如'2020 Q1'代表2020年第一季，則你應該回傳2020_Q1。\
-                        if user assign other time, return out of data"
-                },
-                "end_time": {
-                    "type": "string",
-                    "description": "user can assign the end time of the data, the format should be 'year_quarter', for example '2023 Q4' means 2023 Q4, then you should return 2023_Q4.\
-                        If user assign 'all' or not assign, return 2024_Q3. \
-                        如果使用者輸入的是中文，請對應以下的時間格式，例如'2023 Q4'代表2023年第四季，則你應該回傳2023_Q4。\
-                        if user assign other time, return out of data"
-                },
+    )
+    get_plot_func = FunctionDeclaration(
+        name="plot_line_chart",
+        description="Draw a line chart of the financial index for a company according to the user's query, including the start and end time, which are in the format 'year_quarter, showing the financial index for each quarter.",
+        parameters={
+        "type": "object",
+        "properties": {
+            "company": {
+                "type": "string",
+                "description": "string of company name include ['Amazon', 'AMD', 'Amkor', 'Apple', 'Applied Material', 'Baidu', 'Broadcom', 'Cirrus Logic', 'Google', 'Himax', 'Intel', 'KLA', 'Marvell', 'Microchip', 'Microsoft', 'Nvidia', 'ON Semi', 'Qorvo', 'Qualcomm', 'Samsung', 'STM', 'Tencent', 'Texas Instruments', 'TSMC', 'Western Digital'],\
+                    如果使用者輸入的是中文，公司名稱範圍:[亞馬遜', '超微', '艾克爾國際科技', '蘋果', '應用材料', '百度', '博通', '思睿邏輯', '谷歌', '奇景光電', '英特爾', '科磊', '邁威爾科技', '微芯科技', '微軟', '輝達', '安森美', '威訊聯合半導體', '高通公司', '三星', '意法半導體', '騰訊', '德州儀器', '台灣積體電路製造', '威騰電子']. 請轉換成 ['Amazon', 'AMD', 'Amkor', 'Apple', 'Applied Material', 'Baidu', 'Broadcom', 'Cirrus Logic', 'Google', 'Himax', 'Intel', 'KLA', 'Marvell', 'Microchip', 'Microsoft', 'Nvidia', 'ON Semi', 'Qorvo', 'Qualcomm', 'Samsung', 'STM', 'Tencent', 'Texas Instruments', 'TSMC', 'Western Digital']\
+                    If user assign other company name, return out of data"
             },
-                "required": [
-                    "company",
-                    "index",
-                    "start_time",
-                    "end_time"
-                ]
-        }
-        )
-
-        rag_retrieval_func = FunctionDeclaration(
-            name="rag_retrieval",
-            description="""If you need more information about the topic, call this function to access RAG model.
-            如果題目是針對法說會的問題，呼叫此函數以存取 RAG 模型，取得法說會逐字稿。""",
-            parameters={
-                "type": "object",
-                "properties": {}
+            "index": {
+                "type": "string",
+                "description": "index arguement means the finacial index that you want to extract from the raw data frame\
+                    string of index include ['Cost of Goods Sold', 'Operating Expense', 'Operating Income', 'Revenue', 'Tax Expense', 'Total Asset' , 'Gross profit margin' , 'Operating margin']. \
+                    User can input more than one index. For example, user_query = '我想知道 Apple 在 2023 的 revenue 和 Cost of Goods Sold', you should return like this format ['Revenue' , 'Cost of Goods Sold']\
+                    So if user give multiple indeces input, return the list of indeces. \
+                    If user assign other index name, return out of data. \
+                    如果使用者輸入的是中文，指標名稱範圍['銷貨成本', '營業費用', '營業收入', '營收', '稅費', '總資產', '毛利率', '營業利益率']，將它轉化成  ['Cost of Goods Sold', 'Operating Expense', 'Operating Income', 'Revenue', 'Tax Expense', 'Total Asset' , 'Gross profit margin' , 'Operating margin']"
             },
-        )
-        csv_agent_func = FunctionDeclaration(
-            name="csv_agent",
-            description="If you need more information about finantial data, like ['Cost of Goods Sold', 'Operating Expense', 'Operating Income', 'Revenue', 'Tax Expense', 'Total Asset' , 'Gross profit margin' , 'Operating margin'], call this function to access csv data.",
-            parameters={
-                "type": "object",
-                "properties": {}
+            "start_time": {
+                "type": "string",
+                "description": f"user can assign the start time of the data, the format should be 'year_quarter', for example '2020 Q1' means 2020 Q1, then you should return 2020_Q1.\
+                    If user assign 'all' or not assign, return {period_label(data_start)}. \
+                    如果使用者輸入的是中文，請對應以下的時間格式，例如'2020 Q1'代表2020年第一季，則你應該回傳2020_Q1。\
+                    if user assign other time, return out of data"
             },
-        )
-        tool_kit = Tool(function_declarations=[csv_agent_func, rag_retrieval_func, get_plot_func])
-    except Exception as e:
-        print("建立檢索工具時發生錯誤:", e)
-        return
-    
-    try:
-        model = GenerativeModel(
-            model_name=args.model_name,
-            generation_config=GenerationConfig(
-                temperature=args.temperature if args.temperature else 0.5,
-                max_output_tokens=args.max_tokens if args.max_tokens else 100,
-            ),
-            tools=[tool_kit]
-        )
+            "end_time": {
+                "type": "string",
+                "description": f"user can assign the end time of the data, the format should be 'year_quarter', for example '2023 Q4' means 2023 Q4, then you should return 2023_Q4.\
+                    If user assign 'all' or not assign, return {period_label(data_end)}. \
+                    如果使用者輸入的是中文，請對應以下的時間格式，例如'2023 Q4'代表2023年第四季，則你應該回傳2023_Q4。\
+                    if user assign other time, return out of data"
+            },
+        },
+            "required": [
+                "company",
+                "index",
+                "start_time",
+                "end_time"
+            ]
+    }
+    )
+
+    rag_retrieval_func = FunctionDeclaration(
+        name="rag_retrieval",
+        description="""If you need more information about the topic, call this function to access RAG model.
+        如果題目是針對法說會的問題，呼叫此函數以存取 RAG 模型，取得法說會逐字稿。""",
+        parameters={
+            "type": "object",
+            "properties": {}
+        },
+    )
+    csv_agent_func = FunctionDeclaration(
+        name="csv_agent",
+        description="If you need more information about finantial data, like ['Cost of Goods Sold', 'Operating Expense', 'Operating Income', 'Revenue', 'Tax Expense', 'Total Asset' , 'Gross profit margin' , 'Operating margin'], call this function to access csv data.",
+        parameters={
+            "type": "object",
+            "properties": {}
+        },
+    )
+    tool_kit = Tool(function_declarations=[csv_agent_func, rag_retrieval_func, get_plot_func])
+    return rag_retrieval_tool, get_plot_func, tool_kit
+
+
+def get_toolkit(user_role, data_start, data_end):
+    # 匯入新的季度後時間範圍改變，function declarations 需要重建
+    key = (user_role, data_start, data_end)
+    if key not in _TOOLKIT_CACHE:
+        _TOOLKIT_CACHE[key] = build_toolkit(user_role, data_start, data_end)
+    return _TOOLKIT_CACHE[key]
+
+
+def stored_data_range(user_role):
+    """
+    store 中記錄的資料時間範圍 (period key)，不需要載入資料或連線到 bucket，供路由用的 function declarations 使用。
+    尚未建立 store 時回傳 None。
+    """
+    meta = read_meta(dataset_location(user_role)[1])
+    if not meta or "min_period" not in meta:
+        return None
+    return parse_period(meta["min_period"]), parse_period(meta["max_period"])
+
+
+def load_dataset(user_role):
+    """載入 user_role 的 FinIndex 與財報資料 (會向 bucket 檢查 generation，有新版本時下載)"""
+    location = dataset_location(user_role)
+    fin_index = load_index(*location)
+    df, _ = load_and_categorize(*location)
+    return fin_index, df
+
+
+def route_prompt(args, model, tool_kit):
+    """回傳 (intent, LLM 的回覆)；本機路由有把握時不呼叫 LLM，回覆為 None"""
+    llm_reply = {}
+
+    def route_with_llm():
         response = model.generate_content("你有三個工具可以使用:[csv_agent, rag_retrieval, line_plot]如果使用者問歷年(calendar year)和財年(fiscal year)的轉換，或者問匯率的轉換，或者問以下指標:['Cost of Goods Sold', 'Operating Expense', 'Operating Income', 'Revenue', 'Tax Expense', 'Total Asset' , 'Gross profit margin' , 'Operating margin'] 都call csv_agent來解決以上三種問題。如果是針對法說會的問題，call rag_retrieval。如果使用者要求畫折線圖(line plot)，call plot_line_chart。以下為使用者問題:"+args.prompt, tools=[tool_kit], tool_config=ToolConfig(
                 function_calling_config=ToolConfig.FunctionCallingConfig(
                     mode=ToolConfig.FunctionCallingConfig.Mode.ANY,
                 )
             ))
-        response_part = response.candidates[0].content.parts[0]
-        if args.user_role == "Global":
-            bucket_name = "careerhack2025-bsid-resource-bucket"
-            blob_name = "FIN_Data.csv"
-        else:
-            bucket_name = "tsmccareerhack2025-bsid-grp6-bucket"
-            blob_name = f"{args.user_role}_Fin_data.csv"
-        csv_file_path = load_csv_from_bucket(bucket_name, blob_name)
+        response_part = llm_reply["part"] = response.candidates[0].content.parts[0]
         if hasattr(response_part, 'function_call') and response_part.function_call:
-            if response_part.function_call.name == "csv_agent":
-                print("Call csv_agent function")
-                response = csv_agent(args, csv_file_path)
-                print(response)
-            elif response_part.function_call.name == "rag_retrieval":
-                print("Call rag_retrieval function")
-                response = rag_agent(args, rag_retrieval_tool)
-                print(response)
-            elif response_part.function_call.name == "plot_line_chart":
-                df, _ = load_and_categorize(csv_file_path)
-                parsed_query = parse_user_query_with_gemini(args.prompt, model, get_plot_func)
-                if parsed_query:
-                    path = plot_financial_data(df, parsed_query)
-                    print(path)
-                else:
-                    print("Error : Failed to parse query")
+            return response_part.function_call.name
+        return None
+
+    intent = MAIN_ROUTER.resolve(args.prompt, route_with_llm, args.router_threshold)
+    return intent, llm_reply.get("part")
+
+
+def run_prefetch(loop, name, func, *args):
+    """
+    在 daemon thread 執行預先載入，回傳 loop 的 future。
+    ThreadPoolExecutor 的 thread 會在 process 結束前被 join，單次執行時 RAG 路徑用不到的資料集載入會延後 chat.py 結束；
+    daemon thread 在 process 結束時直接終止 (寫入 store 的檔案都是 tmp + os.replace，不會留下不完整的檔案)。
+    """
+    future = loop.create_future()
+
+    def resolve(result, error):
+        if future.cancelled():
+            return
+        if error is not None:
+            future.set_exception(error)
         else:
-            print(response_part.text)
+            future.set_result(result)
+
+    def run():
+        try:
+            result, error = func(*args), None
+        except Exception as e:
+            result, error = None, e
+        try:
+            loop.call_soon_threadsafe(resolve, result, error)
+        except RuntimeError:
+            # event loop 已結束 (結果已被捨棄)
+            pass
+
+    threading.Thread(target=run, name=f"prefetch-{name}", daemon=True).start()
+    return future
+
+
+def discard(task):
+    """
+    不再需要預先載入的結果：尚未完成時取消等待。常駐模式下載入仍會完成並留在記憶體中供之後的 request 使用，
+    單次執行時隨 process 結束而終止。
+    """
+    if task.done():
+        if not task.cancelled():
+            task.exception()
+    else:
+        task.cancel()
+
+
+class ChatOutput:
+    """
+    main_worker 輸出給前端的內容。預設與原本相同以 print 輸出文字；
+    stream 模式下每個事件輸出一行 JSON (NDJSON) 並立即 flush，前端可以邊收邊顯示：
+      {"type": "route", "intent": ...}                  選定的處理路徑
+      {"type": "delta", "text": ...}                    回答的一段文字
+      {"type": "chart", "format": "json", "chart": ...} 折線圖資料 (png 時為 "path")
+      {"type": "done", "stages": ..., "first_delta_ms": ...}
+
+    :param stream: 是否輸出 NDJSON 事件
+    """
+
+    def __init__(self, stream=False):
+        self.stream = stream
+        self.started = time.perf_counter()
+        self.first_delta_ms = None
+
+    def _event(self, **event):
+        sys.stdout.write(json.dumps(event, ensure_ascii=False) + "\n")
+        sys.stdout.flush()
+
+    def route(self, intent):
+        if self.stream:
+            self._event(type="route", intent=intent)
+        elif intent in ("csv_agent", "rag_retrieval"):
+            print(f"Call {intent} function")
+
+    def text(self, text):
+        if not self.stream:
+            print(text)
+            return
+        if text is None or text == "":
+            return
+        if self.first_delta_ms is None:
+            self.first_delta_ms = round((time.perf_counter() - self.started) * 1000, 1)
+        self._event(type="delta", text=str(text))
+
+    def chart(self, chart, chart_format):
+        if not self.stream:
+            print(json.dumps(chart, ensure_ascii=False, separators=(",", ":")) if chart_format == "json" and isinstance(chart, dict) else chart)
+        elif chart_format == "json" and isinstance(chart, dict):
+            self._event(type="chart", format="json", chart=chart)
+        elif chart_format == "png" and chart is not None and os.path.exists(str(chart)):
+            self._event(type="chart", format="png", path=chart)
+        else:
+            # 解析失敗時是錯誤訊息
+            self.text(chart)
+
+    def done(self, stages):
+        if self.stream:
+            self._event(type="done", stages=stages, first_delta_ms=self.first_delta_ms)
+
+
+async def run_pipeline(args, output=None, turns=()):
+    """
+    一筆查詢的處理流程。資料集的載入、對話紀錄的整理與路由 (本機路由或 LLM) 同時開始：
+    csv_agent 與折線圖路徑等待並使用載入的資料，RAG 路徑不等待資料集，回答時使用對話紀錄。
+    其他路徑不使用對話紀錄，但整理時產生的摘要仍會存入快取供之後使用。
+    回傳各階段相對於開始時間的起訖時間 (ms)。
+    """
+    output = output or ChatOutput()
+    # stream 模式下 RAG 回答邊生成邊輸出，否則生成完再一次輸出
+    on_delta = output.text if output.stream else None
+    loop = asyncio.get_running_loop()
+    started = time.perf_counter()
+    timings = {}
+
+    def elapsed_ms(moment):
+        return round((moment - started) * 1000, 1)
+
+    async def stage(name, func, *func_args, prefetch=False):
+        start = time.perf_counter()
+        status = "done"
+        ended = []
+
+        def timed():
+            try:
+                return func(*func_args)
+            finally:
+                ended.append(time.perf_counter())
+
+        try:
+            if prefetch:
+                return await run_prefetch(loop, name, timed)
+            return await loop.run_in_executor(None, timed)
+        except asyncio.CancelledError:
+            status = "discarded"
+            raise
+        except Exception:
+            status = "failed"
+            raise
+        finally:
+            # 被捨棄的預先載入在取消時多半仍在執行，end_ms 為 None (實際結束時間未知)，另外記錄捨棄的時間
+            timings[name] = {
+                "start_ms": elapsed_ms(start),
+                "end_ms": elapsed_ms(ended[0]) if ended else None,
+                "status": status,
+            }
+            if status == "discarded":
+                timings[name]["discarded_ms"] = elapsed_ms(time.perf_counter())
+
+    dataset = asyncio.ensure_future(stage("dataset", load_dataset, args.user_role, prefetch=True))
+    history = asyncio.ensure_future(stage("history", build_history, args, list(turns), prefetch=True))
+    try:
+        data_range = stored_data_range(args.user_role)
+        if data_range is None:
+            fin_index, _ = await dataset
+            data_range = (fin_index.min_period, fin_index.max_period)
+        rag_retrieval_tool, get_plot_func, tool_kit = get_toolkit(args.user_role, *data_range)
+    except Exception as e:
+        discard(dataset)
+        discard(history)
+        output.text(f"建立檢索工具時發生錯誤: {e}")
+        return timings
+
+    try:
+        model = get_generative_model(args, tool_kit)
+        intent, llm_part = await stage("route", route_prompt, args, model, tool_kit)
+        output.route(intent)
+        if intent is None:
+            discard(dataset)
+            discard(history)
+            output.text(llm_part.text)
+        elif intent == "rag_retrieval" and (args.rag_backend == "vertex" or args.user_role == "Global"):
+            discard(dataset)
+            response = await stage("answer", rag_agent, args, rag_retrieval_tool, None, on_delta, await history)
+            if on_delta is None:
+                output.text(response)
+        else:
+            if intent != "rag_retrieval":
+                discard(history)
+            try:
+                fin_index, df = await dataset
+            except Exception as e:
+                discard(history)
+                output.text(f"建立檢索工具時發生錯誤: {e}")
+                return timings
+            if (fin_index.min_period, fin_index.max_period) != data_range:
+                # store 中的範圍已過期 (剛匯入新的季度)，折線圖使用最新範圍的 declarations
+                rag_retrieval_tool, get_plot_func, tool_kit = get_toolkit(args.user_role, fin_index.min_period, fin_index.max_period)
+                model = get_generative_model(args, tool_kit)
+            if intent == "csv_agent":
+                response = await stage("answer", csv_agent, args, df)
+                output.text(response)
+            elif intent == "rag_retrieval":
+                # 本機檢索的範圍是該角色資料集中的公司，需要等資料集載入
+                response = await stage("answer", rag_agent, args, rag_retrieval_tool, fin_index.companies, on_delta, await history)
+                if on_delta is None:
+                    output.text(response)
+            elif intent == "plot_line_chart":
+                def answer_plot():
+                    parsed_query = parse_plot_query(args.prompt, model, get_plot_func, fin_index)
+                    if isinstance(parsed_query, str):
+                        return parsed_query
+                    if not parsed_query:
+                        return "Error : Failed to parse query"
+                    return plot_financial_data(fin_index, parsed_query, args.chart_format)
+                output.chart(await stage("answer", answer_plot), args.chart_format)
         # chat = model.client.start_chat(history=history)
         # response = chat.send_message(args.prompt)
         # print(response.candidates[0].content.parts)
+    except Exception as e:
+        discard(dataset)
+        discard(history)
+        output.text(f"發送查詢並生成回答時發生錯誤: {e}")
+    return timings
 
 
-    except Exception as e:
-        print("發送查詢並生成回答時發生錯誤:", e)
-        return
-    
-def main():
+def format_stages(timings):
+    """stderr 用的各階段時間，並列出資料集載入與路由重疊的時間 (只計算已知結束時間的階段)"""
+    parts = []
+    for name, timing in timings.items():
+        if timing["end_ms"] is None:
+            parts.append(f"{name} {timing['start_ms']:.0f}-? ms ({timing['status']} at {timing['discarded_ms']:.0f} ms)")
+        else:
+            parts.append(f"{name} {timing['start_ms']:.0f}-{timing['end_ms']:.0f} ms ({timing['status']})")
+    if "dataset" in timings and "route" in timings and timings["dataset"]["end_ms"] is not None and timings["route"]["end_ms"] is not None:
+        dataset, route = timings["dataset"], timings["route"]
+        overlap = max(0.0, min(dataset["end_ms"], route["end_ms"]) - max(dataset["start_ms"], route["start_ms"]))
+        parts.append(f"overlap {overlap:.0f} ms")
+    return ", ".join(parts)
+
+
+def main_worker(args, history):
+    """
+    使用已部署的 Corpus 建立檢索工具、整合 RAG 模型並發送查詢，回傳各階段的時間。
+    參數:
+      history: 對話紀錄 (read_history 讀入的 JSON list)
+      prompt: 查詢內容
+      user_role: 使用者角色，決定使用哪個 Corpus。可選值有 "Global", "China", "Korea"
+      model_name: 使用的生成模型名稱
+    """
+    if args.user_role not in CORPUS_DICT:
+        raise ValueError("無效的 user_role，請選擇 Global、China 或 Korea") 
+
+    output = ChatOutput(args.stream)
+    timings = asyncio.run(run_pipeline(args, output, history))
+    print(f"[pipeline] {format_stages(timings)}", file=sys.stderr)
+    output.done(timings)
+    return timings
+
+
+def build_arg_parser():
     parser = argparse.ArgumentParser(description="Generate content using a generative model.")
     parser.add_argument("--prompt", type=str, default="Tell me how to win a hackathon", help="The prompt to send to the model.")
     parser.add_argument("--model_name", type=str, default="gemini-1.5-pro", help="The name of the generative model to use.")
     parser.add_argument("--history", type=str, help="History JSON string")
+    parser.add_argument("--history_file", type=str, help="History JSON file instead of --history ('-' reads stdin)")
+    parser.add_argument("--history_tokens", type=int, default=HISTORY_TOKENS, help="Token budget of the history sent to the model; older turns are folded into a cached summary (0 keeps everything)")
     parser.add_argument("--temperature", type=float, help="The temperature to use when sampling from the model.")
     parser.add_argument("--max_tokens", type=int, help="The maximum number of tokens to generate.")
     parser.add_argument("--user_role", type=str, default="Global", choices=["Global", "China", "Korea"], help="According to user role to select Corpus")
@@ -433,23 +975,207 @@ def main():
     parser.add_argument("--sum_mode_company", type=str, default="", help="The company name to summarize")
     parser.add_argument("--sum_mode_year", type=str, default="", help="The year to summarize")
     parser.add_argument("--sum_mode_quarter", type=str, default="Q1", help="The quarter to summarize")
+    parser.add_argument("--router_threshold", type=float, default=0.75, help="Confidence needed to route a prompt locally instead of asking the LLM (above 1 always asks the LLM)")
+    parser.add_argument("--chart_format", type=str, default="json", choices=["json", "png"], help="Line charts as JSON data for the frontend, or as a rendered PNG path")
+    parser.add_argument("--rag_backend", type=str, default="vertex", choices=["vertex", "local"], help="Retrieve transcript passages from the Vertex RAG corpora or the local vector index")
+    parser.add_argument("--rag_index", type=str, default="flat", choices=["flat", "ivf"], help="Local vector index: exact brute force or IVF")
+    parser.add_argument("--no_answer_cache", action="store_true", help="Always retrieve and generate instead of reusing cached RAG answers")
+    parser.add_argument("--stream", action="store_true", help="Write NDJSON events (route, delta, chart, done) as the answer is generated")
+    parser.add_argument("--serve", type=str, choices=["stdio", "unix"], help="Run as a long-lived worker reading JSON line requests")
+    parser.add_argument("--socket", type=str, default="/tmp/marketagent-chat.sock", help="Unix socket path used by --serve unix")
+    return parser
+
+
+def build_history(args, turns):
+    """
+    將對話紀錄 (JSON list) 轉成 Content list，不包含這次的問題。
+    超過 --history_tokens 時較舊的對話以快取中的滾動摘要取代 (需要時才產生新的摘要)，
+    回傳 (contents, key)，key 用於答案快取。
+    """
+    window = HistoryWindow(summarize_history(args.model_name), get_summary_store(), args.history_tokens)
+    summary, recent, info = window.fit(turns)
+    if summary is not None:
+        print(
+            f"[history] {info['turns']} turns ({info['tokens']} tokens): {info['folded']} in summary ({info['summary_tokens']} tokens), "
+            f"{len(recent)} kept ({info['kept_tokens']} tokens), {info['summarized_turns']} newly summarized",
+            file=sys.stderr,
+        )
+
+    content_list = []
+    for item in recent:
+        # Create Part object from the text in parts (圖片等非文字的 part 不送給模型)
+        parts = [Part.from_text(part['text']) for part in item.get('parts', []) if part.get('text')]
+        if parts:
+            # Create Content object with role and parts
+            content_list.append(Content(role=item.get('role', 'user'), parts=parts))
+    if summary is not None:
+        summary_part = Part.from_text(f"Summary of the earlier conversation:\n{summary}")
+        # 維持 user / model 交替，第一則是使用者的訊息時把摘要放在同一則
+        if content_list and content_list[0].role == "user":
+            content_list[0] = Content(role="user", parts=[summary_part] + list(content_list[0].parts))
+        else:
+            content_list.insert(0, Content(role="user", parts=[summary_part]))
+    key = cache_key(summary, prefix_digests(recent)[-1] if recent else None)
+    return content_list, key
+
+
+def request_to_argv(request):
+    """
+    將一筆 JSON request 轉成與命令列相同的參數列表。
+    request 可以是 {"argv": [...]}，或是 {"args": {"prompt": ..., "user_role": ...}}；
+    對話紀錄可以放在另外的 "history" 欄位 (見 request_history)
+    """
+    if "argv" in request:
+        return [str(item) for item in request["argv"]]
+    argv = []
+    for key, value in request.get("args", {}).items():
+        if value is None:
+            continue
+        argv += [f"--{key}", value if isinstance(value, str) else json.dumps(value, ensure_ascii=False)]
+    return argv
+
+
+class EventForwarder(io.TextIOBase):
+    """
+    --stream 的 request 在常駐模式下使用的 stdout：每寫完一行 (一個 NDJSON 事件) 就以
+    {"id": request_id, "event": {...}} 交給 emit 立即送出，不是事件的輸出收集到 output。
+    """
+
+    def __init__(self, request_id, emit, output):
+        self.request_id = request_id
+        self.emit = emit
+        self.output = output
+        self._pending = ""
+
+    def writable(self):
+        return True
+
+    def write(self, text):
+        self._pending += text
+        while "\n" in self._pending:
+            line, self._pending = self._pending.split("\n", 1)
+            self._forward(line)
+        return len(text)
+
+    def _forward(self, line):
+        try:
+            event = json.loads(line)
+        except ValueError:
+            event = None
+        if isinstance(event, dict) and "type" in event:
+            self.emit({"id": self.request_id, "event": event})
+        else:
+            self.output.write(line + "\n")
+
+    def close_pending(self):
+        if self._pending:
+            self._forward(self._pending)
+            self._pending = ""
+
+
+def request_history(request, args):
+    """常駐模式的對話紀錄：request 的 "history" 欄位 (不受命令列長度限制)，或 --history / --history_file"""
+    if "history" in request:
+        return request["history"] or []
+    if args.history_file == "-":
+        raise ValueError("--history_file - is not available in serve mode, send the history in the request")
+    return read_history(args.history, args.history_file)
+
+
+def handle_request(line, parser, emit=None):
+    """
+    處理常駐模式下的一筆 request，回傳包含輸出與延遲的 dict。
+    main_worker 原本 print 到 stdout 的內容會被收集到 output 欄位；
+    request 帶有 --stream 且有 emit 時，事件在產生時就逐一交給 emit，最後的回覆仍是同一個 dict。
+    """
+    start = time.perf_counter()
+    request_id = None
+    stages = None
+    output = io.StringIO()
+    ok = True
+    try:
+        request = json.loads(line)
+        request_id = request.get("id")
+        args = parser.parse_args(request_to_argv(request))
+        stdout = EventForwarder(request_id, emit, output) if args.stream and emit is not None else output
+        try:
+            with contextlib.redirect_stdout(stdout):
+                stages = main_worker(args, request_history(request, args))
+        finally:
+            if stdout is not output:
+                stdout.close_pending()
+    except (Exception, SystemExit) as e:
+        ok = False
+        output.write(f"Invalid request: {e}")
+    latency_ms = (time.perf_counter() - start) * 1000
+    print(f"[chat] request {request_id} finished in {latency_ms:.1f} ms", file=sys.stderr)
+    return {
+        "id": request_id,
+        "ok": ok,
+        "output": output.getvalue(),
+        "latency_ms": round(latency_ms, 1),
+        "stages": stages,
+        "cache": default_cache().stats(),
+        "router": {"main": MAIN_ROUTER.stats(), "csv_tool": CSV_TOOL_ROUTER.stats()},
+        "answer_cache": get_answer_cache().stats(),
+    }
+
+
+class ChatRequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            reply = handle_request(line.decode("utf-8"), self.server.parser, self.send)
+            self.send(reply)
+
+    def send(self, message):
+        self.wfile.write((json.dumps(message, ensure_ascii=False) + "\n").encode("utf-8"))
+        self.wfile.flush()
+
+
+def serve(mode, socket_path, parser):
+    """
+    常駐模式：模型、tool declarations 與資料集只在第一次使用時建立，之後的 request 直接沿用。
+    每行一筆 JSON request，回覆也是一行 JSON；--stream 的 request 在回覆之前會先送出
+    {"id": ..., "event": {...}} 的事件行。
+    """
+    if mode == "stdio":
+        # main_worker 執行時 sys.stdout 會被重導，事件與回覆寫到原本的 stdout
+        stdout = sys.stdout
+
+        def send(message):
+            stdout.write(json.dumps(message, ensure_ascii=False) + "\n")
+            stdout.flush()
+
+        for line in sys.stdin:
+            if not line.strip():
+                continue
+            send(handle_request(line, parser, send))
+        return
+
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+    # main_worker 會重導 stdout，因此 request 依序處理，不使用 threading server
+    with socketserver.UnixStreamServer(socket_path, ChatRequestHandler) as server:
+        server.parser = parser
+        print(f"[chat] serving on {socket_path}", file=sys.stderr)
+        server.serve_forever()
+
+
+def main():
+    parser = build_arg_parser()
     args = parser.parse_args()
+    if args.serve:
+        serve(args.serve, args.socket, parser)
+        return
     
-    history_dict = json.loads(args.history) if args.history else []
-    
-    content_list = []
-    for item in history_dict:
-        # Create Part object from the text in parts
-        parts = [Part.from_text(part['text']) for part in item.get('parts', [])]
-        # Create Content object with role and parts
-        content = Content(role=item.get('role', 'user'), parts=parts)
-        content_list.append(content)
-    content_list.append(Content(role='user', parts=[Part.from_text(args.prompt)]))
+    history = read_history(args.history, args.history_file)
     # chat = model.start_chat(history=content_list)
     # response = chat.send_message(args.prompt)
     # print(response.candidates[0].content.parts[0].text)
     
-    main_worker(args, content_list)
+    main_worker(args, history)
 
 if __name__ == "__main__":
-    main()
+    main()
\ No newline at end of file
@@ -0,0 +1,232 @@
+import os
+import re
+import sys
+import json
+import time
+import sqlite3
+import hashlib
+import argparse
+import threading
+
+from fin_store import STORE_DIR
+
+HISTORY_SUMMARY_PATH = os.environ.get("MARKETAGENT_HISTORY_SUMMARY_PATH", os.path.join(STORE_DIR, "history_summaries.sqlite"))
+# 對話紀錄 (不含摘要) 的 token 上限；超過時較舊的對話併入摘要，只保留最近約 HISTORY_KEEP_RATIO 的量，
+# 之後幾輪對話不需要再產生摘要
+HISTORY_TOKENS = int(os.environ.get("MARKETAGENT_HISTORY_TOKENS", 2000))
+HISTORY_KEEP_RATIO = float(os.environ.get("MARKETAGENT_HISTORY_KEEP_RATIO", 0.5))
+HISTORY_MAX_SUMMARIES = int(os.environ.get("MARKETAGENT_HISTORY_MAX_SUMMARIES", 20000))
+
+# 中日韓文字大約一個字一個 token，其他文字約 4 字元一個 token
+CJK_PATTERN = re.compile(r"[\u3000-\u30ff\u3400-\u9fff\uac00-\ud7af\uff00-\uffef]")
+
+
+def estimate_tokens(text):
+    cjk = len(CJK_PATTERN.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def turn_text(turn):
+    """一則對話 ({"role", "parts": [{"text"}, ...]}) 的文字，忽略圖片等非文字的 part"""
+    return "\n".join(part["text"] for part in turn.get("parts", []) if part.get("text"))
+
+
+def prefix_digests(turns):
+    """每個前綴 turns[:i + 1] 的 hash (逐則串接計算)，用來辨識同一段對話已經摘要過的部分"""
+    digests, digest = [], ""
+    for turn in turns:
+        digest = hashlib.sha256((digest + json.dumps([turn.get("role", "user"), turn_text(turn)], ensure_ascii=False)).encode("utf-8")).hexdigest()
+        digests.append(digest)
+    return digests
+
+
+def read_history(history=None, history_file=None):
+    """
+    讀取對話紀錄 (JSON list)。history_file 為 "-" 時從 stdin 讀取，
+    避免整段對話放在命令列參數中受到長度限制；都沒有時回傳空 list。
+    """
+    if history_file == "-":
+        text = sys.stdin.read()
+    elif history_file:
+        with open(history_file, encoding="utf-8") as f:
+            text = f.read()
+    else:
+        text = history
+    return json.loads(text) if text and text.strip() else []
+
+
+class SummaryStore:
+    """
+    對話摘要的持久化快取 (SQLite)。key 是被摘要的對話前綴的 hash，
+    同一段對話之後的每一輪都能找到並沿用之前的摘要，不需要 chat id；修改或重新產生較早的訊息時 hash 不同，會重新摘要。
+    超過 max_entries 時刪除最久未使用的摘要。
+
+    :param path: SQLite 檔案路徑
+    :param max_entries: 最多保留的摘要數
+    """
+
+    def __init__(self, path=HISTORY_SUMMARY_PATH, max_entries=HISTORY_MAX_SUMMARIES):
+        self.path = path
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS summaries (
+                    digest TEXT PRIMARY KEY,
+                    folded INTEGER NOT NULL,
+                    summary TEXT NOT NULL,
+                    created_at REAL NOT NULL,
+                    last_used REAL NOT NULL
+                )
+                """
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS summaries_last_used ON summaries (last_used)")
+        self.hits = 0
+        self.misses = 0
+
+    def latest(self, digests):
+        """在 digests (依前綴長度排列) 中找出最長的已摘要前綴，回傳 (folded, summary)，沒有時回傳 (0, None)"""
+        if not digests:
+            return 0, None
+        with self._lock, self._conn:
+            row = None
+            # SQLite 的參數數量有上限，分批查詢
+            for start in range(0, len(digests), 500):
+                batch = digests[start:start + 500]
+                found = self._conn.execute(
+                    f"SELECT digest, folded, summary FROM summaries WHERE digest IN ({','.join('?' * len(batch))}) ORDER BY folded DESC LIMIT 1",
+                    batch,
+                ).fetchone()
+                if found is not None and (row is None or found[1] > row[1]):
+                    row = found
+            if row is None:
+                self.misses += 1
+                return 0, None
+            self._conn.execute("UPDATE summaries SET last_used = ? WHERE digest = ?", (time.time(), row[0]))
+            self.hits += 1
+        return row[1], row[2]
+
+    def put(self, digest, folded, summary):
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO summaries (digest, folded, summary, created_at, last_used) VALUES (?, ?, ?, ?, ?)",
+                (digest, folded, summary, now, now),
+            )
+            count = self._conn.execute("SELECT COUNT(*) FROM summaries").fetchone()[0]
+            if count > self.max_entries:
+                self._conn.execute(
+                    "DELETE FROM summaries WHERE rowid IN (SELECT rowid FROM summaries ORDER BY last_used LIMIT ?)",
+                    (count - self.max_entries,),
+                )
+
+    def clear(self):
+        with self._lock, self._conn:
+            return self._conn.execute("DELETE FROM summaries").rowcount
+
+    def stats(self):
+        with self._lock:
+            entries = self._conn.execute("SELECT COUNT(*) FROM summaries").fetchone()[0]
+        lookups = self.hits + self.misses
+        return {"entries": entries, "hits": self.hits, "misses": self.misses, "hit_rate": round(self.hits / lookups, 4) if lookups else None}
+
+
+class HistoryWindow:
+    """
+    將對話紀錄限制在 token 預算內：最近的對話原樣保留，較舊的對話併入滾動摘要。
+    摘要只在保留的對話超過預算時才更新，而且只讀取上一次的摘要與新併入的對話，
+    因此每一輪送給模型的大小與產生摘要的成本不會隨對話變長而增加。
+
+    :param summarize: summarize(previous_summary, turns) -> 新的摘要，previous_summary 可能為 None
+    :param store: SummaryStore
+    :param max_tokens: 保留的對話的 token 上限
+    :param keep_ratio: 更新摘要後保留的對話佔 max_tokens 的比例
+    """
+
+    def __init__(self, summarize, store, max_tokens=HISTORY_TOKENS, keep_ratio=HISTORY_KEEP_RATIO):
+        self.summarize = summarize
+        self.store = store
+        self.max_tokens = max_tokens
+        self.keep_ratio = keep_ratio
+
+    def fit(self, turns):
+        """回傳 (summary, recent_turns, info)，summary 為 None 表示整段對話都在預算內"""
+        tokens = [estimate_tokens(turn_text(turn)) for turn in turns]
+        info = {"turns": len(turns), "tokens": sum(tokens), "folded": 0, "summarized_turns": 0}
+        if not self.max_tokens or sum(tokens) <= self.max_tokens:
+            info["kept_tokens"] = sum(tokens)
+            return None, turns, info
+
+        digests = prefix_digests(turns)
+        folded, summary = self.store.latest(digests)
+        if sum(tokens[folded:]) > self.max_tokens:
+            # 併入較舊的對話直到剩下的對話不超過 keep_ratio；每次摘要最多讀取 max_tokens 的新對話
+            keep = self.max_tokens * self.keep_ratio
+            target, remaining = folded, sum(tokens[folded:])
+            while target < len(turns) and remaining > keep:
+                remaining -= tokens[target]
+                target += 1
+            while folded < target:
+                end, batch_tokens = folded, 0
+                while end < target and (end == folded or batch_tokens + tokens[end] <= self.max_tokens):
+                    batch_tokens += tokens[end]
+                    end += 1
+                try:
+                    summary = self.summarize(summary, turns[folded:end])
+                except Exception as e:
+                    # 無法產生摘要時直接捨棄較舊的對話，仍維持在預算內
+                    print(f"[history] failed to summarize turns {folded}-{end}: {e}", file=sys.stderr)
+                    folded = target
+                    break
+                info["summarized_turns"] += end - folded
+                folded = end
+                self.store.put(digests[folded - 1], folded, summary)
+        info.update(folded=folded, kept_tokens=sum(tokens[folded:]), summary_tokens=estimate_tokens(summary) if summary else 0)
+        return summary, turns[folded:], info
+
+
+# 每個 process 各自開啟連線 (chat_pool 的 worker 由 fork 產生，不能共用父 process 的連線)
+_STORE = {}
+
+
+def get_summary_store():
+    pid = os.getpid()
+    if pid not in _STORE:
+        _STORE.clear()
+        _STORE[pid] = SummaryStore()
+    return _STORE[pid]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Show how a conversation is windowed, or inspect the summary cache.")
+    parser.add_argument("command", choices=["window", "stats", "clear"], help="window: kept turns and cached summary for a history file; stats / clear: the summary cache")
+    parser.add_argument("--history_file", type=str, default="-", help="History JSON file ('-' reads stdin)")
+    parser.add_argument("--path", type=str, default=HISTORY_SUMMARY_PATH, help="SQLite file of the summary cache")
+    parser.add_argument("--max_tokens", type=int, default=HISTORY_TOKENS, help="Token budget of the kept turns")
+    args = parser.parse_args()
+
+    store = SummaryStore(args.path)
+    if args.command == "stats":
+        print(json.dumps(store.stats(), ensure_ascii=False))
+    elif args.command == "clear":
+        print(f"[history] deleted {store.clear()} summaries", file=sys.stderr)
+    else:
+        turns = read_history(history_file=args.history_file)
+        tokens = [estimate_tokens(turn_text(turn)) for turn in turns]
+        folded, summary = store.latest(prefix_digests(turns))
+        print(json.dumps({
+            "turns": len(turns),
+            "tokens": sum(tokens),
+            "cached_folded": folded,
+            "cached_summary": summary,
+            "kept_tokens": sum(tokens[folded:]),
+            "over_budget": sum(tokens[folded:]) > args.max_tokens,
+        }, indent=2, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
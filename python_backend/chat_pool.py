@@ -0,0 +1,371 @@
+import os
+import gc
+import sys
+import json
+import time
+import signal
+import socket
+import argparse
+import selectors
+import threading
+import collections
+
+import chat
+from fin_cube import load_cube
+
+
+def read_rss_mb(pid):
+    """讀取 /proc/<pid>/status 的 VmRSS (MB)，非 Linux 環境回傳 None"""
+    try:
+        with open(f"/proc/{pid}/status", encoding="utf-8") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        return None
+    return None
+
+
+def preload_datasets():
+    """
+    在 fork 之前載入所有 user_role 的財報資料、FinIndex 與 metrics cube，讓 worker 以 copy-on-write 共用。
+    (資料版本改變時 worker 仍會各自重新載入)
+    """
+    for user_role in chat.CORPUS_DICT:
+        try:
+            chat.load_dataset(user_role)
+            load_cube(*chat.dataset_location(user_role))
+        except Exception as e:
+            print(f"[pool] 預先載入 {user_role} 資料失敗: {e}", file=sys.stderr)
+
+
+class Worker:
+    """
+    一個 fork 出來的 chat worker，透過 socketpair 一行一筆 JSON 溝通。
+    supervisor 端的 socket 為 non-blocking，由 WorkerPool 的 selector 讀取。
+    """
+
+    def __init__(self, slot):
+        self.slot = slot
+        self.pid = None
+        self.conn = None
+        self.buffer = b""
+        self.client = None
+        self.status = None
+        self.requests = 0
+        self.restarts = -1
+
+    @property
+    def busy(self):
+        return self.client is not None
+
+    def start(self, parser, inherited=()):
+        """fork 出 worker；inherited 為子行程不需要的 socket 與 selector (前端連線、listener、其他 worker)，在子行程中關閉"""
+        parent_sock, child_sock = socket.socketpair()
+        pid = os.fork()
+        if pid == 0:
+            parent_sock.close()
+            for sock in inherited:
+                sock.close()
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            code = 0
+            try:
+                rfile = child_sock.makefile("rb")
+
+                def send(message):
+                    child_sock.sendall((json.dumps(message, ensure_ascii=False) + "\n").encode("utf-8"))
+
+                for line in rfile:
+                    send(chat.handle_request(line.decode("utf-8"), parser, send))
+            except Exception as e:
+                print(f"[pool] worker {os.getpid()} 異常結束: {e}", file=sys.stderr)
+                code = 1
+            finally:
+                os._exit(code)
+
+        child_sock.close()
+        parent_sock.setblocking(False)
+        self.pid = pid
+        self.conn = parent_sock
+        self.buffer = b""
+        self.client = None
+        self.status = None
+        self.requests = 0
+        self.restarts += 1
+
+    def alive(self):
+        """子行程是否仍在執行；已結束時記錄 exit status (回收後 pid 可能被其他 process 使用，之後不再對它送 signal)"""
+        if self.status is None:
+            try:
+                pid, status = os.waitpid(self.pid, os.WNOHANG)
+            except ChildProcessError:
+                self.status = -1
+            else:
+                if pid:
+                    self.status = status
+        return self.status is None
+
+    def stop(self):
+        if self.alive():
+            try:
+                os.kill(self.pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+            try:
+                _, self.status = os.waitpid(self.pid, 0)
+            except ChildProcessError:
+                self.status = -1
+        self.conn.close()
+
+    def send(self, line):
+        """送出一筆 request (worker 一次只處理一筆，request 只有一行，直接以 blocking 的方式寫完)"""
+        self.conn.setblocking(True)
+        try:
+            self.conn.sendall(line.rstrip("\n").encode("utf-8") + b"\n")
+        finally:
+            self.conn.setblocking(False)
+
+    def read_lines(self):
+        """讀取目前收到的資料並回傳完整的行，worker 結束 (EOF) 時回傳 None"""
+        try:
+            data = self.conn.recv(1 << 16)
+        except BlockingIOError:
+            return []
+        except OSError:
+            return None
+        if not data:
+            return None
+        *lines, self.buffer = (self.buffer + data).split(b"\n")
+        return [line.decode("utf-8") for line in lines if line.strip()]
+
+
+class Client:
+    """前端的一條連線。同一條連線的 request 依序處理，一次只有一筆交給 worker"""
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.buffer = b""
+        self.active = False
+        self.closed = False
+
+    def send(self, line):
+        if self.closed:
+            return
+        try:
+            self.sock.sendall((line + "\n").encode("utf-8"))
+        except OSError:
+            self.closed = True
+
+    def read_lines(self):
+        try:
+            data = self.sock.recv(1 << 16)
+        except OSError:
+            data = b""
+        if not data:
+            return None
+        *lines, self.buffer = (self.buffer + data).split(b"\n")
+        return [line.decode("utf-8") for line in lines if line.strip()]
+
+
+class WorkerPool:
+    """
+    Pre-fork supervisor：父行程載入資料後 fork 出 N 個 worker，request 交給任一閒置 worker 處理；
+    worker 結束或 RSS 超過上限時重新 fork。
+    supervisor 是單一 thread 的 selector 迴圈 (接受連線、轉送 request 與回覆、重新 fork)，
+    fork 時沒有其他 thread 持有鎖；前端連線與 listener 等 socket 在 worker 中立即關閉。
+    """
+
+    def __init__(self, parser, num_workers, max_rss_mb):
+        self.parser = parser
+        self.max_rss_mb = max_rss_mb
+        self.selector = selectors.DefaultSelector()
+        self.listener = None
+        self.clients = set()
+        self.workers = [Worker(slot) for slot in range(num_workers)]
+        self.idle = collections.deque()
+        self.pending = collections.deque()
+        self.served = 0
+        for worker in self.workers:
+            self._spawn(worker)
+
+    def _inherited(self, worker):
+        sockets = [client.sock for client in self.clients]
+        sockets += [other.conn for other in self.workers if other is not worker and other.conn is not None and other.conn.fileno() != -1]
+        if self.listener is not None:
+            sockets.append(self.listener)
+        return sockets + [self.selector]
+
+    def _spawn(self, worker):
+        if threading.active_count() > 1:
+            print(f"[pool] fork 時有 {threading.active_count()} 個 thread", file=sys.stderr)
+        # 凍結目前的 GC 物件，避免 worker 中的 GC 掃描把共用頁面寫髒
+        gc.freeze()
+        worker.start(self.parser, self._inherited(worker))
+        self.selector.register(worker.conn, selectors.EVENT_READ, worker)
+        self.idle.append(worker)
+
+    def _respawn(self, worker, reason):
+        print(f"[pool] 重新啟動 worker {worker.pid}: {reason}", file=sys.stderr)
+        if worker in self.idle:
+            self.idle.remove(worker)
+        client, worker.client = worker.client, None
+        if client is not None:
+            client.active = False
+            client.send(json.dumps({"id": None, "ok": False, "output": str(reason), "latency_ms": None}))
+        self.selector.unregister(worker.conn)
+        worker.stop()
+        self._spawn(worker)
+
+    def _accept(self):
+        sock, _ = self.listener.accept()
+        # 只在可讀時 recv，回覆以 blocking 的 sendall 寫出
+        sock.setblocking(True)
+        client = Client(sock)
+        self.clients.add(client)
+        self.selector.register(sock, selectors.EVENT_READ, client)
+
+    def _close_client(self, client):
+        # 處理中的 request 仍會完成，回覆直接丟棄
+        client.closed = True
+        self.clients.discard(client)
+        self.selector.unregister(client.sock)
+        client.sock.close()
+
+    def _read_client(self, client):
+        lines = client.read_lines()
+        if lines is None:
+            self._close_client(client)
+            return
+        for line in lines:
+            try:
+                request = json.loads(line)
+            except ValueError as e:
+                client.send(json.dumps({"id": None, "ok": False, "output": f"Invalid request: {e}", "latency_ms": None}))
+                continue
+            if isinstance(request, dict) and request.get("cmd") == "stats":
+                client.send(json.dumps(self.stats(), ensure_ascii=False))
+            else:
+                self.pending.append((client, line))
+
+    def _read_worker(self, worker):
+        lines = worker.read_lines()
+        if lines is None:
+            self._respawn(worker, f"worker {worker.pid} 結束")
+            return
+        for line in lines:
+            try:
+                reply = json.loads(line)
+            except ValueError as e:
+                # worker 回覆的不是 JSON，之後的回覆也無法對應，重新啟動
+                self._respawn(worker, e)
+                return
+            client = worker.client
+            if client is None:
+                continue
+            client.send(line)
+            if "event" in reply:
+                continue
+            # 最後的回覆：這筆 request 完成
+            worker.client = None
+            client.active = False
+            worker.requests += 1
+            self.served += 1
+            rss = read_rss_mb(worker.pid)
+            if self.max_rss_mb and rss and rss > self.max_rss_mb:
+                self._respawn(worker, f"RSS {rss:.0f} MB 超過 {self.max_rss_mb} MB")
+                return
+            self.idle.append(worker)
+
+    def _dispatch(self):
+        """依到達順序把 request 交給閒置的 worker，同一條連線上一筆完成前的 request 繼續等待"""
+        waiting = collections.deque()
+        while self.pending and self.idle:
+            client, line = self.pending.popleft()
+            if client.closed:
+                continue
+            if client.active:
+                waiting.append((client, line))
+                continue
+            worker = self.idle.popleft()
+            worker.client = client
+            client.active = True
+            try:
+                worker.send(line)
+            except OSError as e:
+                self._respawn(worker, e)
+        waiting.extend(self.pending)
+        self.pending = waiting
+
+    def serve(self, listener):
+        """在目前的 thread 執行 selector 迴圈，直到 KeyboardInterrupt"""
+        self.listener = listener
+        listener.setblocking(False)
+        self.selector.register(listener, selectors.EVENT_READ, None)
+        while True:
+            for key, _ in self.selector.select():
+                if key.data is None:
+                    self._accept()
+                elif isinstance(key.data, Client):
+                    if not key.data.closed:
+                        self._read_client(key.data)
+                elif key.fileobj is key.data.conn:
+                    self._read_worker(key.data)
+            self._dispatch()
+
+    def stats(self):
+        return {
+            "queue_depth": len(self.pending),
+            "served": self.served,
+            "cores": os.cpu_count(),
+            "supervisor_rss_mb": read_rss_mb(os.getpid()),
+            "workers": [
+                {
+                    "slot": worker.slot,
+                    "pid": worker.pid,
+                    "busy": worker.busy,
+                    "requests": worker.requests,
+                    "restarts": worker.restarts,
+                    "rss_mb": read_rss_mb(worker.pid),
+                }
+                for worker in self.workers
+            ],
+        }
+
+    def shutdown(self):
+        for client in list(self.clients):
+            self._close_client(client)
+        for worker in self.workers:
+            worker.stop()
+        self.selector.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Pre-forked pool of chat.py workers.")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="Number of worker processes to fork.")
+    parser.add_argument("--socket", type=str, default="/tmp/marketagent-chat.sock", help="Unix socket path to listen on.")
+    parser.add_argument("--max_rss_mb", type=float, default=0, help="Restart a worker after a request leaves its RSS above this many MB (0 disables).")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    preload_datasets()
+    print(f"[pool] 資料載入完成，耗時 {time.perf_counter() - start:.2f} s", file=sys.stderr)
+
+    pool = WorkerPool(chat.build_arg_parser(), args.workers, args.max_rss_mb)
+    if os.path.exists(args.socket):
+        os.remove(args.socket)
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(args.socket)
+    listener.listen(128)
+    print(f"[pool] {args.workers} 個 worker 在 {args.socket} 上服務", file=sys.stderr)
+    try:
+        pool.serve(listener)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        pool.shutdown()
+        listener.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,313 @@
+import os
+import sys
+import json
+import time
+import argparse
+
+import numpy as np
+import pandas as pd
+
+from fin_store import DATASETS, STORE_DIR, frame_version, load_frame, parse_period, period_label, store_name
+
+# 由基本指標計算的衍生指標: name -> (需要的基本指標, 以 {指標: 數值陣列} 計算的函式)
+DERIVED_METRICS = {
+    "Gross Profit": (["Revenue", "Cost of Goods Sold"], lambda v: v["Revenue"] - v["Cost of Goods Sold"]),
+    "Gross profit margin": (["Revenue", "Cost of Goods Sold"], lambda v: (v["Revenue"] - v["Cost of Goods Sold"]) / v["Revenue"]),
+    "Operating margin": (["Revenue", "Operating Income"], lambda v: v["Operating Income"] / v["Revenue"]),
+    "Approx Net Income": (["Operating Income", "Tax Expense"], lambda v: v["Operating Income"] - v["Tax Expense"]),
+    "Net margin": (["Revenue", "Operating Income", "Tax Expense"], lambda v: (v["Operating Income"] - v["Tax Expense"]) / v["Revenue"]),
+}
+# 比率 (非金額) 的衍生指標
+RATIO_METRICS = {"Gross profit margin", "Operating margin", "Net margin"}
+
+# cube 的第一維: 數值本身、季增率、年增率
+KINDS = ["value", "qoq", "yoy"]
+LAGS = {"qoq": 1, "yoy": 4}
+
+# 已載入的 MetricCube: (bucket_name, blob_name) -> (df, MetricCube)
+_CUBES = {}
+
+
+class MetricCube:
+    """
+    所有公司、季度與指標的 float32 陣列，形狀為 (kind, company, period, metric)。
+    period 軸是連續的 period key (缺季以 NaN 表示)，因此季增率與年增率只需要錯位相除，
+    單點、區間與跨公司查詢都是陣列索引，不需要 groupby 或 pivot。
+
+    :param companies: 公司軸的名稱
+    :param metrics: 指標軸的名稱 (基本指標在前，衍生指標在後)
+    :param start: period 軸第一格的 period key
+    :param data: float32 陣列，形狀為 (len(KINDS), len(companies), 季數, len(metrics))
+    :param version: 建立 cube 的資料版本 (bucket 物件的 generation)
+    """
+
+    def __init__(self, companies, metrics, start, data, version=None):
+        self.version = version
+        self._set_axes(companies, metrics, start, data)
+
+    def _set_axes(self, companies, metrics, start, data):
+        """設定軸與對應的陣列 (建立時與 _grow 換成較大的陣列時)，並重建名稱到位置的對照"""
+        self.companies = list(companies)
+        self.metrics = list(metrics)
+        self.start = int(start)
+        self.data = data
+        self.company_pos = {company: i for i, company in enumerate(self.companies)}
+        self.metric_pos = {metric: i for i, metric in enumerate(self.metrics)}
+
+    @property
+    def end(self):
+        return self.start + self.data.shape[2] - 1
+
+    @property
+    def base_metrics(self):
+        return [metric for metric in self.metrics if metric not in DERIVED_METRICS]
+
+    @classmethod
+    def build(cls, df, value_column="USD_Value", version=None):
+        """由 store 格式的 DataFrame 建立 cube"""
+        periods = df["PERIOD"]
+        cube = cls([], [], int(periods.min()) if len(df) else 0, np.full((len(KINDS), 0, 0, 0), np.nan, dtype=np.float32), version)
+        cube.update(df, value_column)
+        return cube
+
+    def _grow(self, companies, metrics, periods):
+        """擴充公司、指標與季度軸，既有的資料複製到新陣列中對應的位置"""
+        new_companies = [company for company in dict.fromkeys(companies) if company not in self.company_pos]
+        base = self.base_metrics + [metric for metric in dict.fromkeys(metrics) if metric not in self.metric_pos]
+        derived = [metric for metric, (inputs, _) in DERIVED_METRICS.items() if set(inputs) <= set(base)]
+        metrics = base + derived
+        start = min(self.start, int(periods.min())) if self.data.shape[2] else int(periods.min())
+        end = max(self.end, int(periods.max())) if self.data.shape[2] else int(periods.max())
+        if not new_companies and metrics == self.metrics and start == self.start and end == self.end:
+            return
+        data = np.full((len(KINDS), len(self.companies) + len(new_companies), end - start + 1, len(metrics)), np.nan, dtype=np.float32)
+        if self.data.size:
+            offset = self.start - start
+            columns = [metrics.index(metric) for metric in self.metrics]
+            data[:, :len(self.companies), offset:offset + self.data.shape[2], columns] = self.data
+        self._set_axes(self.companies + new_companies, metrics, start, data)
+
+    def update(self, df, value_column="USD_Value", replace=True):
+        """
+        寫入新的資料列並重算受影響公司的衍生指標與成長率，回傳變動的格數。
+
+        :param df: store 格式的 DataFrame (Company Name / Index / PERIOD / value_column)
+        :param replace: True 表示 df 是完整的資料集，cube 中 df 沒有的格會清空；False 表示 df 只是新增或修改的列
+        """
+        if not len(df):
+            return 0
+        companies = df["Company Name"].astype(str).to_numpy()
+        metrics = df["Index"].astype(str).to_numpy()
+        periods = df["PERIOD"].to_numpy().astype(np.int64)
+        self._grow(companies, metrics, periods)
+        if not self.data.flags.writeable:
+            # 由 memory map 載入的 cube 是唯讀的
+            self.data = np.array(self.data)
+
+        company_index = pd.Index(self.companies).get_indexer(companies)
+        metric_index = pd.Index(self.metrics).get_indexer(metrics)
+        period_index = periods - self.start
+        values = df[value_column].to_numpy().astype(np.float32)
+        plane = self.data[0]
+        old = plane[company_index, period_index, metric_index]
+        changed = ~((old == values) | (np.isnan(old) & np.isnan(values)))
+        affected = set(company_index[changed].tolist())
+        plane[company_index[changed], period_index[changed], metric_index[changed]] = values[changed]
+        cells = int(changed.sum())
+
+        if replace:
+            # 資料集中已不存在的格視為刪除
+            present = np.zeros(plane.shape, dtype=bool)
+            present[company_index, period_index, metric_index] = True
+            base = [self.metric_pos[metric] for metric in self.base_metrics]
+            stale = ~present[:, :, base] & ~np.isnan(plane[:, :, base])
+            if stale.any():
+                stale_company, stale_period, stale_metric = np.nonzero(stale)
+                plane[stale_company, stale_period, np.asarray(base)[stale_metric]] = np.nan
+                affected.update(stale_company.tolist())
+                cells += len(stale_company)
+
+        if affected:
+            self._recompute(sorted(affected))
+        return cells
+
+    def _recompute(self, company_index):
+        """重算指定公司的衍生指標與季增率、年增率"""
+        values = self.data[0, company_index]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            inputs = {metric: values[:, :, self.metric_pos[metric]] for metric in self.base_metrics}
+            for metric, (_, formula) in DERIVED_METRICS.items():
+                if metric in self.metric_pos:
+                    values[:, :, self.metric_pos[metric]] = formula(inputs)
+            for kind, lag in LAGS.items():
+                growth = np.full(values.shape, np.nan, dtype=np.float32)
+                growth[:, lag:] = values[:, lag:] / values[:, :-lag] - 1
+                growth[~np.isfinite(growth)] = np.nan
+                self.data[KINDS.index(kind), company_index] = growth
+        values[~np.isfinite(values)] = np.nan
+        self.data[0, company_index] = values
+
+    def value(self, company, metric, period, kind="value"):
+        """單一公司、指標與季度的數值，沒有資料時回傳 NaN"""
+        company_index = self.company_pos.get(company)
+        metric_index = self.metric_pos.get(metric)
+        if company_index is None or metric_index is None or not self.start <= period <= self.end:
+            return float("nan")
+        return float(self.data[KINDS.index(kind), company_index, period - self.start, metric_index])
+
+    def _period_slice(self, start=None, end=None):
+        lo = 0 if start is None else max(start - self.start, 0)
+        hi = self.data.shape[2] if end is None else max(min(end - self.start + 1, self.data.shape[2]), 0)
+        return slice(lo, max(lo, hi))
+
+    def series(self, company, metric, start=None, end=None, kind="value"):
+        """與 FinIndex.lookup 相同，回傳 (periods, values)，沒有資料的季度不列出"""
+        window = self._period_slice(start, end)
+        if company not in self.company_pos or metric not in self.metric_pos:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        values = self.data[KINDS.index(kind), self.company_pos[company], window, self.metric_pos[metric]]
+        periods = np.arange(self.start + window.start, self.start + window.stop)
+        keep = ~np.isnan(values)
+        return periods[keep], values[keep]
+
+    def cross(self, metric, period, kind="value"):
+        """同一季所有公司的數值，回傳 (companies, values)，沒有資料的公司不列出"""
+        if metric not in self.metric_pos or not self.start <= period <= self.end:
+            return [], np.empty(0, dtype=np.float32)
+        values = self.data[KINDS.index(kind), :, period - self.start, self.metric_pos[metric]]
+        keep = ~np.isnan(values)
+        return [company for company, kept in zip(self.companies, keep) if kept], values[keep]
+
+    def wide(self, companies, metrics, start=None, end=None, kind="value"):
+        """
+        回傳 index 為 (company, period)、欄位為 metrics 的 float64 DataFrame，
+        公司在該季所有指標都沒有資料時不列出 (與 pivot_table 相同)。
+        """
+        window = self._period_slice(start, end)
+        company_index = [self.company_pos[company] for company in companies if company in self.company_pos]
+        metric_index = [self.metric_pos[metric] for metric in metrics]
+        block = self.data[KINDS.index(kind)][np.ix_(company_index, np.arange(window.start, window.stop), metric_index)]
+        present = ~np.isnan(self.data[0][np.ix_(company_index, np.arange(window.start, window.stop), metric_index)]).all(axis=2)
+        company_at, period_at = np.nonzero(present)
+        index = pd.MultiIndex.from_arrays(
+            [np.asarray([self.companies[i] for i in company_index], dtype=object)[company_at], self.start + window.start + period_at],
+            names=["company", "period"],
+        )
+        return pd.DataFrame(block[company_at, period_at].astype(np.float64), index=index, columns=list(metrics))
+
+
+def _paths(blob_name, store_dir):
+    name = store_name(blob_name)
+    return os.path.join(store_dir, f"{name}.cube.npy"), os.path.join(store_dir, f"{name}.cube.json")
+
+
+def write_cube(cube, blob_name, store_dir=None):
+    """將 cube 寫入 store，陣列為未壓縮的 .npy，軸的名稱與版本寫在 json"""
+    store_dir = store_dir or STORE_DIR
+    os.makedirs(store_dir, exist_ok=True)
+    data_path, meta_path = _paths(blob_name, store_dir)
+    tmp_path = f"{data_path}.{os.getpid()}.tmp.npy"
+    np.save(tmp_path, cube.data)
+    os.replace(tmp_path, data_path)
+    meta = {
+        "version": cube.version,
+        "companies": cube.companies,
+        "metrics": cube.metrics,
+        "start": cube.start,
+        "shape": list(cube.data.shape),
+        "bytes": cube.data.nbytes,
+        "built_at": time.time(),
+    }
+    tmp_path = f"{meta_path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(meta, f, indent=2, ensure_ascii=False)
+    os.replace(tmp_path, meta_path)
+    return meta
+
+
+def read_cube(blob_name, store_dir=None):
+    """以 memory map 讀取 store 中的 cube，不存在或損毀時回傳 None"""
+    data_path, meta_path = _paths(blob_name, store_dir or STORE_DIR)
+    try:
+        with open(meta_path, encoding="utf-8") as f:
+            meta = json.load(f)
+        data = np.load(data_path, mmap_mode="r")
+    except (FileNotFoundError, json.JSONDecodeError, ValueError):
+        return None
+    if list(data.shape) != meta["shape"]:
+        return None
+    return MetricCube(meta["companies"], meta["metrics"], meta["start"], data, meta["version"])
+
+
+def load_cube(bucket_name, blob_name, store_dir=None, revalidate=True):
+    """
+    取得資料集的 MetricCube。
+    store 中的 cube 與資料版本相同時直接讀取；版本不同時只寫入有變動的格並重算受影響的公司，
+    沒有 cube 時才完整建立。
+    """
+    key = (bucket_name, blob_name)
+    df = load_frame(bucket_name, blob_name, store_dir, revalidate)
+    cached = _CUBES.get(key)
+    if cached is not None and cached[0] is df:
+        return cached[1]
+
+    version = frame_version(bucket_name, blob_name)
+    start = time.perf_counter()
+    cube = cached[1] if cached is not None else read_cube(blob_name, store_dir)
+    if cube is None:
+        cube = MetricCube.build(df, version=version)
+        write_cube(cube, blob_name, store_dir)
+        print(f"[cube] {store_name(blob_name)} built in {(time.perf_counter() - start) * 1000:.0f} ms", file=sys.stderr)
+    elif cube.version != version:
+        cells = cube.update(df)
+        cube.version = version
+        write_cube(cube, blob_name, store_dir)
+        print(f"[cube] {store_name(blob_name)} updated {cells} cells in {(time.perf_counter() - start) * 1000:.0f} ms", file=sys.stderr)
+    _CUBES[key] = (df, cube)
+    return cube
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build, inspect or query the metrics cube.")
+    parser.add_argument("command", choices=["build", "info", "query"], help="build: (re)build the cube; info: show cube metadata; query: look up --company/--metric/--period")
+    parser.add_argument("--dataset", type=str, default="FIN_Data", choices=[name for name in DATASETS if "TRANSCRIPT" not in name], help="Dataset of the cube")
+    parser.add_argument("--store_dir", type=str, default=STORE_DIR, help="Directory of the store")
+    parser.add_argument("--company", type=str, default=None, help="Company name; omit to compare all companies")
+    parser.add_argument("--metric", type=str, default="Revenue", help="Metric name")
+    parser.add_argument("--period", type=str, default=None, help="Period 'YYYY_QX'; omit for the whole range of --company")
+    parser.add_argument("--kind", type=str, default="value", choices=KINDS, help="value, qoq or yoy growth")
+    args = parser.parse_args()
+
+    bucket_name, blob_name = DATASETS[args.dataset]
+    if args.command == "build":
+        _, meta_path = _paths(blob_name, args.store_dir)
+        if os.path.exists(meta_path):
+            os.remove(meta_path)
+    cube = load_cube(bucket_name, blob_name, args.store_dir)
+    if args.command in ("build", "info"):
+        print(json.dumps({
+            "version": cube.version,
+            "companies": len(cube.companies),
+            "periods": f"{period_label(cube.start)} to {period_label(cube.end)}",
+            "metrics": cube.metrics,
+            "bytes": cube.data.nbytes,
+        }, ensure_ascii=False))
+        return
+
+    period = parse_period(args.period) if args.period else None
+    start = time.perf_counter()
+    if args.company and period is not None:
+        result = {"value": round(cube.value(args.company, args.metric, period, args.kind), 6)}
+    elif args.company:
+        periods, values = cube.series(args.company, args.metric, kind=args.kind)
+        result = {period_label(key): round(float(value), 6) for key, value in zip(periods, values)}
+    else:
+        companies, values = cube.cross(args.metric, period if period is not None else cube.end, args.kind)
+        result = {company: round(float(value), 6) for company, value in zip(companies, values)}
+    elapsed_us = (time.perf_counter() - start) * 1e6
+    print(json.dumps(result, ensure_ascii=False))
+    print(f"[cube] {args.kind} query in {elapsed_us:.1f} us", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
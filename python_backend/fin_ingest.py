@@ -0,0 +1,102 @@
+import os
+import sys
+import json
+import time
+import argparse
+
+from bucket_cache import default_cache
+from fin_cube import load_cube
+from fin_store import DATASETS, STORE_DIR, frame_version, load_frame, load_index, period_label, read_meta
+from transcripts import TRANSCRIPT_BUCKET, TRANSCRIPT_PREFIX, load_catalog, write_catalog
+
+
+def _manifest_path(store_dir):
+    return os.path.join(store_dir, "transcripts.manifest.json")
+
+
+def read_manifest(store_dir=None):
+    """已匯入的逐字稿檔案: {blob_name: generation}"""
+    try:
+        with open(_manifest_path(store_dir or STORE_DIR), encoding="utf-8") as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+def sync_transcripts(bucket_name=TRANSCRIPT_BUCKET, prefix=TRANSCRIPT_PREFIX, store_dir=None, prefetch=True):
+    """
+    比對 bucket 中的逐字稿與上次匯入的清單，回傳 (新增或變動的檔案, 已刪除的檔案)。
+    只列出 metadata，prefetch 時才下載新增的檔案到 BlobCache；變動的檔案會從逐字稿目錄的文字快取中移除。
+    """
+    store_dir = store_dir or STORE_DIR
+    manifest = read_manifest(store_dir)
+    listing = default_cache().list(bucket_name, prefix)
+    changed = sorted(name for name, generation in listing.items() if manifest.get(name) != generation)
+    removed = sorted(set(manifest) - set(listing))
+    if prefetch:
+        for name in changed:
+            default_cache().fetch(bucket_name, name)
+    if manifest and (changed or removed):
+        catalog = load_catalog(store_dir)
+        if catalog.invalidate(changed + removed):
+            write_catalog(catalog, store_dir)
+    if changed or removed:
+        os.makedirs(store_dir, exist_ok=True)
+        tmp_path = f"{_manifest_path(store_dir)}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(listing, f, indent=2, ensure_ascii=False)
+        os.replace(tmp_path, _manifest_path(store_dir))
+    return changed, removed
+
+
+def ingest(datasets=None, store_dir=None, prefetch=True):
+    """
+    匯入 bucket 中新增的資料：附加的資料列只讀取新增的部分並更新 store、FinIndex 與 metrics cube，
+    新的逐字稿檔案記錄到清單中。資料版本 (generation) 隨之改變，依版本建立的快取會自動失效。
+    回傳每個資料集的變動摘要。
+    """
+    summary = {}
+    for name in datasets or DATASETS:
+        bucket_name, blob_name = DATASETS[name]
+        start = time.perf_counter()
+        before = (read_meta(blob_name, store_dir) or {}).get("generation")
+        try:
+            df = load_frame(bucket_name, blob_name, store_dir)
+            record = {"version": frame_version(bucket_name, blob_name), "changed": frame_version(bucket_name, blob_name) != before, "rows": len(df)}
+            if "Index" in df.columns:
+                fin_index = load_index(bucket_name, blob_name, store_dir)
+                load_cube(bucket_name, blob_name, store_dir)
+                record["range"] = f"{period_label(fin_index.min_period)} to {period_label(fin_index.max_period)}"
+        except Exception as e:
+            record = {"error": str(e)}
+        record["ms"] = round((time.perf_counter() - start) * 1000, 1)
+        summary[name] = record
+
+    start = time.perf_counter()
+    try:
+        changed, removed = sync_transcripts(store_dir=store_dir, prefetch=prefetch)
+        summary["transcripts"] = {"changed": changed, "removed": removed, "ms": round((time.perf_counter() - start) * 1000, 1)}
+    except Exception as e:
+        summary["transcripts"] = {"error": str(e)}
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Ingest new rows and transcript files from the buckets without a full rebuild.")
+    parser.add_argument("--dataset", type=str, nargs="*", choices=list(DATASETS), help="Datasets to ingest (default: all)")
+    parser.add_argument("--store_dir", type=str, default=STORE_DIR, help="Directory of the store")
+    parser.add_argument("--no_prefetch", action="store_true", help="Only record new transcript files instead of downloading them")
+    parser.add_argument("--watch", type=float, default=0, help="Poll the buckets every N seconds (0: run once)")
+    args = parser.parse_args()
+
+    while True:
+        summary = ingest(args.dataset, args.store_dir, not args.no_prefetch)
+        print(json.dumps(summary, ensure_ascii=False))
+        sys.stdout.flush()
+        if not args.watch:
+            return
+        time.sleep(args.watch)
+
+
+if __name__ == "__main__":
+    main()
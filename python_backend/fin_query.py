@@ -0,0 +1,342 @@
+import re
+import sys
+import json
+import time
+import argparse
+
+import numpy as np
+import pandas as pd
+
+from fin_cube import DERIVED_METRICS, RATIO_METRICS, load_cube
+from fin_store import DATASETS, load_index, parse_period, period_label
+from plot_slots import SlotExtractor
+
+AGGREGATIONS = ["value", "sum", "mean", "max", "min", "qoq", "yoy"]
+COMPARISONS = ["none", "rank"]
+
+# 給 LLM 的結構化輸出格式，無法以此格式表達的問題 expressible 回傳 false
+QUERY_SPEC_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {
+        "expressible": {"type": "BOOLEAN", "description": "False if the question cannot be answered by selecting, aggregating or ranking the listed metrics"},
+        "companies": {"type": "ARRAY", "items": {"type": "STRING"}, "description": "Company names; empty means all companies"},
+        "metrics": {"type": "ARRAY", "items": {"type": "STRING"}},
+        "start_time": {"type": "STRING", "description": "YYYY_QX"},
+        "end_time": {"type": "STRING", "description": "YYYY_QX"},
+        "aggregation": {"type": "STRING", "enum": AGGREGATIONS},
+        "comparison": {"type": "STRING", "enum": COMPARISONS},
+        "order": {"type": "STRING", "enum": ["desc", "asc"]},
+        "limit": {"type": "INTEGER", "description": "Number of ranked companies to return, 0 for all"},
+    },
+    "required": ["expressible", "companies", "metrics", "start_time", "end_time", "aggregation", "comparison"],
+}
+
+SUM_WORDS = re.compile(r"\btotal\b|\bsum\b|combined|cumulative|annual|full[- ]year|合計|總和|總計|加總|累計|全年", re.IGNORECASE)
+MEAN_WORDS = re.compile(r"average|\bmean\b|\bavg\b|平均", re.IGNORECASE)
+MAX_WORDS = re.compile(r"highest|largest|biggest|maximum|\bmax\b|\bpeak\b|\bmost\b|\bbest\b|最高|最大|最多|最好", re.IGNORECASE)
+MIN_WORDS = re.compile(r"lowest|smallest|minimum|\bmin\b|\bleast\b|\bworst\b|最低|最小|最少|最差", re.IGNORECASE)
+YOY_WORDS = re.compile(r"\byoy\b|year[- ]over[- ]year|年增|年成長|同比", re.IGNORECASE)
+QOQ_WORDS = re.compile(r"\bqoq\b|quarter[- ]over[- ]quarter|growth|\bgrow|change|季增|成長|增長|變化", re.IGNORECASE)
+RANK_WORDS = re.compile(r"which compan|\brank|\btop\s*\d+|\bcompare|哪家|哪間|哪個公司|哪一家|的公司|排名|前\s*\d+\s*名|比較", re.IGNORECASE)
+LIMIT_PATTERN = re.compile(r"\btop\s*(\d+)|前\s*(\d+)\s*名", re.IGNORECASE)
+# 需要解釋、推論或資料以外知識的問題，交給 agent
+OPEN_WORDS = re.compile(r"\bwhy\b|\bexplain|\bpredict|forecast|\bshould\b|為什麼|原因|解釋|預測|建議", re.IGNORECASE)
+
+
+def _mask(text, spans):
+    """把已解析的字元範圍換成空白，避免 'total asset' 中的 total 被當成加總"""
+    chars = list(text)
+    for start, end in spans:
+        chars[start:end] = " " * (end - start)
+    return "".join(chars)
+
+
+def parse_query(query, extractor, all_companies):
+    """
+    在本機把問題解析成 query spec，無法確定時回傳 None (交給 LLM 結構化輸出)。
+
+    :param extractor: SlotExtractor，負責公司、指標與時間
+    :param all_companies: 沒有指定公司但要排名時使用的公司清單
+    """
+    if OPEN_WORDS.search(query):
+        return None
+    claimed = []
+    parsed_query, missing = extractor.extract(query, claimed)
+    rest = _mask(query, claimed)
+    comparison = "rank" if RANK_WORDS.search(rest) else "none"
+    if "company" in missing and comparison == "rank":
+        parsed_query["company"] = ", ".join(all_companies)
+        missing.remove("company")
+    if missing:
+        return None
+
+    if YOY_WORDS.search(rest):
+        aggregation = "yoy"
+    elif QOQ_WORDS.search(rest):
+        aggregation = "qoq"
+    elif MEAN_WORDS.search(rest):
+        aggregation = "mean"
+    elif SUM_WORDS.search(rest):
+        aggregation = "sum"
+    elif MAX_WORDS.search(rest):
+        aggregation = "max"
+    elif MIN_WORDS.search(rest):
+        aggregation = "min"
+    else:
+        aggregation = "value"
+
+    limit = LIMIT_PATTERN.search(rest)
+    return {
+        "companies": [company.strip() for company in parsed_query["company"].split(",")],
+        "metrics": parsed_query["index"],
+        "start_time": parsed_query["start_time"],
+        "end_time": parsed_query["end_time"],
+        "aggregation": aggregation,
+        "comparison": comparison,
+        "order": "asc" if MIN_WORDS.search(rest) else "desc",
+        "limit": int(next(group for group in limit.groups() if group)) if limit else (1 if MAX_WORDS.search(rest) or MIN_WORDS.search(rest) else 0),
+    }
+
+
+def validate_spec(spec, fin_index):
+    """檢查 spec 是否能由 execute 回答，回傳正規化後的 spec，不能時回傳 None"""
+    if not spec or spec.get("expressible") is False:
+        return None
+    companies = {company.lower(): company for company in fin_index.companies}
+    metrics = {metric.lower(): metric for metric in [*fin_index.metrics, *DERIVED_METRICS]}
+    spec = dict(spec)
+    spec["companies"] = [companies.get(str(company).strip().lower()) for company in spec.get("companies") or fin_index.companies]
+    spec["metrics"] = [metrics.get(str(metric).strip().lower()) for metric in spec.get("metrics") or []]
+    start, end = parse_period(spec.get("start_time") or ""), parse_period(spec.get("end_time") or "")
+    if None in spec["companies"] or None in spec["metrics"] or not spec["metrics"] or start is None or end is None or start > end:
+        return None
+    if spec.get("aggregation", "value") not in AGGREGATIONS or spec.get("comparison", "none") not in COMPARISONS:
+        return None
+    # 比率的加總沒有意義
+    if spec["aggregation"] == "sum" and any(metric in RATIO_METRICS for metric in spec["metrics"]):
+        return None
+    spec["companies"] = list(dict.fromkeys(spec["companies"]))
+    spec["metrics"] = list(dict.fromkeys(spec["metrics"]))
+    spec["start"], spec["end"] = start, end
+    spec.setdefault("aggregation", "value")
+    spec.setdefault("comparison", "none")
+    spec["order"] = spec.get("order") or "desc"
+    spec["limit"] = int(spec.get("limit") or 0)
+    return spec
+
+
+def fetch(fin_index, companies, metrics, start, end, scale=None):
+    """
+    以 FinIndex 取出 (company, period) x metric 的寬表，衍生指標以 fin_cube.DERIVED_METRICS 的公式一併計算。
+
+    :param scale: scale(periods) 回傳每一列的乘數 (例如匯率)，在計算比率前套用到金額
+    """
+    base = list(dict.fromkeys(base for metric in metrics for base in (DERIVED_METRICS[metric][0] if metric in DERIVED_METRICS else [metric])))
+    company_column, metric_column, period_column, value_column = [], [], [], []
+    for company in companies:
+        for metric in base:
+            periods, values = fin_index.lookup(company, metric, start, end)
+            company_column.append(np.full(len(periods), company, dtype=object))
+            metric_column.append(np.full(len(periods), metric, dtype=object))
+            period_column.append(periods)
+            value_column.append(values)
+    long = pd.DataFrame({
+        "company": np.concatenate(company_column),
+        "metric": np.concatenate(metric_column),
+        "period": np.concatenate(period_column).astype("int64"),
+        "value": np.concatenate(value_column).astype("float64"),
+    })
+    if scale is not None and len(long):
+        long["value"] *= scale(long["period"].to_numpy())
+    wide = long.pivot_table(index=["company", "period"], columns="metric", values="value", aggfunc="first")
+    wide = wide.reindex(columns=base)
+    for metric in metrics:
+        if metric in DERIVED_METRICS:
+            wide[metric] = DERIVED_METRICS[metric][1](wide)
+    return wide[metrics]
+
+
+def execute(spec, fin_index, scale=None, cube=None):
+    """
+    執行 validate_spec 檢查過的 spec，回傳結果 DataFrame：
+      value / qoq / yoy: index 為 (company, period)
+      sum / mean / max / min: index 為 company (max / min 附上發生的 period)
+
+    :param cube: MetricCube，有提供且不需要換算 (scale 為 None) 時直接取用算好的比率與成長率；
+                 金額本身仍由 FinIndex 取出，保留原始精度 (cube 為 float32)
+    """
+    aggregation = spec["aggregation"]
+    lag = {"qoq": 1, "yoy": 4}.get(aggregation, 0)
+    use_cube = cube is not None and scale is None and (lag or all(metric in RATIO_METRICS for metric in spec["metrics"]))
+    if use_cube:
+        wide = cube.wide(spec["companies"], spec["metrics"], spec["start"], spec["end"], aggregation if lag else "value")
+    else:
+        wide = fetch(fin_index, spec["companies"], spec["metrics"], spec["start"] - lag, spec["end"], scale)
+
+    if lag and use_cube:
+        result = wide
+    elif lag:
+        # 以 (company, period - lag) 對齊前期，缺季時不會錯位
+        previous = wide.copy()
+        previous.index = pd.MultiIndex.from_arrays(
+            [previous.index.get_level_values("company"), previous.index.get_level_values("period") + lag], names=wide.index.names
+        )
+        result = wide / previous.reindex(wide.index) - 1
+        result = result[result.index.get_level_values("period") >= spec["start"]]
+    elif aggregation in ("sum", "mean", "max", "min"):
+        grouped = wide.groupby(level="company")
+        result = getattr(grouped, aggregation)()
+        if aggregation in ("max", "min"):
+            first = spec["metrics"][0]
+            at = getattr(wide[first].dropna().groupby(level="company"), f"idx{aggregation}")()
+            result["period"] = at.map(lambda index: index[1])
+    else:
+        result = wide
+
+    if spec["comparison"] == "rank":
+        first = spec["metrics"][0]
+        if aggregation in ("value", "qoq", "yoy"):
+            # 每間公司取一個值來排名：期間內的最新一季
+            result = result.dropna(subset=[first]).groupby(level="company").tail(1).reset_index(level="period")
+        result = result.dropna(subset=[first]).sort_values(first, ascending=spec["order"] == "asc")
+        if spec["limit"]:
+            result = result.head(spec["limit"])
+    return result
+
+
+def format_number(metric, value, aggregation):
+    if value is None or value != value:
+        return "-"
+    if aggregation in ("qoq", "yoy") or metric in RATIO_METRICS:
+        return f"{value * 100:.2f}%"
+    return f"{value:,.2f}"
+
+
+def format_answer(spec, result, unit="USD Million"):
+    """把結果轉成 markdown 表格，金額單位預設為 USD Million"""
+    period_range = period_label(spec["start"]) if spec["start"] == spec["end"] else f"{period_label(spec['start'])} to {period_label(spec['end'])}"
+    if result.empty:
+        return f"No data found for {', '.join(spec['metrics'])} of {', '.join(spec['companies'])} from {period_range}."
+    labels = {"value": "", "sum": "Total ", "mean": "Average ", "max": "Highest ", "min": "Lowest ", "qoq": "QoQ growth of ", "yoy": "YoY growth of "}
+    ratios = spec["aggregation"] in ("qoq", "yoy") or all(metric in RATIO_METRICS for metric in spec["metrics"])
+    title = f"{labels[spec['aggregation']]}{', '.join(spec['metrics'])} ({period_range}{'' if ratios else f', {unit}'})"
+
+    table = result.reset_index()
+    columns = [column for column in ["company", "period"] if column in table.columns] + spec["metrics"]
+    lines = [f"**{title}**", "", "| " + " | ".join(columns) + " |", "|" + "---|" * len(columns)]
+    for row in table[columns].itertuples(index=False):
+        cells = []
+        for column, value in zip(columns, row):
+            if column == "company":
+                cells.append(str(value))
+            elif column == "period":
+                cells.append(period_label(value) if value == value else "-")
+            else:
+                cells.append(format_number(column, value, spec["aggregation"]))
+        lines.append("| " + " | ".join(cells) + " |")
+    return "\n".join(lines)
+
+
+def answer_query(query, fin_index, extractor, llm_parse=None, cube=None):
+    """
+    以 query spec 回答財報問題：先在本機解析，不行時呼叫 llm_parse(query) 取得 spec (一次結構化輸出)。
+    spec 無法表達時回傳 None，由呼叫端改用 agent。
+
+    :param cube: 資料集的 MetricCube，None 時由 FinIndex 現場計算
+    """
+    start = time.perf_counter()
+    spec = validate_spec(parse_query(query, extractor, fin_index.companies), fin_index)
+    source = "local"
+    if spec is None and llm_parse is not None:
+        source = "llm"
+        try:
+            spec = validate_spec(llm_parse(query), fin_index)
+        except Exception as e:
+            print(f"[query] LLM spec 解析失敗: {e}", file=sys.stderr)
+    if spec is None:
+        print(f"[query] spec 無法表達，改用 agent ({(time.perf_counter() - start) * 1000:.0f} ms)", file=sys.stderr)
+        return None
+    answer = format_answer(spec, execute(spec, fin_index, cube=cube))
+    print(f"[query] {source} spec {spec['aggregation']}/{spec['comparison']} answered in {(time.perf_counter() - start) * 1000:.1f} ms", file=sys.stderr)
+    return answer
+
+
+# 固定的問題集，比較 query engine 與 ReAct agent 的延遲
+BENCH_QUESTIONS = [
+    "What was Apple's revenue in 2023 Q2?",
+    "Nvidia operating income from 2023 Q1 to 2024 Q2",
+    "What is TSMC's gross profit margin in 2024 Q1?",
+    "Which company had the highest revenue in 2024 Q3?",
+    "Total revenue of Intel in 2023",
+    "Average operating margin of AMD and Qualcomm in 2022",
+    "Top 5 companies by total asset in 2024 Q2",
+    "Microsoft revenue YoY growth in 2024",
+    "台積電 2023 年第三季的營收是多少?",
+    "輝達 2024 Q1 的毛利率",
+    "三星 2023 年總資產最高是哪一季?",
+    "2024 Q2 營業費用最低的公司",
+]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Answer financial questions with the structured query engine, or benchmark it against the ReAct agent.")
+    parser.add_argument("command", choices=["ask", "bench"], help="ask: answer --prompt; bench: time the fixed question set")
+    parser.add_argument("--prompt", type=str, default="", help="Question for the ask command")
+    parser.add_argument("--dataset", type=str, default="FIN_Data", choices=list(DATASETS), help="Dataset to query")
+    parser.add_argument("--repeat", type=int, default=5, help="Runs per question for the engine")
+    parser.add_argument("--agent", action="store_true", help="Also time the pandas ReAct agent (needs Vertex AI credentials)")
+    parser.add_argument("--model_name", type=str, default="gemini-1.5-pro", help="Model used by the agent")
+    parser.add_argument("--no_cube", action="store_true", help="Compute ratios and growth from the index instead of the metrics cube")
+    args = parser.parse_args()
+
+    fin_index = load_index(*DATASETS[args.dataset])
+    cube = None if args.no_cube else load_cube(*DATASETS[args.dataset])
+    extractor = SlotExtractor(fin_index.min_period, fin_index.max_period, fin_index.companies, fin_index.metrics)
+    if args.command == "ask":
+        print(answer_query(args.prompt, fin_index, extractor, cube=cube))
+        return
+
+    agent = None
+    if args.agent:
+        import chat
+        from fin_store import load_frame, to_csv_layout
+        from langchain.agents.agent_types import AgentType
+        from langchain_experimental.agents.agent_toolkits import create_pandas_dataframe_agent
+        agent = create_pandas_dataframe_agent(
+            chat.get_llm(args.model_name),
+            to_csv_layout(load_frame(*DATASETS[args.dataset])),
+            verbose=False,
+            agent_type=AgentType.ZERO_SHOT_REACT_DESCRIPTION,
+            allow_dangerous_code=True,
+        )
+
+    results = []
+    for question in BENCH_QUESTIONS:
+        timings = []
+        answered = None
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            answered = answer_query(question, fin_index, extractor, cube=cube) is not None
+            timings.append((time.perf_counter() - start) * 1000)
+        record = {"question": question, "engine": answered, "engine_ms": round(float(np.median(timings)), 3)}
+        if agent is not None:
+            start = time.perf_counter()
+            try:
+                agent.run(question)
+            except Exception as e:
+                record["agent_error"] = str(e)
+            record["agent_ms"] = round((time.perf_counter() - start) * 1000, 1)
+        results.append(record)
+
+    summary = {
+        "questions": len(results),
+        "engine_answered": sum(record["engine"] for record in results),
+        "engine_median_ms": round(float(np.median([record["engine_ms"] for record in results])), 3),
+    }
+    if agent is not None:
+        summary["agent_median_ms"] = round(float(np.median([record["agent_ms"] for record in results])), 1)
+    print(json.dumps({"summary": summary, "results": results}, indent=2, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,338 @@
+import os
+import io
+import sys
+import json
+import time
+import hashlib
+import argparse
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
+
+from bucket_cache import default_cache
+
+# 儲存格式轉換的資料集: name -> (bucket_name, blob_name)
+DATASETS = {
+    "FIN_Data": ("careerhack2025-bsid-resource-bucket", "FIN_Data.csv"),
+    "China_Fin_data": ("tsmccareerhack2025-bsid-grp6-bucket", "China_Fin_data.csv"),
+    "Korea_Fin_data": ("tsmccareerhack2025-bsid-grp6-bucket", "Korea_Fin_data.csv"),
+    "TRANSCRIPT_Data_with_FiscalYear": ("tsmccareerhack2025-bsid-grp6-bucket", "TRANSCRIPT_Data_with_FiscalYear.csv"),
+}
+
+STORE_DIR = os.environ.get("MARKETAGENT_STORE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "marketagent", "store"))
+# 增量讀取時重新下載並比對的開頭與尾端長度，用來確認新版本只是在原檔案後附加資料
+TAIL_BYTES = 4096
+
+# 已載入的 DataFrame: (bucket_name, blob_name) -> (generation, df)
+_FRAMES = {}
+# 已建立的 FinIndex: (bucket_name, blob_name) -> (df, FinIndex)
+_INDEXES = {}
+
+
+def period_key(year, quarter):
+    """將 (年, 季) 轉成可直接比較大小的整數，例如 2020 Q1 -> 8080"""
+    return year * 4 + quarter - 1
+
+
+def period_parts(key):
+    """period_key 的反函數，回傳 (年, 季)"""
+    return key // 4, key % 4 + 1
+
+
+def period_label(key, sep="_"):
+    """將 period key 轉成 '2020_Q1' (sep="_") 或 '2020 Q1' (sep=" ") 的標籤"""
+    year, quarter = period_parts(int(key))
+    return f"{year}{sep}Q{quarter}"
+
+
+def period_labels(keys, sep="_"):
+    """向量化的 period_label，只對不重複的 key 組字串"""
+    keys = pd.Series(keys)
+    return keys.map({key: period_label(key, sep) for key in keys.unique()})
+
+
+def parse_period(time_str):
+    """解析 'YYYY_QX' 或 'YYYY QX'，回傳 period key；格式錯誤時回傳 None"""
+    for sep in ("_", " "):
+        parts = time_str.split(sep)
+        if len(parts) == 2 and parts[0].isdigit() and len(parts[1]) == 2 and parts[1][0] == "Q" and parts[1][1].isdigit():
+            quarter = int(parts[1][1])
+            if 1 <= quarter <= 4:
+                return period_key(int(parts[0]), quarter)
+    return None
+
+
+def normalize_frame(df):
+    """
+    將 CSV 解析出的 DataFrame 轉成固定型別：
+      *_QTR 欄位 ('Q1') -> int8，*_YEAR 欄位 -> int16
+      重複值多的字串欄位 (公司、指標、幣別...) -> category
+      有 CALENDAR_YEAR / CALENDAR_QTR 時新增整數的 PERIOD 欄位
+    """
+    df = df.rename(columns=lambda name: name.lstrip("\ufeff"))
+    for column in df.columns:
+        is_text = pd.api.types.is_object_dtype(df[column]) or pd.api.types.is_string_dtype(df[column])
+        if column.endswith("_QTR"):
+            if is_text:
+                df[column] = df[column].astype(str).str.extract(r"(\d+)", expand=False)
+            df[column] = df[column].astype("int8")
+        elif column.endswith("_YEAR"):
+            df[column] = df[column].astype("int16")
+        elif is_text and df[column].nunique() <= len(df) // 2:
+            df[column] = df[column].astype("category")
+    if "CALENDAR_YEAR" in df.columns and "CALENDAR_QTR" in df.columns:
+        df["PERIOD"] = period_key(df["CALENDAR_YEAR"].astype("int16"), df["CALENDAR_QTR"].astype("int16"))
+    return df
+
+
+def to_csv_layout(df):
+    """還原成原始 CSV 的欄位格式 (CALENDAR_QTR 為 'Q1' 字串、沒有 PERIOD)，給 LLM agent 使用"""
+    df = df.drop(columns=["PERIOD"], errors="ignore").copy()
+    for column in df.columns:
+        if column.endswith("_QTR"):
+            df[column] = "Q" + df[column].astype(str)
+        elif isinstance(df[column].dtype, pd.CategoricalDtype):
+            df[column] = df[column].astype(str)
+    return df
+
+
+def store_name(blob_name):
+    return os.path.splitext(os.path.basename(blob_name))[0]
+
+
+def _paths(blob_name, store_dir):
+    name = store_name(blob_name)
+    return os.path.join(store_dir, f"{name}.arrow"), os.path.join(store_dir, f"{name}.meta.json")
+
+
+def read_meta(blob_name, store_dir=None):
+    _, meta_path = _paths(blob_name, store_dir or STORE_DIR)
+    try:
+        with open(meta_path, encoding="utf-8") as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+
+def write_frame(df, blob_name, meta, store_dir=None):
+    """將 DataFrame 以未壓縮的 Arrow IPC 格式寫入 store，並寫入 metadata"""
+    store_dir = store_dir or STORE_DIR
+    os.makedirs(store_dir, exist_ok=True)
+    data_path, meta_path = _paths(blob_name, store_dir)
+    tmp_path = f"{data_path}.{os.getpid()}.tmp"
+    feather.write_feather(df.reset_index(drop=True), tmp_path, compression="uncompressed")
+    os.replace(tmp_path, data_path)
+    meta = {**meta, "rows": len(df), "built_at": time.time()}
+    if "PERIOD" in df.columns and len(df):
+        meta["min_period"] = period_label(df["PERIOD"].min())
+        meta["max_period"] = period_label(df["PERIOD"].max())
+    tmp_path = f"{meta_path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(meta, f, indent=2, ensure_ascii=False)
+    os.replace(tmp_path, meta_path)
+    return meta
+
+
+def read_frame(blob_name, store_dir=None):
+    """以 memory map 讀取 store 中的資料，數值欄位不需要解析或複製"""
+    data_path, _ = _paths(blob_name, store_dir or STORE_DIR)
+    source = pa.memory_map(data_path, "r")
+    table = pa.ipc.open_file(source).read_all()
+    return table.to_pandas(split_blocks=True)
+
+
+def _source_meta(bucket_name, blob_name, generation, data, size):
+    """記錄來源檔案的版本、大小與尾端 hash，供之後判斷是否能增量更新"""
+    return {
+        "source": f"{bucket_name}/{blob_name}",
+        "generation": generation,
+        "source_bytes": size,
+        "tail_sha256": hashlib.sha256(data[-TAIL_BYTES:]).hexdigest(),
+    }
+
+
+def _head_sha(data):
+    return hashlib.sha256(data[:TAIL_BYTES]).hexdigest()
+
+
+def build(bucket_name, blob_name, store_dir=None):
+    """從 bucket 下載 CSV 並轉換成 store 格式，回傳 (generation, df)"""
+    generation, data = default_cache().fetch(bucket_name, blob_name)
+    df = normalize_frame(pd.read_csv(io.StringIO(data.decode("utf-8"))))
+    header = data.split(b"\n", 1)[0].decode("utf-8").rstrip("\r")
+    meta = {**_source_meta(bucket_name, blob_name, generation, data, len(data)), "header": header, "head_sha256": _head_sha(data)}
+    write_frame(df, blob_name, meta, store_dir)
+    return generation, df
+
+
+def concat_frames(df, rows):
+    """附加新的資料列，原本是 category 的欄位合併類別後維持 category"""
+    combined = pd.concat([df, rows], ignore_index=True)
+    for column in df.columns:
+        if isinstance(df[column].dtype, pd.CategoricalDtype):
+            combined[column] = combined[column].astype(str).astype("category")
+        elif column in rows.columns and combined[column].dtype != df[column].dtype:
+            combined[column] = combined[column].astype(df[column].dtype)
+    return combined
+
+
+def append(bucket_name, blob_name, store_dir=None, df=None):
+    """
+    bucket 物件的新版本只是在原檔案後附加資料列時，只下載新增的部分並附加到 store，回傳 (generation, df, 新增列數)。
+    以重新下載的開頭與尾端 hash 確認原內容未變動 (中段的修改需以 fin_store build --refresh 完整重建)；
+    檔案沒有變大、hash 不符或沒有紀錄時回傳 None，由呼叫端完整重建。
+
+    :param df: 目前已載入的資料，None 時從 store 讀取
+    """
+    meta = read_meta(blob_name, store_dir)
+    if not meta or not meta.get("tail_sha256") or not meta.get("head_sha256") or not meta.get("header"):
+        return None
+    size = meta["source_bytes"]
+    offset = max(size - TAIL_BYTES, 0)
+    generation, data = default_cache().fetch_range(bucket_name, blob_name, offset)
+    tail, delta = data[:size - offset], data[size - offset:]
+    if not delta or len(tail) != size - offset or hashlib.sha256(tail).hexdigest() != meta["tail_sha256"]:
+        return None
+    _, head = default_cache().fetch_range(bucket_name, blob_name, 0, min(size, TAIL_BYTES))
+    if _head_sha(head) != meta["head_sha256"]:
+        return None
+    # 原檔案最後一列沒有換行時，新內容可能是在修改最後一列
+    if tail and not tail.endswith(b"\n") and delta and not delta.startswith((b"\n", b"\r\n")):
+        return None
+    if df is None:
+        df = read_frame(blob_name, store_dir)
+    rows = pd.read_csv(io.StringIO(meta["header"] + "\n" + delta.decode("utf-8"))) if delta.strip() else None
+    if rows is not None and len(rows):
+        rows = normalize_frame(rows)
+        df = concat_frames(df, rows.reindex(columns=df.columns))
+    added = 0 if rows is None else len(rows)
+    new_meta = {**_source_meta(bucket_name, blob_name, generation, tail + delta, size + len(delta)), "head_sha256": _head_sha(head + delta)}
+    write_frame(df, blob_name, {**meta, **new_meta, "appended_rows": meta.get("appended_rows", 0) + added}, store_dir)
+    return generation, df, added
+
+
+def load_frame(bucket_name, blob_name, store_dir=None, revalidate=True):
+    """
+    載入財報資料的共用入口。
+    store 中的資料與 bucket 物件 generation 相同時直接 memory map 讀取，否則重新轉換。
+    已載入的 DataFrame 會留在記憶體中。
+
+    :param revalidate: 是否向 bucket 檢查 generation；False 時只要 store 中有資料就使用
+    """
+    key = (bucket_name, blob_name)
+    generation = default_cache().generation(bucket_name, blob_name) if revalidate else None
+    cached = _FRAMES.get(key)
+    if cached is not None and (not revalidate or cached[0] == generation):
+        return cached[1]
+
+    meta = read_meta(blob_name, store_dir)
+    if meta is not None and (not revalidate or meta.get("generation") == generation):
+        try:
+            cached = (meta.get("generation"), read_frame(blob_name, store_dir))
+        except (FileNotFoundError, pa.ArrowInvalid):
+            cached = build(bucket_name, blob_name, store_dir)
+    else:
+        cached = None
+        if meta is not None:
+            # 新的季度通常是附加在檔案後面，先嘗試只讀取新增的部分
+            start = time.perf_counter()
+            try:
+                # 記憶體中的資料與 store 同版本時直接沿用，否則由 append 從 store 讀取
+                current = _FRAMES.get(key)
+                current = current[1] if current is not None and current[0] == meta.get("generation") else None
+                appended = append(bucket_name, blob_name, store_dir, current)
+            except (FileNotFoundError, pa.ArrowInvalid, pd.errors.ParserError, UnicodeDecodeError, ValueError) as e:
+                print(f"[ingest] {store_name(blob_name)}: 增量更新失敗 ({e})，完整重建", file=sys.stderr)
+                appended = None
+            if appended is not None:
+                cached = appended[:2]
+                print(f"[ingest] {store_name(blob_name)}: +{appended[2]} rows in {(time.perf_counter() - start) * 1000:.0f} ms", file=sys.stderr)
+        if cached is None:
+            cached = build(bucket_name, blob_name, store_dir)
+    _FRAMES[key] = cached
+    return cached[1]
+
+
+class FinIndex:
+    """
+    財報資料的 (公司, 指標) 索引。
+    資料依 (公司, 指標, PERIOD) 排序後，每個 (公司, 指標) 對應一段連續的列，
+    時間範圍以 searchsorted 在該段中定位，查詢成本只與符合的列數有關。
+    """
+
+    def __init__(self, df, value_column="USD_Value", version=None):
+        self.version = version
+        df = df.sort_values(by=["Company Name", "Index", "PERIOD"], kind="stable")
+        self.periods = df["PERIOD"].to_numpy()
+        self.values = df[value_column].to_numpy()
+        self.slices = {
+            (str(company), str(metric)): (rows[0], rows[-1] + 1)
+            for (company, metric), rows in df.groupby(["Company Name", "Index"], observed=True, sort=False).indices.items()
+        }
+        self.companies = sorted({company for company, _ in self.slices})
+        self.metrics = sorted({metric for _, metric in self.slices})
+        self.min_period = int(self.periods.min()) if len(self.periods) else None
+        self.max_period = int(self.periods.max()) if len(self.periods) else None
+
+    def lookup(self, company, metric, start=None, end=None):
+        """
+        回傳 (periods, values)，皆為依時間排序的 numpy array。
+
+        :param start: 起始 period key (含)，None 表示不限制
+        :param end: 結束 period key (含)，None 表示不限制
+        """
+        if (company, metric) not in self.slices:
+            return np.empty(0, dtype=self.periods.dtype), np.empty(0, dtype=self.values.dtype)
+        first, last = self.slices[(company, metric)]
+        periods = self.periods[first:last]
+        lo = 0 if start is None else np.searchsorted(periods, start, side="left")
+        hi = len(periods) if end is None else np.searchsorted(periods, end, side="right")
+        return periods[lo:hi], self.values[first + lo:first + hi]
+
+
+def load_index(bucket_name, blob_name, store_dir=None, revalidate=True):
+    """取得資料集的 FinIndex，資料重新載入 (generation 改變) 時才重建"""
+    key = (bucket_name, blob_name)
+    df = load_frame(bucket_name, blob_name, store_dir, revalidate)
+    cached = _INDEXES.get(key)
+    if cached is None or cached[0] is not df:
+        cached = (df, FinIndex(df, version=frame_version(bucket_name, blob_name)))
+        _INDEXES[key] = cached
+    return cached[1]
+
+
+def frame_version(bucket_name, blob_name):
+    """目前載入的資料版本 (bucket 物件的 generation)，供依資料內容建立的快取使用"""
+    cached = _FRAMES.get((bucket_name, blob_name))
+    return cached[0] if cached is not None else None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build or inspect the typed columnar financial data store.")
+    parser.add_argument("command", choices=["build", "info"], help="build: convert CSVs into the store; info: show store metadata")
+    parser.add_argument("--dataset", type=str, nargs="*", choices=list(DATASETS), help="Datasets to process (default: all)")
+    parser.add_argument("--store_dir", type=str, default=STORE_DIR, help="Directory of the store")
+    parser.add_argument("--refresh", action="store_true", help="Rebuild even if the stored generation is current")
+    args = parser.parse_args()
+
+    for name in args.dataset or DATASETS:
+        bucket_name, blob_name = DATASETS[name]
+        if args.command == "info":
+            print(name, json.dumps(read_meta(blob_name, args.store_dir), ensure_ascii=False))
+            continue
+        start = time.perf_counter()
+        try:
+            meta = read_meta(blob_name, args.store_dir)
+            if args.refresh or meta is None or meta.get("generation") != default_cache().generation(bucket_name, blob_name):
+                build(bucket_name, blob_name, args.store_dir)
+                print(f"{name}: built in {time.perf_counter() - start:.2f} s")
+            else:
+                print(f"{name}: up to date")
+        except Exception as e:
+            print(f"{name}: failed ({e})", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
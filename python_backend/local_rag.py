@@ -0,0 +1,426 @@
+import os
+import re
+import sys
+import json
+import time
+import zlib
+import hashlib
+import argparse
+import threading
+
+import numpy as np
+
+from fin_store import DATASETS, STORE_DIR, load_index
+from transcript_chunks import split_transcript
+from transcripts import TRANSCRIPT_BUCKET, load_catalog, load_transcript_text
+
+# 與 Vertex RAG corpus 相同的檢索設定：每次取最接近的 top_k 段，只保留 cosine distance 不超過門檻的段落。
+# 門檻是依 Vertex embedding 的距離分布設定的，HashingEmbedder 的距離普遍較大，大部分段落會被門檻濾掉
+VECTOR_DISTANCE_THRESHOLD = 0.6
+# 切段的 token 上限 (估計值) 與預設的 embedding 模型，例如 "hashing"、"hashing:1024"、"vertex:text-embedding-004"
+CHUNK_TOKENS = int(os.environ.get("MARKETAGENT_RAG_CHUNK_TOKENS", 512))
+EMBEDDER = os.environ.get("MARKETAGENT_RAG_EMBEDDER", "vertex:text-embedding-004")
+# CLI 用：user_role 對應的財報資料集，檢索範圍為該資料集中公司的逐字稿
+ROLE_DATASETS = {"Global": "FIN_Data", "China": "China_Fin_data", "Korea": "Korea_Fin_data"}
+
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+(?:['.][a-z0-9]+)*|[\u4e00-\u9fff]")
+STOPWORDS = frozenset(
+    "a an the and or but of to in on for with at by from as is are was were be been being it its this that these those "
+    "we our us you your they their them i he she his her not do does did so if then than there here have has had will would "
+    "can could should about into over also just very".split()
+)
+
+
+def similarity_top_k(user_role):
+    """Global corpus 取 20 段，其他角色取 12 段"""
+    return 20 if user_role == "Global" else 12
+
+
+def normalize(vectors):
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.where(norms == 0, 1, norms)
+
+
+class HashingEmbedder:
+    """
+    以 feature hashing 將字詞與相鄰字詞 (bigram) 映射到固定維度的向量。
+    結果只由文字決定，不需要模型或網路，供離線測試與基準測試使用。
+
+    :param dim: 向量維度
+    """
+
+    def __init__(self, dim=512):
+        self.dim = dim
+        self.name = f"hashing-{dim}"
+
+    def _features(self, text):
+        words = [word for word in TOKEN_PATTERN.findall(text.lower()) if word not in STOPWORDS]
+        return words + [f"{left} {right}" for left, right in zip(words, words[1:])]
+
+    def embed(self, texts):
+        vectors = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            counts = {}
+            for feature in self._features(text):
+                counts[feature] = counts.get(feature, 0) + 1
+            if not counts:
+                continue
+            hashes = np.fromiter((zlib.crc32(feature.encode("utf-8")) for feature in counts), dtype=np.int64, count=len(counts))
+            weights = 1 + np.log(np.fromiter(counts.values(), dtype=np.float32, count=len(counts)))
+            # hash 的最高位元決定正負號，碰撞的特徵彼此抵銷而不是累加
+            np.add.at(vectors[row], hashes % self.dim, np.where(hashes & 0x80000000, weights, -weights))
+        return normalize(vectors)
+
+
+class VertexEmbedder:
+    """
+    Vertex AI 的文字 embedding 模型，第一次使用時才載入 SDK。
+
+    :param model_name: embedding 模型名稱
+    :param batch_size: 每次請求的段落數
+    """
+
+    def __init__(self, model_name="text-embedding-004", batch_size=32):
+        self.name = model_name
+        self.batch_size = batch_size
+        self._model = None
+
+    def embed(self, texts):
+        if self._model is None:
+            from vertexai.language_models import TextEmbeddingModel
+            self._model = TextEmbeddingModel.from_pretrained(self.name)
+        rows = []
+        for start in range(0, len(texts), self.batch_size):
+            rows += [embedding.values for embedding in self._model.get_embeddings(texts[start:start + self.batch_size])]
+        return normalize(np.asarray(rows, dtype=np.float32))
+
+
+def get_embedder(spec=None):
+    """'hashing'、'hashing:<dim>' 或 'vertex:<model_name>'"""
+    spec = spec or EMBEDDER
+    kind, _, option = spec.partition(":")
+    if kind == "hashing":
+        return HashingEmbedder(int(option) if option else 512)
+    if kind == "vertex":
+        return VertexEmbedder(option or "text-embedding-004")
+    raise ValueError(f"未知的 embedder: {spec}")
+
+
+def _top_k(ids, distances, k):
+    """回傳距離最小的 k 個 (ids, distances)，依距離由小到大排序"""
+    if len(ids) > k:
+        part = np.argpartition(distances, k - 1)[:k]
+        ids, distances = ids[part], distances[part]
+    order = np.argsort(distances, kind="stable")
+    return ids[order], distances[order]
+
+
+class FlatIndex:
+    """與所有向量逐一比較 (brute force)，結果精確"""
+
+    kind = "flat"
+
+    def __init__(self, vectors):
+        self.vectors = vectors
+
+    def search(self, query, k):
+        return _top_k(np.arange(len(self.vectors)), 1 - self.vectors @ query, k)
+
+
+class IVFIndex:
+    """
+    以 k-means 將向量分成 nlist 群 (inverted file index)，查詢時只比較最接近的 nprobe 群中的向量。
+
+    :param nlist: 分群數，預設為向量數的平方根
+    :param nprobe: 查詢時比較的群數
+    """
+
+    kind = "ivf"
+
+    def __init__(self, vectors, nlist=None, nprobe=8, iterations=10, seed=0):
+        n = len(vectors)
+        self.nlist = max(1, min(n, nlist or int(np.sqrt(n))))
+        self.nprobe = max(1, min(nprobe, self.nlist))
+        rng = np.random.default_rng(seed)
+        centroids = vectors[rng.choice(n, self.nlist, replace=False)].copy() if n else np.zeros((1, vectors.shape[1]), dtype=np.float32)
+        assign = np.zeros(n, dtype=np.int64)
+        for _ in range(iterations if n else 0):
+            assign = np.argmax(vectors @ centroids.T, axis=1)
+            for cluster in range(self.nlist):
+                members = vectors[assign == cluster]
+                # 沒有成員的群保留原本的中心
+                if len(members):
+                    centroids[cluster] = members.sum(axis=0)
+            centroids = normalize(centroids)
+        if n:
+            assign = np.argmax(vectors @ centroids.T, axis=1)
+        self.centroids = centroids
+        # 同一群的向量連續存放，查詢時只需要取出幾段連續的區間
+        order = np.argsort(assign, kind="stable")
+        self.ids = order
+        self.packed = vectors[order]
+        self.offsets = np.searchsorted(assign[order], np.arange(self.nlist + 1))
+
+    def search(self, query, k, nprobe=None):
+        nprobe = min(nprobe or self.nprobe, self.nlist)
+        scores = self.centroids @ query
+        probe = np.argpartition(-scores, nprobe - 1)[:nprobe] if nprobe < self.nlist else np.arange(self.nlist)
+        candidates = np.concatenate([np.arange(self.offsets[cluster], self.offsets[cluster + 1]) for cluster in probe])
+        return _top_k(self.ids[candidates], 1 - self.packed[candidates] @ query, k)
+
+
+INDEX_TYPES = {"flat": FlatIndex, "ivf": IVFIndex}
+
+
+class LocalCorpus:
+    """
+    單一角色的本機逐字稿向量庫。
+
+    :param chunks: [{company, year, quarter, filename, text}, ...]
+    :param vectors: (len(chunks), dim) 的 float32 正規化向量
+    :param embedder: 建立向量時使用的 embedder，查詢也使用同一個
+    :param version: 建立時的逐字稿目錄版本、embedder 與切段設定的 hash
+    """
+
+    def __init__(self, chunks, vectors, embedder, version=None):
+        self.chunks = chunks
+        self.vectors = vectors
+        self.embedder = embedder
+        self.version = version
+        self._indexes = {}
+        self._lock = threading.Lock()
+
+    def index(self, kind="flat", **options):
+        key = (kind, tuple(sorted(options.items())))
+        with self._lock:
+            if key not in self._indexes:
+                start = time.perf_counter()
+                self._indexes[key] = INDEX_TYPES[kind](self.vectors, **options)
+                if kind != "flat":
+                    print(f"[rag] {kind} index over {len(self.chunks)} chunks built in {(time.perf_counter() - start) * 1000:.0f} ms", file=sys.stderr)
+            return self._indexes[key]
+
+    def search(self, query, top_k, threshold=VECTOR_DISTANCE_THRESHOLD, kind="flat"):
+        """回傳最接近的 top_k 段中距離不超過 threshold 的段落，依距離由小到大排序"""
+        if not self.chunks:
+            return []
+        ids, distances = self.index(kind).search(self.embedder.embed([query])[0], top_k)
+        return [{**self.chunks[i], "distance": float(distance)} for i, distance in zip(ids, distances) if distance <= threshold]
+
+
+def _corpus_paths(user_role, embedder, store_dir):
+    name = re.sub(r"[^\w.-]+", "_", f"{user_role}.{embedder.name}")
+    return os.path.join(store_dir, "rag", f"{name}.npy"), os.path.join(store_dir, "rag", f"{name}.json")
+
+
+def corpus_version(catalog_version, embedder, chunk_tokens, companies):
+    key = json.dumps([catalog_version, embedder.name, chunk_tokens, sorted(companies) if companies is not None else None])
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()[:16]
+
+
+def build_corpus(companies, embedder, store_dir=None, chunk_tokens=CHUNK_TOKENS, catalog=None):
+    """
+    將公司的逐字稿依發言切段並建立向量，companies 為 None 時包含所有逐字稿。
+    每段前面加上公司與季度，檢索時公司名稱也會被比對到。bucket 中缺少的逐字稿略過。
+    """
+    catalog = catalog or load_catalog(store_dir)
+    wanted = set(companies) if companies is not None else None
+    chunks, missing = [], 0
+    for entry in catalog.entries.values():
+        if wanted is not None and entry["company"] not in wanted:
+            continue
+        try:
+            text = load_transcript_text(TRANSCRIPT_BUCKET, entry["blob"], store_dir, catalog)
+        except FileNotFoundError:
+            missing += 1
+            continue
+        header = f"{entry['company']} {entry['year']} Q{entry['quarter']} earnings call"
+        for chunk in split_transcript(text, chunk_tokens):
+            chunks.append({
+                "company": entry["company"],
+                "year": entry["year"],
+                "quarter": entry["quarter"],
+                "filename": entry["filename"],
+                "text": f"{header}\n{chunk.strip()}",
+            })
+    if missing:
+        print(f"[rag] {missing} transcripts missing from the bucket were skipped", file=sys.stderr)
+    vectors = embedder.embed([chunk["text"] for chunk in chunks]) if chunks else np.zeros((0, getattr(embedder, "dim", 1)), dtype=np.float32)
+    return LocalCorpus(chunks, vectors.astype(np.float32), embedder, corpus_version(catalog.version, embedder, chunk_tokens, companies))
+
+
+def write_corpus(corpus, user_role, store_dir=None):
+    store_dir = store_dir or STORE_DIR
+    data_path, meta_path = _corpus_paths(user_role, corpus.embedder, store_dir)
+    os.makedirs(os.path.dirname(data_path), exist_ok=True)
+    tmp_path = f"{data_path}.{os.getpid()}.tmp.npy"
+    np.save(tmp_path, corpus.vectors)
+    os.replace(tmp_path, data_path)
+    tmp_path = f"{meta_path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump({"version": corpus.version, "embedder": corpus.embedder.name, "chunks": corpus.chunks}, f, ensure_ascii=False)
+    os.replace(tmp_path, meta_path)
+
+
+def read_corpus(user_role, embedder, store_dir=None):
+    data_path, meta_path = _corpus_paths(user_role, embedder, store_dir or STORE_DIR)
+    try:
+        with open(meta_path, encoding="utf-8") as f:
+            meta = json.load(f)
+        vectors = np.load(data_path, mmap_mode="r")
+    except (FileNotFoundError, json.JSONDecodeError, ValueError):
+        return None
+    return LocalCorpus(meta["chunks"], vectors, embedder, meta["version"])
+
+
+# 已載入的向量庫: (store_dir, user_role, embedder 名稱) -> LocalCorpus
+_CORPORA = {}
+_LOCK = threading.Lock()
+
+
+def load_corpus(user_role, companies=None, embedder=None, store_dir=None, chunk_tokens=CHUNK_TOKENS):
+    """
+    取得 user_role 的向量庫。store 中的向量庫與目前的逐字稿目錄、embedder 與切段設定相同時直接讀取 (向量以 mmap 開啟)，
+    否則重新建立並寫回 store。
+    """
+    store_dir = store_dir or STORE_DIR
+    embedder = embedder or get_embedder()
+    key = (store_dir, user_role, embedder.name)
+    with _LOCK:
+        version = corpus_version(load_catalog(store_dir).version, embedder, chunk_tokens, companies)
+        corpus = _CORPORA.get(key)
+        if corpus is None or corpus.version != version:
+            corpus = read_corpus(user_role, embedder, store_dir)
+        if corpus is None or corpus.version != version:
+            start = time.perf_counter()
+            corpus = build_corpus(companies, embedder, store_dir, chunk_tokens)
+            write_corpus(corpus, user_role, store_dir)
+            print(f"[rag] {user_role} corpus built ({len(corpus.chunks)} chunks) in {time.perf_counter() - start:.1f} s", file=sys.stderr)
+        _CORPORA[key] = corpus
+        return corpus
+
+
+def retrieve(query, user_role, companies=None, kind="flat", top_k=None, threshold=VECTOR_DISTANCE_THRESHOLD, store_dir=None):
+    """以本機向量庫檢索逐字稿段落，top_k 預設與 Vertex RAG 設定相同"""
+    corpus = load_corpus(user_role, companies, store_dir=store_dir)
+    return corpus.search(query, top_k or similarity_top_k(user_role), threshold, kind)
+
+
+def format_contexts(hits):
+    """將檢索結果整理成放入 prompt 的文字"""
+    return "\n\n".join(f"[{i + 1}] {hit['text']}" for i, hit in enumerate(hits))
+
+
+def synthetic_corpus(size, embedder, seed=0, topics=40, words_per_chunk=200):
+    """
+    產生主題分群的隨機段落，沒有逐字稿時用於基準測試。
+    每個主題有自己的常用字，段落混合主題字與共用字。
+    """
+    rng = np.random.default_rng(seed)
+    common = [f"w{i}" for i in range(2000)]
+    topic_words = [[f"t{topic}x{i}" for i in range(60)] for topic in range(topics)]
+    chunks = []
+    for i in range(size):
+        topic = int(rng.integers(topics))
+        words = np.where(rng.random(words_per_chunk) < 0.35, rng.choice(topic_words[topic], words_per_chunk), rng.choice(common, words_per_chunk))
+        chunks.append({"company": f"topic{topic}", "year": 0, "quarter": 0, "filename": f"synthetic-{i}", "text": " ".join(words)})
+    return LocalCorpus(chunks, embedder.embed([chunk["text"] for chunk in chunks]), embedder, "synthetic")
+
+
+def benchmark(corpus, queries, top_k, threshold, nprobes):
+    """
+    以 brute force 的結果為基準，比較 IVF 在不同 nprobe 下的 recall@top_k 與查詢延遲。
+    主要指標是 recall_top_k；套用距離門檻後的 recall 只在門檻內有足夠段落時才有意義 (見 mean_results_within_threshold)。
+    """
+    query_vectors = corpus.embedder.embed(queries)
+    flat = corpus.index("flat")
+
+    def run(search):
+        latencies, results = [], []
+        for query in query_vectors:
+            start = time.perf_counter()
+            ids, distances = search(query)
+            latencies.append((time.perf_counter() - start) * 1000)
+            results.append((set(ids.tolist()), set(ids[distances <= threshold].tolist())))
+        return np.asarray(latencies), results
+
+    def summary(latencies):
+        return {"p50_ms": round(float(np.percentile(latencies, 50)), 3), "p95_ms": round(float(np.percentile(latencies, 95)), 3)}
+
+    def recall(results, truth, part):
+        values = [len(found[part] & expected[part]) / len(expected[part]) for found, expected in zip(results, truth) if expected[part]]
+        return round(float(np.mean(values)), 4) if values else None
+
+    flat_latencies, truth = run(lambda query: flat.search(query, top_k))
+    report = {
+        "chunks": len(corpus.chunks),
+        "queries": len(queries),
+        "top_k": top_k,
+        "threshold": threshold,
+        "mean_results_within_threshold": round(float(np.mean([len(expected[1]) for expected in truth])), 2),
+        "flat": summary(flat_latencies),
+    }
+    if not corpus.embedder.name.startswith("vertex"):
+        report["threshold_note"] = f"threshold {threshold} is calibrated for Vertex embeddings, not {corpus.embedder.name}; recall_within_threshold is measured on few results"
+    ivf = corpus.index("ivf")
+    report["ivf_nlist"] = ivf.nlist
+    for nprobe in nprobes:
+        latencies, results = run(lambda query: ivf.search(query, top_k, nprobe))
+        # recall_top_k 比較索引找到的 top_k；recall_within_threshold 比較套用距離門檻後實際回傳的段落
+        report[f"ivf_nprobe_{nprobe}"] = {"recall_top_k": recall(results, truth, 0), **summary(latencies), "recall_within_threshold": recall(results, truth, 1)}
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build, query or benchmark the local transcript vector retrieval backend.")
+    parser.add_argument("command", choices=["build", "query", "bench"], help="build: (re)build the role corpus; query: retrieve chunks for --query; bench: IVF recall and latency against brute force")
+    parser.add_argument("--user_role", type=str, default="Global", choices=list(ROLE_DATASETS), help="Role whose corpus to use")
+    parser.add_argument("--store_dir", type=str, default=STORE_DIR, help="Directory of the store")
+    parser.add_argument("--embedder", type=str, default=EMBEDDER, help="'hashing', 'hashing:<dim>' or 'vertex:<model_name>'")
+    parser.add_argument("--index", type=str, default="flat", choices=list(INDEX_TYPES), help="Index used by query")
+    parser.add_argument("--query", type=str, default="", help="Query text for query")
+    parser.add_argument("--top_k", type=int, help="Chunks to retrieve (default: 20 for Global, 12 otherwise)")
+    parser.add_argument("--threshold", type=float, default=VECTOR_DISTANCE_THRESHOLD, help="Maximum cosine distance of retrieved chunks")
+    parser.add_argument("--synthetic", type=int, default=0, help="Benchmark on N synthetic chunks instead of the transcripts")
+    parser.add_argument("--queries", type=int, default=200, help="Number of benchmark queries")
+    parser.add_argument("--nprobe", type=int, nargs="*", default=[1, 4, 8, 16], help="IVF nprobe values to benchmark")
+    args = parser.parse_args()
+
+    embedder = get_embedder(args.embedder)
+    top_k = args.top_k or similarity_top_k(args.user_role)
+    if args.command == "bench" and args.synthetic:
+        corpus = synthetic_corpus(args.synthetic, embedder)
+    else:
+        companies = None
+        if args.user_role != "Global":
+            companies = load_index(*DATASETS[ROLE_DATASETS[args.user_role]], args.store_dir).companies
+        if args.command == "build":
+            # 清除已載入的向量庫與版本，強制重新建立
+            _CORPORA.clear()
+            data_path, _ = _corpus_paths(args.user_role, embedder, args.store_dir)
+            if os.path.exists(data_path):
+                os.remove(data_path)
+        corpus = load_corpus(args.user_role, companies, embedder, args.store_dir)
+
+    if args.command == "query":
+        start = time.perf_counter()
+        hits = corpus.search(args.query, top_k, args.threshold, args.index)
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        for hit in hits:
+            print(json.dumps({**hit, "text": hit["text"][:200]}, ensure_ascii=False))
+        print(f"[rag] {len(hits)} chunks in {elapsed_ms:.1f} ms", file=sys.stderr)
+    elif args.command == "bench":
+        rng = np.random.default_rng(1)
+        # 以隨機段落中的一小段文字作為查詢，模擬引用逐字稿內容的問題
+        queries = []
+        for i in rng.choice(len(corpus.chunks), min(args.queries, len(corpus.chunks)), replace=False):
+            words = corpus.chunks[i]["text"].split()
+            offset = int(rng.integers(max(1, len(words) - 30)))
+            queries.append(" ".join(words[offset:offset + 30]))
+        print(json.dumps(benchmark(corpus, queries, top_k, args.threshold, args.nprobe), indent=2))
+    else:
+        print(json.dumps({"version": corpus.version, "embedder": embedder.name, "chunks": len(corpus.chunks)}, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
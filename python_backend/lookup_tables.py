@@ -0,0 +1,270 @@
+import io
+import os
+import re
+import sys
+import json
+import time
+import hashlib
+import argparse
+
+import numpy as np
+import pandas as pd
+
+from bucket_cache import default_cache
+from fin_store import DATASETS, load_frame, load_index, period_key, period_label, period_parts
+from fin_query import RATIO_METRICS, execute, format_answer, parse_query, validate_spec
+from plot_slots import SlotExtractor
+
+TRANSCRIPT_BUCKET, TRANSCRIPT_BLOB = DATASETS["TRANSCRIPT_Data_with_FiscalYear"]
+
+# 匯率表來源: 'gs://bucket/blob' 或本機 CSV (date,base,quote,rate)；未設定時使用內建的匯率
+FX_SOURCE = os.environ.get("MARKETAGENT_FX_TABLE", "")
+DEFAULT_FX_RATES = [("2020-01-01", "USD", "TWD", 32.93)]
+
+# 逐字稿檔名中的財年季度，例如 'Apple Inc. (NASDAQ AAPL) Q2 2020 Results Conference Call'
+FILENAME_PERIOD = re.compile(r"\bQ([1-4])\s*(?:FY\s*)?'?(\d{4}|\d{2})\b", re.IGNORECASE)
+
+CURRENCY_ALIASES = {
+    "TWD": r"\btwd\b|\bntd\b|\bnt\$|台幣|臺幣|新台幣",
+    "USD": r"\busd\b|us\$|dollar|美金|美元",
+    "KRW": r"\bkrw\b|won\b|韓元|韓圜",
+    "CNY": r"\bcny\b|\brmb\b|yuan|人民幣",
+    "JPY": r"\bjpy\b|\byen\b|日圓|日幣",
+}
+FISCAL_WORDS = re.compile(r"fiscal|\bfy|財年|會計年度", re.IGNORECASE)
+CALENDAR_WORDS = re.compile(r"calendar|歷年|日曆", re.IGNORECASE)
+
+
+def quarter_end_dates(periods):
+    """period key 轉成該季最後一天 (numpy datetime64[D])，向量化計算"""
+    periods = np.asarray(periods, dtype="int64")
+    months = (periods // 4 - 1970) * 12 + (periods % 4 + 1) * 3
+    return months.astype("datetime64[M]") - np.timedelta64(1, "D")
+
+
+class FiscalCalendar:
+    """
+    各公司的歷年 (calendar) 與財年 (fiscal) 季度對照表。
+    財年欄位依名稱偵測 (例如 FISCAL_YEAR / FISCAL_QTR)，沒有時從逐字稿檔名中的 'Q2 2020' 解析。
+    表中沒有的季度以該公司最常見的季度差推算。
+    """
+
+    def __init__(self, df):
+        calendar = pd.Series(period_key(df["CALENDAR_YEAR"].astype("int64"), df["CALENDAR_QTR"].astype("int64")), index=df.index)
+        fiscal = self._fiscal_keys(df)
+        table = pd.DataFrame({"company": df["Company Name"].astype(str), "calendar": calendar, "fiscal": fiscal}).dropna()
+        table = table.astype({"calendar": "int64", "fiscal": "int64"}).drop_duplicates(["company", "calendar"])
+        self.offsets = (table["fiscal"] - table["calendar"]).groupby(table["company"]).agg(lambda offsets: offsets.mode().iloc[0])
+        self.to_fiscal_map = table.set_index(["company", "calendar"])["fiscal"]
+        self.to_calendar_map = table.drop_duplicates(["company", "fiscal"]).set_index(["company", "fiscal"])["calendar"]
+        self.companies = sorted(self.offsets.index)
+
+    @staticmethod
+    def _fiscal_keys(df):
+        columns = {column.lower().replace(" ", "_"): column for column in df.columns}
+        year_column = next((columns[name] for name in columns if "fiscal" in name and "year" in name), None)
+        quarter_column = next((columns[name] for name in columns if "fiscal" in name and ("qtr" in name or "quarter" in name)), None)
+        if year_column is not None and quarter_column is not None:
+            years = pd.to_numeric(df[year_column].astype(str).str.extract(r"(\d{2,4})", expand=False), errors="coerce")
+            quarters = pd.to_numeric(df[quarter_column].astype(str).str.extract(r"([1-4])", expand=False), errors="coerce")
+        else:
+            parts = df["Transcript_Filename"].astype(str).str.extract(FILENAME_PERIOD)
+            quarters, years = pd.to_numeric(parts[0], errors="coerce"), pd.to_numeric(parts[1], errors="coerce")
+        years = years.where(years >= 100, years + 2000)
+        return period_key(years, quarters)
+
+    def _convert(self, companies, keys, mapping, sign):
+        companies = pd.Index(np.asarray(companies, dtype=object))
+        keys = np.asarray(keys, dtype="int64")
+        exact = mapping.reindex(pd.MultiIndex.from_arrays([companies, keys])).to_numpy(dtype="float64")
+        estimated = keys + sign * self.offsets.reindex(companies).to_numpy(dtype="float64")
+        return np.where(np.isnan(exact), estimated, exact)
+
+    def to_fiscal(self, companies, calendar_keys):
+        """向量化轉換，回傳 float array (公司不在表中時為 NaN)"""
+        return self._convert(companies, calendar_keys, self.to_fiscal_map, 1)
+
+    def to_calendar(self, companies, fiscal_keys):
+        return self._convert(companies, fiscal_keys, self.to_calendar_map, -1)
+
+
+class FxTable:
+    """
+    有版本的匯率表，每個 (base, quote) 是依生效日期排序的匯率序列，查詢時取該日期之前最近的一筆。
+    沒有直接報價的幣別組合以反向匯率或經由 USD 換算。
+
+    :param rates: DataFrame，欄位 date, base, quote, rate
+    :param version: 匯率表版本 (來源物件的 generation 或內容 hash)
+    """
+
+    def __init__(self, rates, version):
+        self.version = version
+        rates = rates.assign(date=pd.to_datetime(rates["date"]), base=rates["base"].str.upper(), quote=rates["quote"].str.upper())
+        self.series = {}
+        for (base, quote), group in rates.sort_values("date").groupby(["base", "quote"]):
+            dates, values = group["date"].to_numpy().astype("datetime64[D]"), group["rate"].to_numpy(dtype="float64")
+            self.series[(base, quote)] = (dates, values)
+            self.series.setdefault((quote, base), (dates, 1 / values))
+        self.currencies = sorted({currency for pair in self.series for currency in pair})
+
+    def rates(self, base, quote, dates):
+        """回傳每個日期的匯率 (1 base = rate quote)，日期早於第一筆時使用第一筆"""
+        dates = np.asarray(dates, dtype="datetime64[D]")
+        if base == quote:
+            return np.ones(len(dates))
+        if (base, quote) not in self.series:
+            if base != "USD" and quote != "USD":
+                return self.rates(base, "USD", dates) * self.rates("USD", quote, dates)
+            raise KeyError(f"No FX rate for {base}/{quote}")
+        series_dates, values = self.series[(base, quote)]
+        positions = np.clip(np.searchsorted(series_dates, dates, side="right") - 1, 0, len(values) - 1)
+        return values[positions]
+
+    def latest(self, base, quote):
+        """回傳 (生效日期, 匯率)"""
+        legs = [(base, quote)] if (base, quote) in self.series else [(base, "USD"), ("USD", quote)]
+        date = max(self.series[leg][0][-1] for leg in legs)
+        return str(date), float(self.rates(base, quote, [date])[0])
+
+
+def read_fx_table(source=None):
+    """讀取匯率表，回傳 FxTable；source 為 'gs://bucket/blob'、本機 CSV 路徑或空字串 (內建匯率)"""
+    source = FX_SOURCE if source is None else source
+    if not source:
+        return FxTable(pd.DataFrame(DEFAULT_FX_RATES, columns=["date", "base", "quote", "rate"]), "builtin-1")
+    if source.startswith("gs://"):
+        bucket_name, _, blob_name = source[len("gs://"):].partition("/")
+        generation, data = default_cache().fetch(bucket_name, blob_name)
+        return FxTable(pd.read_csv(io.BytesIO(data)), f"{blob_name}@{generation}")
+    with open(source, "rb") as f:
+        data = f.read()
+    return FxTable(pd.read_csv(io.BytesIO(data)), f"{os.path.basename(source)}@{hashlib.sha256(data).hexdigest()[:12]}")
+
+
+# 已建立的查詢表: name -> (來源版本, 物件)
+_TABLES = {}
+
+
+def load_fiscal_calendar():
+    """取得財年對照表，逐字稿資料重新載入時才重建"""
+    df = load_frame(TRANSCRIPT_BUCKET, TRANSCRIPT_BLOB)
+    cached = _TABLES.get("fiscal")
+    if cached is None or cached[0] is not df:
+        cached = (df, FiscalCalendar(df))
+        _TABLES["fiscal"] = cached
+    return cached[1]
+
+
+def load_fx_table():
+    """取得匯率表，來源為 bucket 物件時以 generation 判斷是否需要重新讀取"""
+    cached = _TABLES.get("fx")
+    generation = None
+    if FX_SOURCE.startswith("gs://"):
+        bucket_name, _, blob_name = FX_SOURCE[len("gs://"):].partition("/")
+        generation = default_cache().generation(bucket_name, blob_name)
+    if cached is None or cached[0] != generation:
+        cached = (generation, read_fx_table())
+        _TABLES["fx"] = cached
+    return cached[1]
+
+
+def mentioned_currencies(query):
+    """依出現順序回傳問題中提到的幣別 (不重複)"""
+    found = [(match.start(), currency) for currency, pattern in CURRENCY_ALIASES.items() for match in re.finditer(pattern, query, re.IGNORECASE)]
+    return list(dict.fromkeys(currency for _, currency in sorted(found)))
+
+
+def answer_exchange(query, fin_index, extractor, fx_table):
+    """
+    匯率問題：有指標時以 query spec 計算後，用各季季末的匯率換算整個結果；
+    只問匯率時回傳最新匯率。無法表達時回傳 None。
+    """
+    start = time.perf_counter()
+    currencies = mentioned_currencies(query)
+    if any(currency not in fx_table.currencies for currency in currencies):
+        return None
+    parsed_query, missing = extractor.extract(query)
+    if "index" in missing:
+        # 只問匯率：提到兩種幣別時依出現順序為 base / quote，只提到一種時以 USD 為 base (只提到 USD 時換算成 TWD)
+        others = [currency for currency in currencies if currency != "USD"]
+        base, quote = currencies[:2] if len(currencies) >= 2 else ("USD", others[0] if others else "TWD")
+        date, rate = fx_table.latest(base, quote)
+        return f"1 {base} = {rate:g} {quote} (effective {date}, FX table {fx_table.version})"
+
+    # 資料以 USD 計價，換算成提到的第一個非 USD 幣別
+    currency = next((currency for currency in currencies if currency != "USD"), "TWD")
+    spec = validate_spec(parse_query(query, extractor, fin_index.companies), fin_index)
+    if spec is None:
+        return None
+    scale = lambda periods: fx_table.rates("USD", currency, quarter_end_dates(periods))
+    result = execute(spec, fin_index, scale)
+    answer = format_answer(spec, result, unit=f"{currency} Million")
+    print(f"[lookup] exchange USD->{currency} answered in {(time.perf_counter() - start) * 1000:.1f} ms", file=sys.stderr)
+    if all(metric in RATIO_METRICS for metric in spec["metrics"]) or spec["aggregation"] in ("qoq", "yoy"):
+        return answer
+    return f"{answer}\n\nConverted at quarter-end USD/{currency} rates (FX table {fx_table.version})."
+
+
+def answer_fiscal(query, fiscal_calendar, extractor):
+    """
+    歷年與財年的季度轉換。問題中的季度緊接在 fiscal / FY / 財年 之後時視為財年，換算成歷年，否則反之。
+    沒有提到季度時列出最近一年的對照。無法確定公司時回傳 None。
+    """
+    start = time.perf_counter()
+    parsed_query, missing = extractor.extract(query)
+    if "company" in missing:
+        return None
+    companies = [company.strip() for company in parsed_query["company"].split(",") if company.strip() in fiscal_calendar.offsets.index]
+    if not companies:
+        return None
+    mentions = extractor.periods(query)
+    from_fiscal = False
+    if mentions:
+        # 以緊接在第一個季度前的字判斷輸入是財年 ('fiscal 2024 Q1'、'FY2023 Q2'、'財年 2023') 還是歷年
+        before = query[max(0, mentions[0][0] - 12):mentions[0][0]]
+        from_fiscal = FISCAL_WORDS.search(before) is not None and CALENDAR_WORDS.search(before) is None
+    if mentions:
+        keys = np.unique(np.concatenate([np.arange(first, last + 1) for _, first, last, _ in mentions]))
+    else:
+        latest = int(fiscal_calendar.to_fiscal_map.index.get_level_values("calendar").max())
+        keys = np.arange(period_key(period_parts(latest)[0], 1), period_key(period_parts(latest)[0], 4) + 1)
+
+    company_column = np.repeat(companies, len(keys))
+    key_column = np.tile(keys, len(companies))
+    converted = fiscal_calendar.to_calendar(company_column, key_column) if from_fiscal else fiscal_calendar.to_fiscal(company_column, key_column)
+    calendar_column, fiscal_column = (converted, key_column) if from_fiscal else (key_column, converted)
+
+    lines = ["| company | calendar | fiscal |", "|---|---|---|"]
+    for company, calendar, fiscal in zip(company_column, calendar_column, fiscal_column):
+        calendar_label = period_label(int(calendar), " ") if calendar == calendar else "-"
+        fiscal_label = f"FY{period_label(int(fiscal), ' ')}" if fiscal == fiscal else "-"
+        lines.append(f"| {company} | {calendar_label} | {fiscal_label} |")
+    print(f"[lookup] fiscal {'fiscal->calendar' if from_fiscal else 'calendar->fiscal'} answered in {(time.perf_counter() - start) * 1000:.1f} ms", file=sys.stderr)
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Answer exchange-rate and calendar/fiscal questions from the lookup tables.")
+    parser.add_argument("command", choices=["exchange", "fiscal", "info"], help="exchange / fiscal: answer --prompt; info: show table versions")
+    parser.add_argument("--prompt", type=str, default="", help="Question to answer")
+    parser.add_argument("--dataset", type=str, default="FIN_Data", choices=list(DATASETS), help="Financial dataset for exchange questions")
+    args = parser.parse_args()
+
+    fin_index = load_index(*DATASETS[args.dataset])
+    extractor = SlotExtractor(fin_index.min_period, fin_index.max_period, fin_index.companies, fin_index.metrics)
+    if args.command == "exchange":
+        print(answer_exchange(args.prompt, fin_index, extractor, load_fx_table()))
+    elif args.command == "fiscal":
+        print(answer_fiscal(args.prompt, load_fiscal_calendar(), extractor))
+    else:
+        fx_table = load_fx_table()
+        calendar = load_fiscal_calendar()
+        print(json.dumps({
+            "fx_version": fx_table.version,
+            "fx_pairs": sorted(f"{base}/{quote}" for base, quote in fx_table.series),
+            "fiscal_offsets": {company: int(offset) for company, offset in calendar.offsets.items()},
+        }, indent=2, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
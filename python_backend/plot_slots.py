@@ -0,0 +1,207 @@
+import re
+import difflib
+
+from fin_store import period_key, period_label
+
+# 公司別名，涵蓋 plot_line_chart 描述中的中英文名稱與常見簡稱
+COMPANY_ALIASES = {
+    "Amazon": ["amazon", "amzn", "亞馬遜"],
+    "AMD": ["amd", "advanced micro devices", "超微"],
+    "Amkor": ["amkor", "艾克爾國際科技", "艾克爾"],
+    "Apple": ["apple", "aapl", "蘋果"],
+    "Applied Material": ["applied material", "applied materials", "amat", "應用材料", "應材"],
+    "Baidu": ["baidu", "百度"],
+    "Broadcom": ["broadcom", "avgo", "博通"],
+    "Cirrus Logic": ["cirrus logic", "cirrus", "思睿邏輯"],
+    "Google": ["google", "alphabet", "googl", "谷歌"],
+    "Himax": ["himax", "奇景光電", "奇景"],
+    "Intel": ["intel", "intc", "英特爾"],
+    "KLA": ["kla", "kla-tencor", "科磊"],
+    "Marvell": ["marvell", "mrvl", "邁威爾科技", "邁威爾"],
+    "Microchip": ["microchip", "mchp", "微芯科技", "微芯"],
+    "Microsoft": ["microsoft", "msft", "微軟"],
+    "Nvidia": ["nvidia", "nvda", "輝達", "英偉達"],
+    "ON Semi": ["on semi", "onsemi", "on semiconductor", "安森美"],
+    "Qorvo": ["qorvo", "威訊聯合半導體", "威訊"],
+    "Qualcomm": ["qualcomm", "qcom", "高通公司", "高通"],
+    "Samsung": ["samsung", "三星"],
+    "STM": ["stm", "stmicroelectronics", "st micro", "意法半導體", "意法"],
+    "Tencent": ["tencent", "騰訊"],
+    "Texas Instruments": ["texas instruments", "txn", "德州儀器", "德儀"],
+    "TSMC": ["tsmc", "taiwan semiconductor", "台灣積體電路製造", "台積電", "台積"],
+    "Western Digital": ["western digital", "wdc", "威騰電子", "威騰"],
+}
+
+# 指標別名，中文對應沿用 plot_line_chart 描述中的轉換 (例如 營業收入 -> Operating Income)
+METRIC_ALIASES = {
+    "Cost of Goods Sold": ["cost of goods sold", "cogs", "cost of sales", "cost of revenue", "銷貨成本", "營業成本"],
+    "Operating Expense": ["operating expense", "operating expenses", "opex", "營業費用"],
+    "Operating Income": ["operating income", "operating profit", "營業收入", "營業利益"],
+    "Revenue": ["revenue", "revenues", "sales", "net sales", "營收", "營業額", "收入"],
+    "Tax Expense": ["tax expense", "tax expenses", "income tax", "tax", "稅費", "所得稅"],
+    "Total Asset": ["total asset", "total assets", "assets", "總資產", "資產"],
+    "Gross profit margin": ["gross profit margin", "gross margin", "毛利率"],
+    "Operating margin": ["operating margin", "營業利益率", "營益率"],
+}
+
+CHINESE_NUMBERS = {"一": 1, "二": 2, "三": 3, "四": 4}
+QUARTER = r"(?:q\s?([1-4])|第?([1-4一二三四])\s?季度?)"
+# 年份與季度: '2023 Q1'、'2023_Q1'、'2023Q1'、'2023年第一季'、'2023年Q1'、'Q1 2023'
+PERIOD_PATTERNS = [
+    re.compile(r"(20\d{2})\s*(?:年|_|-|/)?\s*" + QUARTER, re.IGNORECASE),
+    re.compile(r"\b" + QUARTER.replace("第?", "") + r"\s*(?:of\s*)?(20\d{2})", re.IGNORECASE),
+]
+YEAR_PATTERN = re.compile(r"(?<!\d)(20\d{2})(?!\d)\s*年?")
+START_WORDS = re.compile(r"since|from|after|starting|以來|開始|起|之後", re.IGNORECASE)
+END_WORDS = re.compile(r"until|till|through|up to|before|截至|截止|到|至|之前", re.IGNORECASE)
+# 相對時間需要知道 "現在" 是哪一季，交給 LLM 判斷
+RELATIVE_WORDS = re.compile(r"\blast\b|\bpast\b|recent|previous|this year|next|最近|近\d|近[一二三四五六七八九十]|去年|今年|前年|上一季|本季", re.IGNORECASE)
+
+
+def _alias_pattern(alias):
+    """英文別名要求完整單字，中文別名直接比對子字串"""
+    escaped = re.escape(alias).replace(r"\ ", r"\s+")
+    return re.compile(rf"(?<![a-z0-9]){escaped}(?![a-z0-9])" if alias.isascii() else escaped, re.IGNORECASE)
+
+
+class SlotExtractor:
+    """
+    不呼叫 LLM，直接從 prompt 解析 plot_line_chart 的參數 (公司、指標、起訖季度)。
+    別名依長度由長到短比對，已被長別名佔用的位置不再比對短別名
+    (例如 '營業利益率' 不會再被當成 '營業利益'，'cost of sales' 不會再被當成 'sales')。
+
+    :param companies: 資料集中的公司名稱，會加入別名表 (China / Korea 資料集的公司不一定在內建別名中)
+    :param metrics: 資料集中的指標名稱
+    :param data_start: 資料起始 period key
+    :param data_end: 資料結束 period key
+    :param fuzzy_cutoff: difflib 模糊比對的相似度門檻
+    """
+
+    def __init__(self, data_start, data_end, companies=(), metrics=(), fuzzy_cutoff=0.85):
+        self.data_start = data_start
+        self.data_end = data_end
+        self.fuzzy_cutoff = fuzzy_cutoff
+        self.companies = self._aliases(COMPANY_ALIASES, companies)
+        self.metrics = self._aliases(METRIC_ALIASES, metrics)
+
+    @staticmethod
+    def _aliases(table, names):
+        aliases = {alias.lower(): name for name, items in table.items() for alias in [name, *items]}
+        for name in names:
+            aliases.setdefault(str(name).lower(), str(name))
+        ordered = sorted(aliases.items(), key=lambda item: -len(item[0]))
+        return [(alias, name, _alias_pattern(alias)) for alias, name in ordered]
+
+    def _match(self, text, aliases, claimed):
+        """回傳 [(位置, 正式名稱)]，claimed 記錄已被佔用的字元範圍"""
+        found = []
+        for _, name, pattern in aliases:
+            for match in pattern.finditer(text):
+                if any(match.start() < end and start < match.end() for start, end in claimed):
+                    continue
+                claimed.append(match.span())
+                found.append((match.start(), name))
+        return found
+
+    def _fuzzy(self, text, aliases, claimed):
+        """對尚未被比對到的英文單字 (與連續兩三個單字) 做模糊比對，處理 'Nvida'、'Qualcom' 這類拼字錯誤"""
+        english = {alias: name for alias, name, _ in aliases if alias.isascii() and len(alias) >= 4}
+        words = [match for match in re.finditer(r"[a-z][a-z\-]+", text, re.IGNORECASE)
+                 if not any(match.start() < end and start < match.end() for start, end in claimed)]
+        found = []
+        for size in (3, 2, 1):
+            for i in range(len(words) - size + 1):
+                start, end = words[i].start(), words[i + size - 1].end()
+                if any(start < claimed_end and claimed_start < end for claimed_start, claimed_end in claimed):
+                    continue
+                candidate = " ".join(word.group().lower() for word in words[i:i + size])
+                if len(candidate) < 4:
+                    continue
+                close = difflib.get_close_matches(candidate, english, n=1, cutoff=self.fuzzy_cutoff)
+                if close:
+                    claimed.append((start, end))
+                    found.append((start, english[close[0]]))
+        return found
+
+    def _names(self, text, aliases, claimed):
+        found = self._match(text, aliases, claimed) + self._fuzzy(text, aliases, claimed)
+        return list(dict.fromkeys(name for _, name in sorted(found)))
+
+    def periods(self, text, claimed=None):
+        """回傳 [(位置, 起始 key, 結束 key, 是否只有年份)]，單獨的年份代表該年的 Q1 到 Q4"""
+        claimed = [] if claimed is None else claimed
+        mentions = []
+        for pattern in PERIOD_PATTERNS:
+            for match in pattern.finditer(text):
+                if any(match.start() < end and start < match.end() for start, end in claimed):
+                    continue
+                claimed.append(match.span())
+                groups = [group for group in match.groups() if group]
+                year = int(next(group for group in groups if len(group) == 4))
+                quarter = next(group for group in groups if len(group) == 1)
+                quarter = CHINESE_NUMBERS.get(quarter) or int(quarter)
+                key = period_key(year, quarter)
+                mentions.append((match.start(), key, key, False))
+        for match in YEAR_PATTERN.finditer(text):
+            if any(match.start() < end and start < match.end() for start, end in claimed):
+                continue
+            year = int(match.group(1))
+            mentions.append((match.start(), period_key(year, 1), period_key(year, 4), True))
+        return sorted(mentions)
+
+    def _time_range(self, text, claimed):
+        """
+        回傳 (start_key, end_key, resolved)。
+        只提到年份時以資料範圍為界 (例如 '2024' 代表 2024 Q1 到資料最後一季)，
+        明確的季度則保留原值，由呼叫端檢查是否超出資料範圍。
+        """
+        mentions = self.periods(text, claimed)
+        if not mentions:
+            if RELATIVE_WORDS.search(text):
+                return None, None, False
+            return self.data_start, self.data_end, True
+        first, last = mentions[0], mentions[-1]
+        start, end = first[1], last[2]
+        if len(mentions) == 1:
+            before, after = text[:first[0]], text[first[0]:]
+            # 'since 2021'、'2021年以來' 只指定起點；'until 2023 Q2' 只指定終點
+            if START_WORDS.search(before) or (START_WORDS.search(after) and not END_WORDS.search(text)):
+                end = self.data_end
+            elif END_WORDS.search(before):
+                start = self.data_start
+        if first[3]:
+            start = max(start, self.data_start)
+        if last[3]:
+            end = min(end, self.data_end)
+        return start, end, True
+
+    def extract(self, query, claimed=None):
+        """
+        回傳 (parsed_query, missing)。
+        parsed_query 與 parse_user_query_with_gemini 的格式相同:
+          {"company": "Apple, Nvidia", "index": ["Revenue"], "start_time": "2020_Q1", "end_time": "2024_Q3"}
+        missing 為無法在本機解析的欄位名稱，需要交給 LLM。
+
+        :param claimed: 傳入 list 時會填入已解析的字元範圍，供呼叫端判斷剩下的文字
+        """
+        claimed = [] if claimed is None else claimed
+        companies = self._names(query, self.companies, claimed)
+        metrics = self._names(query, self.metrics, claimed)
+        start, end, time_resolved = self._time_range(query, claimed)
+
+        parsed_query = {}
+        missing = []
+        if companies:
+            parsed_query["company"] = ", ".join(companies)
+        else:
+            missing.append("company")
+        if metrics:
+            parsed_query["index"] = metrics
+        else:
+            missing.append("index")
+        if time_resolved:
+            parsed_query["start_time"] = period_label(start)
+            parsed_query["end_time"] = period_label(end)
+        else:
+            missing.extend(["start_time", "end_time"])
+        return parsed_query, missing
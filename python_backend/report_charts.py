@@ -0,0 +1,206 @@
+import os
+import json
+import shutil
+
+
+def planned_charts(df_pivot):
+    """
+    依可用的欄位與資料筆數決定要產生的圖表，回傳 [(type, description), ...]。
+    當可用季度資料少於 3 筆時，不生成趨勢圖與成長率圖表。
+    """
+    n = len(df_pivot)  # 可用資料筆數
+    columns = set(df_pivot.columns)
+    charts = []
+    if n >= 3 and {"Revenue", "Operating Income"}.issubset(columns):
+        charts.append(("trend", "Revenue & Operating Income Trend"))
+    if {"Revenue", "Cost of Goods Sold", "Operating Expense", "Operating Income", "Tax Expense"}.issubset(columns):
+        charts.append(("bar", "Cost Structure per Quarter"))
+    if {"Gross Margin", "Operating Margin", "Net Margin"}.issubset(columns):
+        charts.append(("table", "Financial Ratios Table"))
+    if n >= 3 and {"Revenue", "Operating Income"}.issubset(columns):
+        charts.append(("growth", "Revenue and Operating Income Growth Rate"))
+    return charts
+
+
+def growth_rate(df_pivot, metric):
+    """環比成長率 (%)，prepare_data 已由 metrics cube 取出季增率時直接使用 (缺季時不會與前一列錯位)"""
+    column = f"{metric} QoQ"
+    if column in df_pivot.columns:
+        return df_pivot[column] * 100
+    return df_pivot[metric].pct_change() * 100
+
+
+def render_chart(chart_type, df_pivot, company, fig_path):
+    """繪製單一圖表並存到 fig_path，matplotlib 只在實際繪圖時載入"""
+    import matplotlib.pyplot as plt
+
+    # 1. 趨勢圖：Revenue 與 Operating Income 趨勢圖
+    if chart_type == "trend":
+        plt.figure(figsize=(10,6))
+        plt.plot(df_pivot["Period"], df_pivot["Revenue"], marker="o", label="Revenue")
+        plt.plot(df_pivot["Period"], df_pivot["Operating Income"], marker="o", label="Operating Income")
+        plt.xlabel("Period")
+        plt.ylabel("Amount (Million USD)")
+        plt.title(f"{company} Revenue & Operating Income Trend")
+        plt.xticks(rotation=45)
+        plt.legend()
+        plt.tight_layout()
+
+    # 2. 群組長條圖：各季度成本結構 (Revenue, COGS, Operating Expense, Operating Income, Tax Expense)
+    elif chart_type == "bar":
+        periods = df_pivot["Period"]
+        bar_width = 0.15
+        index = range(len(periods))
+        plt.figure(figsize=(12,6))
+        plt.bar([i - 2*bar_width for i in index], df_pivot["Revenue"], width=bar_width, label="Revenue")
+        plt.bar([i - bar_width for i in index], df_pivot["Cost of Goods Sold"], width=bar_width, label="COGS")
+        plt.bar(index, df_pivot["Operating Expense"], width=bar_width, label="Operating Expense")
+        plt.bar([i + bar_width for i in index], df_pivot["Operating Income"], width=bar_width, label="Operating Income")
+        plt.bar([i + 2*bar_width for i in index], df_pivot["Tax Expense"], width=bar_width, label="Tax Expense")
+        plt.xlabel("Period")
+        plt.xticks(index, periods, rotation=45)
+        plt.ylabel("Amount (Million USD)")
+        plt.title(f"{company} Cost Structure by Period")
+        plt.legend()
+        plt.tight_layout()
+
+    # 3. 財務比率表：prepare_data 算好的毛利率、營業利益率、簡易淨利率，以表格呈現
+    elif chart_type == "table":
+        ratio_table = df_pivot[["Period", "Gross Margin", "Operating Margin", "Net Margin"]]
+        fig, ax = plt.subplots(figsize=(8, len(ratio_table)*0.5 + 1))
+        ax.axis('tight')
+        ax.axis('off')
+        table = ax.table(cellText=ratio_table.round(2).values,
+                         colLabels=ratio_table.columns,
+                         cellLoc='center', loc='center')
+        plt.title(f"{company} Financial Ratios")
+        fig.tight_layout()
+
+    # 4. 成長率趨勢圖：計算 Revenue 與 Operating Income 的環比成長率
+    elif chart_type == "growth":
+        df_pivot = df_pivot.sort_values(by=["CALENDAR_YEAR", "CALENDAR_QTR"])
+        df_pivot["Revenue Growth Rate"] = growth_rate(df_pivot, "Revenue")
+        df_pivot["Operating Income Growth Rate"] = growth_rate(df_pivot, "Operating Income")
+
+        plt.figure(figsize=(10, 6))
+        plt.plot(df_pivot["Period"], df_pivot["Revenue Growth Rate"], marker='o', label="Revenue Growth Rate")
+        plt.plot(df_pivot["Period"], df_pivot["Operating Income Growth Rate"], marker='o', label="Operating Income Growth Rate")
+        plt.title(f"{company} Growth Rates")
+        plt.xlabel("Period")
+        plt.ylabel("Growth Rate (%)")
+        plt.legend()
+        plt.grid(True)
+        plt.xticks(rotation=45)
+        plt.tight_layout()
+
+    plt.savefig(fig_path)
+    plt.close()
+
+
+def _values(column):
+    """數值欄位轉成 JSON 可表示的 list，NaN (例如第一季的成長率) 以 null 表示"""
+    return [None if value != value else round(float(value), 4) for value in column]
+
+
+def chart_spec(chart_type, df_pivot, company):
+    """
+    與 render_chart 相同的圖表，以 JSON 結構 (x 標籤、各序列數值、單位、標題) 回傳，
+    交給前端繪製，不需要載入 matplotlib。
+    """
+    periods = [str(period) for period in df_pivot["Period"]]
+    if chart_type == "trend":
+        return {
+            "chart": "line",
+            "title": f"{company} Revenue & Operating Income Trend",
+            "x_label": "Period",
+            "y_label": "Amount (Million USD)",
+            "unit": "USD Million",
+            "x": periods,
+            "series": [{"name": name, "values": _values(df_pivot[name])} for name in ["Revenue", "Operating Income"]],
+        }
+    if chart_type == "bar":
+        return {
+            "chart": "bar",
+            "title": f"{company} Cost Structure by Period",
+            "x_label": "Period",
+            "y_label": "Amount (Million USD)",
+            "unit": "USD Million",
+            "x": periods,
+            "series": [
+                {"name": "COGS" if name == "Cost of Goods Sold" else name, "values": _values(df_pivot[name])}
+                for name in ["Revenue", "Cost of Goods Sold", "Operating Expense", "Operating Income", "Tax Expense"]
+            ],
+        }
+    if chart_type == "table":
+        columns = ["Gross Margin", "Operating Margin", "Net Margin"]
+        return {
+            "chart": "table",
+            "title": f"{company} Financial Ratios",
+            "unit": "ratio",
+            "columns": ["Period"] + columns,
+            "rows": [[period] + _values(row) for period, row in zip(periods, df_pivot[columns].round(2).to_numpy())],
+        }
+    if chart_type == "growth":
+        df_pivot = df_pivot.sort_values(by=["CALENDAR_YEAR", "CALENDAR_QTR"])
+        return {
+            "chart": "line",
+            "title": f"{company} Growth Rates",
+            "x_label": "Period",
+            "y_label": "Growth Rate (%)",
+            "unit": "%",
+            "x": [str(period) for period in df_pivot["Period"]],
+            "series": [
+                {"name": "Revenue Growth Rate", "values": _values(growth_rate(df_pivot, "Revenue"))},
+                {"name": "Operating Income Growth Rate", "values": _values(growth_rate(df_pivot, "Operating Income"))},
+            ],
+        }
+    raise ValueError(f"Unknown chart type: {chart_type}")
+
+
+def chart_data(df_pivot, company, report_dir):
+    """
+    產生所有圖表的 JSON 資料並寫入 report_dir/charts.json，回傳 visualizations 列表。
+    每筆 visualization 的 path 指向 charts.json，chart 為其中的索引。
+    """
+    charts = []
+    visualizations = []
+    charts_path = os.path.join(report_dir, "charts.json")
+    for chart_type, description in planned_charts(df_pivot):
+        charts.append(chart_spec(chart_type, df_pivot, company))
+        visualizations.append({
+            "type": chart_type,
+            "path": charts_path,
+            "chart": len(charts) - 1,
+            "description": description
+        })
+    with open(charts_path, "w", encoding="utf-8") as f:
+        json.dump(charts, f, ensure_ascii=False, separators=(",", ":"))
+    return visualizations
+
+
+def chart_keys(store, df_pivot, cache_spec, dataset_version):
+    """回傳每張要產生的圖表在 ChartStore 中的 key"""
+    return [store.key(chart_type, cache_spec, dataset_version) for chart_type, _ in planned_charts(df_pivot)]
+
+
+def render_visualizations(df_pivot, company, report_dir, store=None, cache_spec=None, dataset_version=None):
+    """
+    根據透視後的季度財務數據產生報告用的圖表與表格，回傳 visualizations 列表。
+    有 store 時以 (cache_spec, dataset_version) 查快取，命中的圖表直接複製到 report_dir。
+    只依賴參數、不使用全域狀態，可在獨立的 process 中執行。
+    """
+    visualizations = []
+    for chart_type, description in planned_charts(df_pivot):
+        fig_path = os.path.join(report_dir, f"visualization_{len(visualizations)}.png")
+        if store is None:
+            render_chart(chart_type, df_pivot, company, fig_path)
+        else:
+            key = store.key(chart_type, cache_spec, dataset_version)
+            cached_path = store.get_or_render(key, lambda path: render_chart(chart_type, df_pivot, company, path))
+            shutil.copyfile(cached_path, fig_path)
+        visualizations.append({
+            "type": chart_type,
+            "path": fig_path,
+            "description": description
+        })
+    return visualizations
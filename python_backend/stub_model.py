@@ -0,0 +1,39 @@
+import os
+import time
+from types import SimpleNamespace
+
+# 路由呼叫回傳的 function call、串流時每段之間的間隔 (秒)
+STUB_INTENT = os.environ.get("MARKETAGENT_STUB_INTENT", "rag_retrieval")
+STUB_DELAY = float(os.environ.get("MARKETAGENT_STUB_DELAY", 0.05))
+
+
+def _response(text="", function_call=None):
+    part = SimpleNamespace(text=text, function_call=function_call)
+    return SimpleNamespace(text=text, candidates=[SimpleNamespace(content=SimpleNamespace(parts=[part]))])
+
+
+class StubModel:
+    """
+    不連線的替代 GenerativeModel (chat.py 在 MARKETAGENT_STUB_MODEL=1 時使用)，
+    用於在沒有 Vertex AI 的環境測試串流輸出與 route.ts。
+    路由呼叫 (有 tool_config) 回傳 STUB_INTENT 的 function call；其他呼叫回傳固定的回答，stream=True 時逐字分段回傳。
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.calls = 0
+
+    def _answer(self, prompt):
+        question = prompt.rsplit("Question:", 1)[-1].strip()
+        return f"Stub answer to: {question[:200]}"
+
+    def _chunks(self, text):
+        for word in text.split(" "):
+            time.sleep(STUB_DELAY)
+            yield _response(word + " ")
+
+    def generate_content(self, prompt, stream=False, tools=None, tool_config=None, **kwargs):
+        self.calls += 1
+        if tool_config is not None:
+            return _response(function_call=SimpleNamespace(name=STUB_INTENT, args={}))
+        answer = self._answer(prompt if isinstance(prompt, str) else str(prompt))
+        return self._chunks(answer) if stream else _response(answer)
@@ -1,18 +1,31 @@
 import os
 import io
+import time
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from typing import Dict, List, TypedDict, Annotated
 from datetime import datetime
-from langgraph.graph import Graph, StateGraph
+from langgraph.graph import Graph, StateGraph, START
 from langchain_google_vertexai import VertexAI
 from langgraph.prebuilt import ToolExecutor
+import numpy as np
 import pandas as pd
-import matplotlib.pyplot as plt
 from vertexai.generative_models import GenerationConfig, GenerativeModel
-from google.cloud import aiplatform, storage
+from google.cloud import aiplatform
+from bucket_cache import default_cache
+from analysis_memo import AnalysisMemo, prompt_version
+from chart_cache import chart_store
+from fin_cube import DERIVED_METRICS, load_cube
+from fin_store import frame_version, load_frame, load_index, period_key, period_label, period_labels, period_parts
+from report_charts import chart_data, chart_keys, render_visualizations
+from transcript_chunks import merge_analyses, split_transcript
+from transcripts import TRANSCRIPT_BUCKET, load_catalog, load_transcript_text, transcript_blob
+import csv
 import json
-import seaborn as sns
 import datetime
 import argparse
+import hashlib
 
 now = datetime.datetime.now()
 
@@ -20,11 +33,9 @@ now = datetime.datetime.now()
 formatted_time = now.strftime("%Y%m%d-%H-%M-%S")
 
 REPORT_DIR = f"summarize_reports/{formatted_time}"
-os.makedirs(REPORT_DIR, exist_ok=True)
 
 PROJECT_ID = PROJECT_ID
 REGION = "us-central1"
-aiplatform.init(project=PROJECT_ID, location=REGION)
 
 # 假設 VertexAI、GenerationConfig、Graph、StateGraph 等工具已正確引入
 # 以下為示例，請確保實際使用時這些工具正確導入
@@ -37,13 +48,8 @@ def load_csv_from_bucket(bucket_name, blob_name):
     :param blob_name: CSV 檔案在 bucket 中的路徑或名稱
     """
     # print(f"Loading CSV file from bucket {bucket_name} with blob name {blob_name}")
-    # 建立 Storage client
-    client = storage.Client()
-    bucket = client.bucket(bucket_name)
-    blob = bucket.blob(blob_name)
-    
-    # 直接從 blob 讀取資料（bytes 格式），並解碼成字串
-    csv_bytes = blob.download_as_string()
+    # 透過共用的快取讀取，物件 generation 未變動時不重新下載
+    csv_bytes = default_cache().get_bytes(bucket_name, blob_name)
     csv_str = csv_bytes.decode('utf-8')
     
     # 使用 io.StringIO 將字串轉換成檔案物件，供 csv.reader 使用
@@ -51,91 +57,52 @@ def load_csv_from_bucket(bucket_name, blob_name):
     return csv_file
 
 def load_transcript_from_bucket(bucket_name, blob_name):
-    client = storage.Client()
-    bucket = client.bucket(bucket_name)
-    blob = bucket.blob(blob_name)
-    
-    # 直接從 blob 讀取資料（bytes 格式），並解碼成字串
-    transcript_bytes = blob.download_as_string()
-    transcript_str = transcript_bytes.decode('utf-8')
+    # 讀過的逐字稿直接從本機文字快取讀取，沒有時才經由共用的快取下載
+    transcript_str = load_transcript_text(bucket_name, blob_name)
     
     # 使用 io.StringIO 將字串轉換成檔案物件，供 transcript.reader 使用
     transcript_file = io.StringIO(transcript_str)
     return transcript_file
 
 def find_transcript_name(company, year, quarter):
-    df = pd.read_csv('python_backend/TRANSCRIPT_Data.csv')
-    result = df[(df['Company Name'] == company) & (df['CALENDAR_YEAR'] == year) & (df['CALENDAR_QTR'] == quarter)]
-
-    if not result.empty:
-        return result.iloc[0]['Transcript_Filename']
-    else:
-        return None
+    # 以 (公司, 年, 季) 查預先建立的逐字稿目錄，不需要每次讀取並過濾整份清單
+    entry = load_catalog().get(company, year, quarter)
+    return entry["filename"] if entry is not None else None
 
 
-class AnalysisState(TypedDict):
-    csv_path: str
-    transcript_path: str
-    company: str
-    year: int
-    quarter: int
-    data_analysis: Dict | None
-    transcript_analysis: Dict | None
-    visualizations: List[Dict] | None
-    report_path: str | None
+class RateLimiter:
+    """
+    以固定間隔發放呼叫額度的限流器，多個 thread 共用時合計每分鐘最多 requests_per_minute 次。
+    requests_per_minute 為 0 時不限制。
+    """
 
-class ReportGeneratorAgent:
-    def __init__(self):
-        self.model = VertexAI(model_name="gemini-1.5-pro")
-        self.tools = self._create_tools()
-        self.graph = self._create_graph()
-    
-    def _create_tools(self):
-        return {
-            "analyze_data": self._analyze_csv_data,
-            "analyze_transcript": self._analyze_transcript,
-            "create_visualization": self._create_visualization,
-            "generate_report": self._generate_final_report,
-            "self_evaluation": self._self_evaluation  # 新增自我評估工具
-        }
-    
-    def _analyze_csv_data(self, state: AnalysisState) -> AnalysisState:
-        """分析 CSV 數據，僅使用指定 Company 且年份小於傳入 Year，或年份等於傳入 Year 且 Quarter 小於等於傳入的資料"""
-        csv_file = load_csv_from_bucket("careerhack2025-bsid-resource-bucket", f"FIN_Data.csv")
-        df = pd.read_csv(csv_file)
-        # 過濾 Company
-        df = df[df["Company Name"] == state["company"]]
-        # 確保 CALENDAR_YEAR 為整數
-        df["CALENDAR_YEAR"] = df["CALENDAR_YEAR"].astype(int)
-        # 將 CALENDAR_QTR 轉換為整數（假設其格式中包含數字）
-        df["CALENDAR_QTR"] = df["CALENDAR_QTR"].str.extract('(\d+)').astype(int)
-        # 過濾條件：若 CALENDAR_YEAR 小於傳入的 Year，則保留所有；若等於，則保留 Quarter <= 傳入的 Quarter
-        df = df[
-            (df["CALENDAR_YEAR"] < state["year"]) |
-            ((df["CALENDAR_YEAR"] == state["year"]) & (df["CALENDAR_QTR"] <= state["quarter"]))
-        ]
-        # 新增 "Period" 欄位作為時間標籤 (例如 "2020 Q1")
-        df["Period"] = df["CALENDAR_YEAR"].astype(str) + " Q" + df["CALENDAR_QTR"].astype(str)
-        df = df.sort_values(by=["CALENDAR_YEAR", "CALENDAR_QTR"])
-        
-        # 基本統計分析
-        analysis = {
-            "row_count": len(df),
-            "column_count": len(df.columns),
-            "numerical_columns": df.select_dtypes(include=['float64', 'int64']).columns.tolist(),
-            "categorical_columns": df.select_dtypes(include=['object']).columns.tolist(),
-            "basic_stats": df.describe().to_dict()
-        }
-        state["data_analysis"] = analysis
-        # 將處理後的 DataFrame 存入 state 中，以便後續視覺化使用（可選）
-        state["data_analysis"]["filtered_df"] = df.to_dict(orient="list")
-        return state
-    
-    def _analyze_transcript(self, state: AnalysisState) -> AnalysisState:
-        """分析逐字稿內容"""
-        transcript = state["transcript_path"].getvalue()
-        
-        prompt = f"""
+    def __init__(self, requests_per_minute: float = 0):
+        self.interval = 60.0 / requests_per_minute if requests_per_minute else 0
+        self._next = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            wait = self._next - now
+            self._next = max(now, self._next) + self.interval
+        if wait > 0:
+            time.sleep(wait)
+
+
+# 財報資料在 bucket 中的位置
+FIN_BUCKET = "careerhack2025-bsid-resource-bucket"
+FIN_BLOB = "FIN_Data.csv"
+# 成長率欄位的後綴，例如 "Revenue QoQ"
+GROWTH_SUFFIXES = {"qoq": "QoQ", "yoy": "YoY"}
+# metrics cube 的衍生指標在報告圖表中使用的欄位名稱
+REPORT_COLUMNS = {"Gross profit margin": "Gross Margin", "Operating margin": "Operating Margin", "Net margin": "Net Margin"}
+
+
+# 逐字稿分析的 prompt 與 response schema，內容的 hash 是分析結果快取的版本，修改任何一個時舊的結果自動失效
+TRANSCRIPT_PROMPT = """
         You are a financial analyst with expertise in corporate earnings reports, market trends, and financial data interpretation. Your task is to analyze the following transcript and extract key insights to assist in generating a high-quality financial report.
 
         Please analyze the following transcript and provide:
@@ -175,198 +142,311 @@ class ReportGeneratorAgent:
 
         Please return the analysis in JSON format.
         """
-        response_schema = {
-            "type": "ARRAY",
-            "items": {
-                "type": "OBJECT",
-                "properties": {
-                    "topic": {
-                        "type": "STRING",
-                        "description": "Main subject or section from the earnings call"
-                    },
-                    "critical_point": {
-                        "type": "ARRAY",
-                        "items": {
-                            "type": "OBJECT",
-                            "properties": {
-                                "summary": {
-                                    "type": "STRING",
-                                    "description": "Key takeaway or insight from this topic"
-                                },
-                                "data": {
-                                    "type": "ARRAY",
-                                    "items": {
-                                        "type": "STRING",
-                                        "description": "Relevant financial figures, trends, or direct quotes"
-                                    }
-                                }
-                            },
-                            "required": ["summary", "data"]
+TRANSCRIPT_SCHEMA = {
+    "type": "ARRAY",
+    "items": {
+        "type": "OBJECT",
+        "properties": {
+            "topic": {
+                "type": "STRING",
+                "description": "Main subject or section from the earnings call"
+            },
+            "critical_point": {
+                "type": "ARRAY",
+                "items": {
+                    "type": "OBJECT",
+                    "properties": {
+                        "summary": {
+                            "type": "STRING",
+                            "description": "Key takeaway or insight from this topic"
                         },
-                        "description": "A list of key insights, including financial metrics, market trends, and management outlook"
-                    }
+                        "data": {
+                            "type": "ARRAY",
+                            "items": {
+                                "type": "STRING",
+                                "description": "Relevant financial figures, trends, or direct quotes"
+                            }
+                        }
+                    },
+                    "required": ["summary", "data"]
                 },
-                "required": ["topic", "critical_point"]
+                "description": "A list of key insights, including financial metrics, market trends, and management outlook"
             }
+        },
+        "required": ["topic", "critical_point"]
+    }
+}
+TRANSCRIPT_PROMPT_VERSION = prompt_version(TRANSCRIPT_PROMPT, TRANSCRIPT_SCHEMA)
+# 切片分析時加在每個片段 prompt 前面的說明
+TRANSCRIPT_CHUNK_NOTE = """
+        The transcript below is part {part} of {parts} of the earnings call. Only report what this part contains; the parts are analyzed separately and merged afterwards.
+"""
+
+
+def report_pivot(fin_index, cube, company: str, start: int | None, end: int | None, growth_kinds=("qoq",)) -> pd.DataFrame:
+    """
+    單一公司每季一列的透視資料、財務比率與成長率 (欄位 "Revenue QoQ" 等)，前三欄為 Period、CALENDAR_YEAR、CALENDAR_QTR。
+    金額與財務比率由 FinIndex 的原始數值計算 (cube 為 float32，大額的營收與資產會失去精度)，
+    成長率由 metrics cube 取出。
+    """
+    columns = {}
+    for metric in fin_index.metrics:
+        periods, values = fin_index.lookup(company, metric, start, end)
+        if len(periods):
+            # 同一季重複的資料列與 pivot_table 相同取平均
+            columns[metric] = pd.Series(values.astype("float64"), index=periods).groupby(level=0).mean()
+    df_pivot = pd.DataFrame(columns).sort_index()
+    with np.errstate(divide="ignore", invalid="ignore"):
+        for metric, (inputs, formula) in DERIVED_METRICS.items():
+            if set(inputs) <= set(df_pivot.columns):
+                df_pivot[metric] = formula(df_pivot)
+    df_pivot = df_pivot.replace([np.inf, -np.inf], np.nan)
+    growth_metrics = [metric for metric in ["Revenue", "Operating Income"] if metric in cube.metric_pos]
+    for kind in growth_kinds:
+        growth = cube.wide([company], growth_metrics, start, end, kind)
+        df_pivot = df_pivot.join(growth.droplevel("company").add_suffix(f" {GROWTH_SUFFIXES[kind]}"))
+    df_pivot = df_pivot.dropna(axis=1, how="all").rename(columns=REPORT_COLUMNS)
+    periods = df_pivot.index.to_numpy()
+    df_pivot = df_pivot.reset_index(drop=True)
+    df_pivot.insert(0, "Period", period_labels(periods, sep=" ").to_numpy())
+    df_pivot.insert(1, "CALENDAR_YEAR", periods // 4)
+    df_pivot.insert(2, "CALENDAR_QTR", periods % 4 + 1)
+    return df_pivot
+
+
+# 多季趨勢報告的合成 prompt，輸入為每季的精簡摘要而不是原始逐字稿
+RANGE_PROMPT = """
+        You are a financial analyst. Using the per-quarter digests below (reported figures and key points from each earnings call), write a trend report on {company} covering {first} to {last}.
+
+        Per-quarter digests:
+        {digests}
+
+        Please generate a well-structured report in English, including:
+        - Executive Summary of the multi-quarter trend
+        - Revenue, profitability and margin trends with the figures that support them
+        - How management's guidance and priorities changed from quarter to quarter
+        - Recurring and emerging risks
+        - Conclusions and Outlook
+
+        Format Requirement: Markdown Format
+"""
+# 季度摘要中列出的財務指標 (growth 為百分比以外的比率)
+DIGEST_METRICS = [
+    "Revenue", "Revenue QoQ", "Revenue YoY", "Operating Income", "Operating Income QoQ", "Operating Income YoY",
+    "Gross Margin", "Operating Margin", "Net Margin",
+]
+
+
+def quarter_digest(period: str, row: pd.Series | None, analysis: List[Dict] | None, points_per_topic: int = 2) -> Dict:
+    """單季的精簡摘要：主要財務指標與逐字稿分析每個主題的前幾個重點 (只保留 summary，不含 data)"""
+    metrics = {} if row is None else {name: round(float(row[name]), 4) for name in DIGEST_METRICS if name in row.index and row[name] == row[name]}
+    highlights = [
+        {"topic": item["topic"], "points": [point["summary"] for point in item.get("critical_point", [])[:points_per_topic]]}
+        for item in analysis or []
+    ]
+    return {"period": period, "metrics": metrics, "highlights": highlights}
+
+
+def merge_dicts(left: Dict, right: Dict) -> Dict:
+    """平行的節點各自回傳 timings，以合併取代覆寫"""
+    return {**(left or {}), **(right or {})}
+
+
+class AnalysisState(TypedDict):
+    transcript_path: str
+    company: str
+    year: int
+    quarter: int
+    report_dir: str
+    dataset_version: str | None
+    filtered_df: pd.DataFrame | None
+    pivot_df: pd.DataFrame | None
+    data_analysis: Dict | None
+    transcript_analysis: Dict | None
+    visualizations: List[Dict] | None
+    report_path: str | None
+    started_at: float
+    timings: Annotated[Dict, merge_dicts]
+
+class ReportGeneratorAgent:
+    """
+    :param parallel: True 時彼此獨立的節點平行執行 (逐字稿分析與資料分析、圖表同時進行)，
+                     False 時維持原本依序執行的流程
+    :param rate_limiter: 所有 LLM 呼叫前先取得額度，批次模式下由多個報告共用
+    :param chart_workers: 繪圖 process 的數量
+    :param chart_format: 'json' 時圖表以資料寫入 charts.json 交給前端繪製，'png' 時以 matplotlib 繪圖
+    :param memo: 逐字稿分析結果的快取，None 時每次都呼叫 LLM
+    :param chunk_tokens: 逐字稿超過此 token 數 (估計值) 時依發言切成多個片段分別分析再合併，0 時一律整份分析
+    :param chunk_workers: 同時分析的片段數
+    """
+
+    def __init__(self, parallel: bool = True, rate_limiter: RateLimiter | None = None, chart_workers: int = 1, chart_format: str = "png", memo: AnalysisMemo | None = None, chunk_tokens: int = 0, chunk_workers: int = 4):
+        aiplatform.init(project=PROJECT_ID, location=REGION)
+        self.model_name = "gemini-1.5-pro"
+        self.model = VertexAI(model_name=self.model_name)
+        self.memo = memo
+        self.chunk_tokens = chunk_tokens
+        self.chunk_workers = chunk_workers
+        self.parallel = parallel
+        self.rate_limiter = rate_limiter or RateLimiter()
+        self.chart_workers = chart_workers
+        self.chart_format = chart_format
+        self._chart_executor = None
+        self._chart_executor_lock = threading.Lock()
+        # 報告圖表的快取，相同公司、季度與資料版本的圖表不重新繪製
+        self.chart_store = chart_store(os.path.join("summarize_reports", "chart_cache"), "report_chart_")
+        self.tools = self._create_tools()
+        self.graph = self._create_graph()
+    
+    def close(self):
+        """結束繪圖 process"""
+        with self._chart_executor_lock:
+            if self._chart_executor is not None:
+                self._chart_executor.shutdown()
+                self._chart_executor = None
+
+    def _create_tools(self):
+        return {
+            "prepare_data": self._prepare_data,
+            "analyze_data": self._analyze_csv_data,
+            "analyze_transcript": self._analyze_transcript,
+            "create_visualization": self._create_visualization,
+            "generate_report": self._generate_final_report,
+            "self_evaluation": self._self_evaluation  # 新增自我評估工具
+        }
+    
+    def _prepare_data(self, state: AnalysisState) -> AnalysisState:
+        """
+        讀取一次財報資料並整理給後續節點共用：
+        僅保留指定 Company 且年份小於傳入 Year，或年份等於傳入 Year 且 Quarter 小於等於傳入的資料，
+        並由 metrics cube 取出每季一列的透視資料與財務比率。
+        """
+        counters_before = dict(default_cache().counters)
+        load_start = time.perf_counter()
+        # store 中的 CALENDAR_YEAR / CALENDAR_QTR 已是整數，並有整數的 PERIOD 鍵值
+        df = load_frame(FIN_BUCKET, FIN_BLOB)
+        load_seconds = time.perf_counter() - load_start
+        # 過濾 Company
+        df = df[df["Company Name"] == state["company"]]
+        # 過濾條件：若 CALENDAR_YEAR 小於傳入的 Year，則保留所有；若等於，則保留 Quarter <= 傳入的 Quarter
+        df = df[df["PERIOD"] <= period_key(state["year"], state["quarter"])]
+        # 新增 "Period" 欄位作為時間標籤 (例如 "2020 Q1")
+        df = df.assign(Period=period_labels(df["PERIOD"], sep=" "), Index=df["Index"].astype(str))
+        df = df.sort_values(by="PERIOD")
+
+        # 每季一列的透視資料與財務比率 (毛利率、營業利益率、簡易淨利率)、季增率由 metrics cube 取出，
+        # cube 每個資料版本只建立一次，不需要每份報告重新 pivot 與計算
+        pivot_start = time.perf_counter()
+        cube = load_cube(FIN_BUCKET, FIN_BLOB)
+        df_pivot = report_pivot(load_index(FIN_BUCKET, FIN_BLOB), cube, state["company"], None, period_key(state["year"], state["quarter"]))
+        pivot_seconds = time.perf_counter() - pivot_start
+
+        counters = default_cache().counters
+        return {
+            "dataset_version": frame_version(FIN_BUCKET, FIN_BLOB),
+            "filtered_df": df,
+            "pivot_df": df_pivot,
+            "timings": {"prepare_data": {
+                "downloads": counters["misses"] - counters_before["misses"],
+                "bytes_downloaded": counters["bytes_downloaded"] - counters_before["bytes_downloaded"],
+                "cache_hits": counters["memory_hits"] + counters["disk_hits"] - counters_before["memory_hits"] - counters_before["disk_hits"],
+                "load_frame_seconds": load_seconds,
+                "pivot_seconds": pivot_seconds,
+            }},
         }
+
+    def _analyze_csv_data(self, state: AnalysisState) -> AnalysisState:
+        """分析 CSV 數據，使用 prepare_data 整理好的資料"""
+        df = state["filtered_df"]
         
+        # 基本統計分析
+        analysis = {
+            "row_count": len(df),
+            "column_count": len(df.columns),
+            "numerical_columns": df.select_dtypes(include="number").columns.tolist(),
+            "categorical_columns": df.select_dtypes(include=["object", "category"]).columns.tolist(),
+            "basic_stats": df.describe().to_dict()
+        }
+        # 將處理後的 DataFrame 存入 state 中，以便後續視覺化使用（可選）
+        analysis["filtered_df"] = df.to_dict(orient="list")
+        return {"data_analysis": analysis}
+    
+    def _analyze_transcript(self, state: AnalysisState) -> AnalysisState:
+        """分析逐字稿內容"""
+        transcript = state["transcript_path"].getvalue()
+        # 超過 chunk_tokens 的逐字稿切成多個片段分別分析，片段設定也是快取版本的一部分
+        chunks = split_transcript(transcript, self.chunk_tokens)
+        version = TRANSCRIPT_PROMPT_VERSION if len(chunks) == 1 else prompt_version(TRANSCRIPT_PROMPT_VERSION, TRANSCRIPT_CHUNK_NOTE, str(self.chunk_tokens))
+        # 相同逐字稿、模型與 prompt 版本分析過時直接使用快取的結果，不呼叫 LLM
+        transcript_sha = hashlib.sha256(transcript.encode("utf-8")).hexdigest()
+        if self.memo is not None:
+            analysis = self.memo.get(transcript_sha, self.model_name, version)
+            if analysis is not None:
+                return {"transcript_analysis": analysis, "timings": {"analyze_transcript": {"memo_hit": True, "chunks": len(chunks)}}}
+
+        analysis = self._analyze_chunks(chunks)
+        if self.memo is not None:
+            self.memo.put(transcript_sha, self.model_name, version, analysis)
+        return {"transcript_analysis": analysis, "timings": {"analyze_transcript": {"memo_hit": False, "chunks": len(chunks)}}}
+
+    def _analyze_chunks(self, chunks):
+        """只有一個片段時與原本相同，以整份逐字稿呼叫一次；多個片段時同時分析 (最多 chunk_workers 個) 後合併"""
+        if len(chunks) == 1:
+            return self._generate_transcript_analysis(TRANSCRIPT_PROMPT.format(transcript=chunks[0]))
+        prompts = [
+            TRANSCRIPT_CHUNK_NOTE.format(part=i + 1, parts=len(chunks)) + TRANSCRIPT_PROMPT.format(transcript=chunk)
+            for i, chunk in enumerate(chunks)
+        ]
+        with ThreadPoolExecutor(max_workers=max(1, min(self.chunk_workers, len(chunks)))) as pool:
+            partials = list(pool.map(self._generate_transcript_analysis, prompts))
+        return merge_analyses(partials)
+
+    def _generate_transcript_analysis(self, prompt):
+        self.rate_limiter.acquire()
         response = self.model.client.generate_content(
             prompt,
             generation_config=GenerationConfig(
-                response_mime_type="application/json", response_schema=response_schema
+                response_mime_type="application/json", response_schema=TRANSCRIPT_SCHEMA
             ),
         )
-        analysis = json.loads(response.text)
-        state["transcript_analysis"] = analysis
-        return state
+        return json.loads(response.text)
+
+    def compare_transcript_modes(self, transcript: str) -> Dict:
+        """
+        以相同逐字稿分別執行一次完整分析與切片分析 (不使用快取)，回傳兩者的耗時與結果大小，
+        用於調整 chunk_tokens 與 chunk_workers。
+        """
+        results = {}
+        for mode, chunks in [("single", [transcript]), ("chunked", split_transcript(transcript, self.chunk_tokens))]:
+            start = time.perf_counter()
+            analysis = self._analyze_chunks(chunks)
+            results[mode] = {
+                "seconds": time.perf_counter() - start,
+                "chunks": len(chunks),
+                "topics": len(analysis),
+                "critical_points": sum(len(item.get("critical_point", [])) for item in analysis),
+            }
+        return results
         
     def _create_visualization(self, state: AnalysisState) -> AnalysisState:
         """根據數據創建視覺化圖表與表格，展示多季財務數據的趨勢、結構與財務比率。
-        當可用季度資料少於 3 筆時，不生成趨勢圖與成長率圖表。"""
-        # print("Starting visualization creation...")
-        csv_file = load_csv_from_bucket("careerhack2025-bsid-resource-bucket", f"FIN_Data.csv")
-        df = pd.read_csv(csv_file)
-        # print("CSV data loaded.")
-        
-        # 確保 CALENDAR_YEAR 和 CALENDAR_QTR 為整數
-        df["CALENDAR_YEAR"] = df["CALENDAR_YEAR"].astype(int)
-        df["CALENDAR_QTR"] = df["CALENDAR_QTR"].str.extract('(\d+)').astype(int)
-        # print("CALENDAR_YEAR and CALENDAR_QTR converted to integers.")
-        
-        # 過濾指定公司
-        df = df[df["Company Name"] == state["company"]]
-        # print(f"Filtered data for company: {state['company']}")
-        
-        # 過濾條件：若 CALENDAR_YEAR 小於傳入的 Year，則保留所有；若等於，則保留 Quarter <= 傳入的 Quarter
-        df = df[
-            (df["CALENDAR_YEAR"] < state["year"]) |
-            ((df["CALENDAR_YEAR"] == state["year"]) & (df["CALENDAR_QTR"] <= state["quarter"]))
-        ]
-        # print(f"Filtered data for year <= {state['year']} and quarter <= {state['quarter']}")
-        
-        # 新增 "Period" 欄位 (例如 "2020 Q1")
-        df["Period"] = df["CALENDAR_YEAR"].astype(str) + " Q" + df["CALENDAR_QTR"].astype(str)
-        df = df.sort_values(by=["CALENDAR_YEAR", "CALENDAR_QTR"])
-        # print("Added and sorted by Period column.")
-        
-        # 透視數據，使 Index 列中的屬性成為單獨的列
-        df_pivot = df.pivot_table(index=["Period", "CALENDAR_YEAR", "CALENDAR_QTR"], columns="Index", values="USD_Value").reset_index()
-        # print("Pivoted data:")
-        # print(df_pivot.head())
-        
-        visualizations = []
-        n = len(df_pivot)  # 可用資料筆數
-        # print(f"Number of available data points: {n}")
-        
-        # 1. 趨勢圖：Revenue 與 Operating Income 趨勢圖（僅當資料筆數>=3時生成）
-        if n >= 3 and set(["Revenue", "Operating Income"]).issubset(df_pivot.columns):
-            # print("Creating trend visualization...")
-            plt.figure(figsize=(10,6))
-            plt.plot(df_pivot["Period"], df_pivot["Revenue"], marker="o", label="Revenue")
-            plt.plot(df_pivot["Period"], df_pivot["Operating Income"], marker="o", label="Operating Income")
-            plt.xlabel("Period")
-            plt.ylabel("Amount (Million USD)")
-            plt.title(f"{state['company']} Revenue & Operating Income Trend")
-            plt.xticks(rotation=45)
-            plt.legend()
-            plt.tight_layout()
-            fig_path1 = os.path.join(REPORT_DIR, f"visualization_{len(visualizations)}.png")
-            plt.savefig(fig_path1)
-            plt.close()
-            visualizations.append({
-                "type": "trend",
-                "path": fig_path1,
-                "description": "Revenue & Operating Income Trend"
-            })
-            # print(f"Trend visualization saved at {fig_path1}")
-        
-        # 2. 群組長條圖：各季度成本結構 (Revenue, COGS, Operating Expense, Operating Income, Tax Expense)
-        # print("Creating bar chart visualization...")
-        required_cols = ["Revenue", "Cost of Goods Sold", "Operating Expense", "Operating Income", "Tax Expense"]
-        if set(required_cols).issubset(df_pivot.columns):
-            periods = df_pivot["Period"]
-            bar_width = 0.15
-            index = range(len(periods))
-            plt.figure(figsize=(12,6))
-            plt.bar([i - 2*bar_width for i in index], df_pivot["Revenue"], width=bar_width, label="Revenue")
-            plt.bar([i - bar_width for i in index], df_pivot["Cost of Goods Sold"], width=bar_width, label="COGS")
-            plt.bar(index, df_pivot["Operating Expense"], width=bar_width, label="Operating Expense")
-            plt.bar([i + bar_width for i in index], df_pivot["Operating Income"], width=bar_width, label="Operating Income")
-            plt.bar([i + 2*bar_width for i in index], df_pivot["Tax Expense"], width=bar_width, label="Tax Expense")
-            plt.xlabel("Period")
-            plt.xticks(index, periods, rotation=45)
-            plt.ylabel("Amount (Million USD)")
-            plt.title(f"{state['company']} Cost Structure by Period")
-            plt.legend()
-            plt.tight_layout()
-            fig_path2 = os.path.join(REPORT_DIR, f"visualization_{len(visualizations)}.png")
-            plt.savefig(fig_path2)
-            plt.close()
-            visualizations.append({
-                "type": "bar",
-                "path": fig_path2,
-                "description": "Cost Structure per Quarter"
-            })
-            # print(f"Bar chart visualization saved at {fig_path2}")
-        
-        # 3. 財務比率表：計算毛利率、營業利益率、簡易淨利率，並以表格呈現
-        # print("Creating financial ratios table visualization...")
-        if set(["Revenue", "Cost of Goods Sold", "Operating Income", "Tax Expense"]).issubset(df_pivot.columns):
-            df_pivot["Gross Profit"] = df_pivot["Revenue"] - df_pivot["Cost of Goods Sold"]
-            df_pivot["Gross Margin"] = df_pivot["Gross Profit"] / df_pivot["Revenue"]
-            df_pivot["Operating Margin"] = df_pivot["Operating Income"] / df_pivot["Revenue"]
-            df_pivot["Approx Net Income"] = df_pivot["Operating Income"] - df_pivot["Tax Expense"]
-            df_pivot["Net Margin"] = df_pivot["Approx Net Income"] / df_pivot["Revenue"]
-            ratio_table = df_pivot[["Period", "Gross Margin", "Operating Margin", "Net Margin"]]
-            fig, ax = plt.subplots(figsize=(8, len(ratio_table)*0.5 + 1))
-            ax.axis('tight')
-            ax.axis('off')
-            table = ax.table(cellText=ratio_table.round(2).values,
-                             colLabels=ratio_table.columns,
-                             cellLoc='center', loc='center')
-            plt.title(f"{state['company']} Financial Ratios")
-            fig.tight_layout()
-            fig_path3 = os.path.join(REPORT_DIR, f"visualization_{len(visualizations)}.png")
-            plt.savefig(fig_path3)
-            plt.close()
-            visualizations.append({
-                "type": "table",
-                "path": fig_path3,
-                "description": "Financial Ratios Table"
-            })
-            # print(f"Financial ratios table visualization saved at {fig_path3}")
-        
-        # 4. 成長率趨勢圖：計算 Revenue 與 Operating Income 的環比成長率（僅當資料筆數>=3時生成）
-        if n >= 3 and set(["Revenue", "Operating Income"]).issubset(df_pivot.columns):
-            # print("Creating growth rate visualization...")
-            df_pivot = df_pivot.sort_values(by=["CALENDAR_YEAR", "CALENDAR_QTR"])
-            df_pivot["Revenue Growth Rate"] = df_pivot["Revenue"].pct_change() * 100
-            df_pivot["Operating Income Growth Rate"] = df_pivot["Operating Income"].pct_change() * 100
-            
-            plt.figure(figsize=(10, 6))
-            plt.plot(df_pivot["Period"], df_pivot["Revenue Growth Rate"], marker='o', label="Revenue Growth Rate")
-            plt.plot(df_pivot["Period"], df_pivot["Operating Income Growth Rate"], marker='o', label="Operating Income Growth Rate")
-            plt.title(f"{state['company']} Growth Rates")
-            plt.xlabel("Period")
-            plt.ylabel("Growth Rate (%)")
-            plt.legend()
-            plt.grid(True)
-            plt.xticks(rotation=45)
-            plt.tight_layout()
-            
-            fig_path4 = os.path.join(REPORT_DIR, f"visualization_{len(visualizations)}.png")
-            plt.savefig(fig_path4)
-            plt.close()
-            visualizations.append({
-                "type": "growth",
-                "path": fig_path4,
-                "description": "Revenue and Operating Income Growth Rate"
-            })
-            # print(f"Growth rate visualization saved at {fig_path4}")
-        
-        state["visualizations"] = visualizations
-        # print("Visualization creation completed.")
-        return state
+        json 模式只輸出圖表資料，不載入 matplotlib；
+        png 模式在平行執行時於獨立的 process 中繪圖，不與其他節點的 thread 共用 pyplot 狀態。"""
+        # 使用 prepare_data 整理好的透視資料，複製一份以免成長率欄位寫回共用的 state
+        df_pivot = state["pivot_df"].copy()
+        if self.chart_format == "json":
+            return {"visualizations": chart_data(df_pivot, state["company"], state["report_dir"])}
+        cache_spec = {"company": state["company"], "year": state["year"], "quarter": state["quarter"]}
+        render_args = (df_pivot, state["company"], state["report_dir"], self.chart_store, cache_spec, state["dataset_version"])
+        # 所有圖表都已在快取中時直接複製，不需要啟動繪圖 process
+        cached = all(self.chart_store.contains(key) for key in chart_keys(self.chart_store, df_pivot, cache_spec, state["dataset_version"]))
+        if not self.parallel or cached:
+            return {"visualizations": render_visualizations(*render_args)}
+        with self._chart_executor_lock:
+            if self._chart_executor is None:
+                self._chart_executor = ProcessPoolExecutor(max_workers=self.chart_workers, mp_context=multiprocessing.get_context("spawn"))
+        future = self._chart_executor.submit(render_visualizations, *render_args)
+        return {"visualizations": future.result()}
     
     def _generate_final_report(self, state: AnalysisState) -> AnalysisState:
         """生成最終報告"""
@@ -390,15 +470,15 @@ class ReportGeneratorAgent:
 
         Format Requirement: Markdown Format
         """
+        self.rate_limiter.acquire()
         report = self.model.predict(prompt)
         
         # 保存報告
-        report_path = os.path.join(REPORT_DIR, "report.md")
+        report_path = os.path.join(state["report_dir"], "report.md")
         with open(report_path, "w", encoding="utf-8") as f:
             f.write(report)
         
-        state["report_path"] = report_path
-        return state
+        return {"report_path": report_path}
     
     def _self_evaluation(self, state: AnalysisState) -> AnalysisState:
         """
@@ -416,68 +496,302 @@ class ReportGeneratorAgent:
         Report:
         {report_content}
         """
+        self.rate_limiter.acquire()
         evaluated_report = self.model.predict(evaluation_prompt)
         print(evaluated_report)
         
         # 保存最終經過自我評估修正的報告
-        final_report_path = os.path.join(REPORT_DIR, "final_report.md")
+        final_report_path = os.path.join(state["report_dir"], "final_report.md")
         with open(final_report_path, "w", encoding="utf-8") as f:
             f.write(evaluated_report)
         
-        state["report_path"] = final_report_path
-        return state
+        return {"report_path": final_report_path}
     
+    def _timed(self, name, node):
+        """包裝節點，記錄相對於流程開始的起訖時間與執行的 thread，合併進 state 的 timings"""
+        def run(state: AnalysisState) -> AnalysisState:
+            start = time.perf_counter()
+            update = node(state)
+            end = time.perf_counter()
+            timing = update.setdefault("timings", {}).setdefault(name, {})
+            timing.update({
+                "start": start - state["started_at"],
+                "end": end - state["started_at"],
+                "seconds": end - start,
+                "thread": threading.current_thread().name,
+            })
+            return update
+        return run
+
+    def _analyze_financials(self, state: AnalysisState) -> AnalysisState:
+        """
+        平行模式的資料分支：準備資料後，資料分析 (thread) 與圖表 (process) 同時執行。
+        整個分支是一個節點，才能與逐字稿分析在同一個 superstep 中重疊執行。
+        """
+        update = self._timed("prepare_data", self._prepare_data)(state)
+        branch_state = {**state, **update}
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            futures = [
+                pool.submit(self._timed("analyze_data", self._analyze_csv_data), branch_state),
+                pool.submit(self._timed("create_visualization", self._create_visualization), branch_state),
+            ]
+            for future in futures:
+                result = future.result()
+                update["timings"] = merge_dicts(update["timings"], result.pop("timings"))
+                update.update(result)
+        return update
+
     def _create_graph(self) -> Graph:
-        """創建工作流程圖"""
+        """
+        創建工作流程圖。
+        平行模式：逐字稿分析與資料分支 (準備資料 -> 資料分析、圖表) 同時開始，兩者都完成後才生成報告。
+        """
         workflow = StateGraph(state_schema=AnalysisState)
         
-        workflow.add_node("analyze_data", self._analyze_csv_data)
-        workflow.add_node("analyze_transcript", self._analyze_transcript)
-        workflow.add_node("create_visualization", self._create_visualization)
-        workflow.add_node("generate_report", self._generate_final_report)
-        workflow.add_node("self_evaluation", self._self_evaluation)  # 新增自我評估節點
-        
-        workflow.set_entry_point("analyze_data")
-        workflow.add_edge("analyze_data", "analyze_transcript")
-        workflow.add_edge("analyze_transcript", "create_visualization")
-        workflow.add_edge("create_visualization", "generate_report")
+        if self.parallel:
+            workflow.add_node("analyze_transcript", self._timed("analyze_transcript", self._analyze_transcript))
+            workflow.add_node("analyze_financials", self._analyze_financials)
+            workflow.add_edge(START, "analyze_transcript")
+            workflow.add_edge(START, "analyze_financials")
+            workflow.add_edge(["analyze_transcript", "analyze_financials"], "generate_report")
+        else:
+            for name in ["prepare_data", "analyze_data", "analyze_transcript", "create_visualization"]:
+                workflow.add_node(name, self._timed(name, self.tools[name]))
+            workflow.set_entry_point("prepare_data")
+            workflow.add_edge("prepare_data", "analyze_data")
+            workflow.add_edge("analyze_data", "analyze_transcript")
+            workflow.add_edge("analyze_transcript", "create_visualization")
+            workflow.add_edge("create_visualization", "generate_report")
+        workflow.add_node("generate_report", self._timed("generate_report", self._generate_final_report))
+        workflow.add_node("self_evaluation", self._timed("self_evaluation", self._self_evaluation))  # 新增自我評估節點
         workflow.add_edge("generate_report", "self_evaluation")  # 從生成報告到自我評估
         
         return workflow.compile()
     
-    def generate_report(self, csv_path: str, transcript_path: str, company: str, quarter: int, year: int) -> str:
-        """執行報告生成流程"""
+    def _write_timing_report(self, state: AnalysisState) -> str:
+        """記錄各節點的時間軸與本次報告實際的資料準備成本"""
+        prepare = state["timings"]["prepare_data"]
+        wall_seconds = max(timing["end"] for timing in state["timings"].values())
+        # 依序執行時的總時間以各節點時間的總和估計 (實際的依序執行時間以 --serial 量測)
+        estimated_serial_seconds = sum(timing["seconds"] for timing in state["timings"].values())
+        timing_report = {
+            "mode": "parallel" if self.parallel else "serial",
+            "wall_seconds": wall_seconds,
+            "estimated_serial_seconds": estimated_serial_seconds,
+            "estimated_wall_reduction_seconds": estimated_serial_seconds - wall_seconds,
+            "timeline": sorted(
+                ({"node": name, **timing} for name, timing in state["timings"].items()),
+                key=lambda item: item["start"],
+            ),
+            # prepare_data 實際的下載次數、位元組與載入時間 (BlobCache 的計數由整個 process 共用，
+            # 批次模式下包含同時執行的其他報告)
+            "data": {
+                name: prepare[name]
+                for name in ("downloads", "bytes_downloaded", "cache_hits", "load_frame_seconds", "pivot_seconds")
+            },
+        }
+        timing_path = os.path.join(state["report_dir"], "timing.json")
+        with open(timing_path, "w", encoding="utf-8") as f:
+            json.dump(timing_report, f, indent=2)
+        return timing_path
+
+    def generate_report(self, transcript_path: str, company: str, quarter: int, year: int, report_dir: str = REPORT_DIR) -> str:
+        """執行報告生成流程，報告、圖表與 timing.json 寫入 report_dir"""
         initial_state: AnalysisState = {
-            "csv_path": csv_path,
             "transcript_path": transcript_path,
             "company": company,
             "year": year,
             "quarter": quarter,
+            "report_dir": report_dir,
+            "dataset_version": None,
+            "filtered_df": None,
+            "pivot_df": None,
             "data_analysis": None,
             "transcript_analysis": None,
             "visualizations": None,
-            "report_path": None
+            "report_path": None,
+            "started_at": time.perf_counter(),
+            "timings": {}
         }
         
+        os.makedirs(report_dir, exist_ok=True)
         final_state = self.graph.invoke(initial_state)
+        self._write_timing_report(final_state)
         return final_state["report_path"]
 
-def main():
-    parser = argparse.ArgumentParser(description="Generate content using a generative model.")
+    def generate_range_report(self, company: str, year: int, quarter: int, quarters: int = 4, report_dir: str = REPORT_DIR, workers: int = 4) -> str:
+        """
+        產生截至 (year, quarter) 共 quarters 季的趨勢報告。
+        財務資料直接由 metrics cube 取出；各季逐字稿分析已在快取中時直接使用，只分析缺少的季度，
+        最後以各季的精簡摘要呼叫一次 LLM 合成報告。range_report.md、digests.json 與 timing.json 寫入 report_dir。
+        """
+        started = time.perf_counter()
+        os.makedirs(report_dir, exist_ok=True)
+        end = period_key(year, quarter)
+        start = end - quarters + 1
+        df_pivot = report_pivot(load_index(FIN_BUCKET, FIN_BLOB), load_cube(FIN_BUCKET, FIN_BLOB), company, start, end, growth_kinds=("qoq", "yoy"))
+        periods = list(range(start, end + 1))
+
+        def analyze(period):
+            quarter_year, quarter_number = period_parts(period)
+            transcript_name = find_transcript_name(company, quarter_year, quarter_number)
+            if transcript_name is None:
+                return None, {"transcript": False}
+            try:
+                transcript_file = load_transcript_from_bucket(TRANSCRIPT_BUCKET, transcript_blob(transcript_name))
+            except FileNotFoundError:
+                # 目錄中有但 bucket 中沒有檔案時，該季只使用財務資料
+                return None, {"transcript": False}
+            quarter_start = time.perf_counter()
+            update = self._analyze_transcript({"transcript_path": transcript_file})
+            return update["transcript_analysis"], {**update["timings"]["analyze_transcript"], "seconds": time.perf_counter() - quarter_start}
+
+        with ThreadPoolExecutor(max_workers=max(1, min(workers, len(periods)))) as pool:
+            results = dict(zip(periods, pool.map(analyze, periods)))
+
+        rows = {period_key(int(row["CALENDAR_YEAR"]), int(row["CALENDAR_QTR"])): row for _, row in df_pivot.iterrows()}
+        digests = [quarter_digest(period_label(period, sep=" "), rows.get(period), results[period][0]) for period in periods]
+        with open(os.path.join(report_dir, "digests.json"), "w", encoding="utf-8") as f:
+            json.dump(digests, f, indent=2, ensure_ascii=False)
+
+        synthesis_start = time.perf_counter()
+        prompt = RANGE_PROMPT.format(
+            company=company,
+            first=period_label(start, sep=" "),
+            last=period_label(end, sep=" "),
+            digests=json.dumps(digests, ensure_ascii=False),
+        )
+        self.rate_limiter.acquire()
+        report = self.model.predict(prompt)
+        report_path = os.path.join(report_dir, "range_report.md")
+        with open(report_path, "w", encoding="utf-8") as f:
+            f.write(report)
+        if self.chart_format == "json":
+            chart_data(df_pivot, company, report_dir)
+
+        quarters_timing = {period_label(period): timing for period, (_, timing) in results.items()}
+        timing_report = {
+            "mode": "range",
+            "quarters": quarters_timing,
+            "analyses_reused": sum(timing.get("memo_hit") is True for timing in quarters_timing.values()),
+            "analyses_computed": sum(timing.get("memo_hit") is False for timing in quarters_timing.values()),
+            "missing_transcripts": sum(timing.get("transcript") is False for timing in quarters_timing.values()),
+            "synthesis_prompt_chars": len(prompt),
+            "synthesis_seconds": time.perf_counter() - synthesis_start,
+            "wall_seconds": time.perf_counter() - started,
+        }
+        with open(os.path.join(report_dir, "timing.json"), "w", encoding="utf-8") as f:
+            json.dump(timing_report, f, indent=2)
+        return report_path
 
-    parser.add_argument("--company", type=str, default="", help="The company name to summarize")
-    parser.add_argument("--year", type=str, default="", help="The year to summarize")
-    parser.add_argument("--quarter", type=str, default="Q1", help="The quarter to summarize")
-    args = parser.parse_args()
+def load_manifest(path: str) -> List[Dict]:
+    """
+    讀取批次清單，CSV (欄位 company, year, quarter) 或 JSON (物件 list)。
+    quarter 可以是 'Q3' 或 3，統一轉成 'Q3'。
+    """
+    with open(path, encoding="utf-8-sig") as f:
+        rows = json.load(f) if path.endswith(".json") else list(csv.DictReader(f))
+    jobs = []
+    for row in rows:
+        quarter = str(row["quarter"]).strip().upper()
+        jobs.append({
+            "company": str(row["company"]).strip(),
+            "year": int(row["year"]),
+            "quarter": quarter if quarter.startswith("Q") else f"Q{quarter}",
+        })
+    return jobs
+
+
+def job_key(job: Dict) -> str:
+    return f"{job['company']}_{job['year']}_{job['quarter']}"
+
+
+def run_job(agent: ReportGeneratorAgent, company: str, year: int, quarter: str, report_dir: str) -> str:
+    """產生單一 (公司, 年, 季) 的報告，回傳報告路徑"""
+    transcript_name = find_transcript_name(company, year, quarter)
+    if transcript_name is None:
+        raise ValueError(f"找不到 {company} {year} {quarter} 的逐字稿")
+    transcript_file = load_transcript_from_bucket(TRANSCRIPT_BUCKET, transcript_blob(transcript_name))
+    return agent.generate_report(
+        transcript_path=transcript_file,
+        company=company,
+        quarter=int(quarter[1]),
+        year=year,
+        report_dir=report_dir
+    )
 
-    agent = ReportGeneratorAgent()
-    csv_file = load_csv_from_bucket("careerhack2025-bsid-resource-bucket", f"FIN_Data.csv")
+
+def run_batch(agent: ReportGeneratorAgent, jobs: List[Dict], batch_dir: str, workers: int, progress_path: str) -> Dict:
+    """
+    以最多 workers 個 thread 產生多份報告，共用同一個 agent (模型 client、資料與繪圖 process)。
+    每完成一份就在 progress_path 追加一行 JSON，重新執行時略過已完成的工作。
+    """
+    done = set()
+    if os.path.exists(progress_path):
+        with open(progress_path, encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    record = json.loads(line)
+                    if record["status"] == "done":
+                        done.add(record["key"])
+    pending = [job for job in jobs if job_key(job) not in done]
+    progress_lock = threading.Lock()
+    failures = []
+
+    def run(job):
+        key = job_key(job)
+        start = time.perf_counter()
+        record = {"key": key, **job}
+        try:
+            record["report_path"] = run_job(agent, job["company"], job["year"], job["quarter"], os.path.join(batch_dir, key))
+            record["status"] = "done"
+        except Exception as e:
+            record["status"] = "failed"
+            record["error"] = str(e)
+        record["seconds"] = time.perf_counter() - start
+        with progress_lock:
+            with open(progress_path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+            if record["status"] == "failed":
+                failures.append(record)
+        print(f"[batch] {key}: {record['status']} ({record['seconds']:.1f} s)")
+        return record
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        records = list(pool.map(run, pending))
+    elapsed = time.perf_counter() - start
+    completed = sum(record["status"] == "done" for record in records)
+
+    summary = {
+        "jobs": len(jobs),
+        "skipped": len(jobs) - len(pending),
+        "completed": completed,
+        "failed": len(failures),
+        "elapsed_seconds": elapsed,
+        "jobs_per_minute": completed / elapsed * 60 if elapsed else None,
+        "mean_job_seconds": sum(record["seconds"] for record in records) / len(records) if records else None,
+        "failures": [{"key": record["key"], "error": record["error"]} for record in failures],
+    }
+    with open(os.path.join(batch_dir, "batch_summary.json"), "w", encoding="utf-8") as f:
+        json.dump(summary, f, indent=2, ensure_ascii=False)
+    return summary
+
+
+def run_single(agent: ReportGeneratorAgent, args) -> None:
+    """main() 的單一報告模式 (含 --quarters 與 --compare_chunking)"""
+    if args.quarters > 1:
+        report_path = agent.generate_range_report(args.company, int(args.year), int(args.quarter[1]), args.quarters, workers=args.workers)
+        print(f"Range report generated at: {report_path}")
+        return
 
     transcript_name = find_transcript_name(args.company, int(args.year), args.quarter)
     # print(f"Transcript name: {transcript_name}")
-    transcript_file = load_transcript_from_bucket("tsmccareerhack2025-bsid-grp6-bucket", f"Transcript File/Transcript File/{transcript_name}.txt")
+    transcript_file = load_transcript_from_bucket(TRANSCRIPT_BUCKET, transcript_blob(transcript_name))
+    if args.compare_chunking:
+        print(json.dumps(agent.compare_transcript_modes(transcript_file.getvalue()), indent=2, ensure_ascii=False))
+        return
     report_path = agent.generate_report(
-        csv_path=csv_file,
         transcript_path=transcript_file,
         company=args.company,
         quarter=int(args.quarter[1]),
@@ -485,5 +799,48 @@ def main():
     )
     # print(f"Report generated at: {report_path}")
 
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate content using a generative model.")
+
+    parser.add_argument("--company", type=str, default="", help="The company name to summarize")
+    parser.add_argument("--year", type=str, default="", help="The year to summarize")
+    parser.add_argument("--quarter", type=str, default="Q1", help="The quarter to summarize")
+    parser.add_argument("--serial", action="store_true", help="Run the graph nodes one after another instead of in parallel")
+    # 摘要模式的前端路徑不會讀取 charts.json，預設維持 PNG 圖檔
+    parser.add_argument("--chart_format", type=str, default="png", choices=["json", "png"], help="Render charts as PNG images or write them as JSON data (charts.json)")
+    parser.add_argument("--manifest", type=str, help="CSV/JSON list of (company, year, quarter) to generate reports for in batch mode")
+    parser.add_argument("--workers", type=int, default=4, help="Number of reports generated concurrently in batch mode")
+    parser.add_argument("--rpm", type=float, default=0, help="Maximum LLM requests per minute across all jobs (0 = unlimited)")
+    parser.add_argument("--batch_dir", type=str, default=f"summarize_reports/batch-{formatted_time}", help="Output directory of batch mode, one sub-directory per job")
+    parser.add_argument("--progress", type=str, help="Progress file used to resume batch mode (default: <batch_dir>/progress.jsonl)")
+    parser.add_argument("--no_memo", action="store_true", help="Always call the LLM for transcript analysis instead of reusing memoized results")
+    parser.add_argument("--chunk_tokens", type=int, default=0, help="Split transcripts longer than this many (estimated) tokens into speaker-aware chunks analyzed concurrently (0 = single call)")
+    parser.add_argument("--chunk_workers", type=int, default=4, help="Number of transcript chunks analyzed concurrently")
+    parser.add_argument("--quarters", type=int, default=1, help="Write a trend report over this many quarters ending at --year/--quarter, reusing stored per-quarter transcript analyses")
+    parser.add_argument("--compare_chunking", action="store_true", help="Time single-call against chunked transcript analysis for --company/--year/--quarter and print the result")
+    args = parser.parse_args()
+    if args.compare_chunking and not args.chunk_tokens:
+        parser.error("--compare_chunking needs --chunk_tokens")
+    memo = None if args.no_memo else AnalysisMemo()
+
+    if args.manifest:
+        os.makedirs(args.batch_dir, exist_ok=True)
+        agent = ReportGeneratorAgent(parallel=not args.serial, rate_limiter=RateLimiter(args.rpm), chart_workers=args.workers, chart_format=args.chart_format, memo=memo, chunk_tokens=args.chunk_tokens, chunk_workers=args.chunk_workers)
+        try:
+            summary = run_batch(agent, load_manifest(args.manifest), args.batch_dir, args.workers, args.progress or os.path.join(args.batch_dir, "progress.jsonl"))
+        finally:
+            agent.close()
+        if memo is not None:
+            summary["analysis_memo"] = memo.stats()
+        print(json.dumps(summary, indent=2, ensure_ascii=False))
+        return
+
+    agent = ReportGeneratorAgent(parallel=not args.serial, chart_format=args.chart_format, memo=memo, chunk_tokens=args.chunk_tokens, chunk_workers=args.chunk_workers)
+    try:
+        run_single(agent, args)
+    finally:
+        agent.close()
+
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,115 @@
+import os
+
+import pytest
+
+from bucket_cache import BlobCache, LocalDirBackend
+
+BUCKET = "bucket"
+
+
+def put_blob(root, blob_name, data):
+    path = root / BUCKET / blob_name
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(data)
+    return path
+
+
+def make_cache(tmp_path, **kwargs):
+    root = tmp_path / "root"
+    root.mkdir(exist_ok=True)
+    return root, BlobCache(LocalDirBackend(str(root)), str(tmp_path / "cache"), **kwargs)
+
+
+def test_memory_hit_after_miss(tmp_path):
+    root, cache = make_cache(tmp_path)
+    put_blob(root, "a.csv", b"hello")
+
+    assert cache.get_bytes(BUCKET, "a.csv") == b"hello"
+    assert cache.get_bytes(BUCKET, "a.csv") == b"hello"
+    stats = cache.stats()
+    assert (stats["misses"], stats["memory_hits"], stats["disk_hits"]) == (1, 1, 0)
+    assert stats["revalidations"] == 2
+    assert stats["bytes_downloaded"] == 5
+    assert stats["hit_rate"] == 0.5
+
+
+def test_memory_lru_eviction_falls_back_to_disk(tmp_path):
+    root, cache = make_cache(tmp_path, max_memory_bytes=10)
+    put_blob(root, "a.csv", b"aaaaaa")
+    put_blob(root, "b.csv", b"bbbbbb")
+
+    cache.fetch(BUCKET, "a.csv")
+    cache.fetch(BUCKET, "b.csv")
+    # 兩個物件超過記憶體上限，最久未使用的 a 被移出記憶體，仍可由磁碟讀取
+    assert cache.stats()["memory_entries"] == 1
+    assert cache.get_bytes(BUCKET, "a.csv") == b"aaaaaa"
+    stats = cache.stats()
+    assert (stats["misses"], stats["memory_hits"], stats["disk_hits"]) == (2, 0, 1)
+    assert stats["memory_bytes"] == 6
+
+
+def test_disk_hit_in_new_process(tmp_path):
+    root, cache = make_cache(tmp_path)
+    put_blob(root, "a.csv", b"hello")
+    generation, _ = cache.fetch(BUCKET, "a.csv")
+
+    # 新的 BlobCache 讀取磁碟上的索引，不需要重新下載
+    _, fresh = make_cache(tmp_path)
+    assert fresh.fetch(BUCKET, "a.csv") == (generation, b"hello")
+    stats = fresh.stats()
+    assert (stats["misses"], stats["disk_hits"], stats["bytes_downloaded"]) == (0, 1, 0)
+
+
+def test_generation_change_downloads_again(tmp_path):
+    root, cache = make_cache(tmp_path)
+    path = put_blob(root, "a.csv", b"old")
+    first, _ = cache.fetch(BUCKET, "a.csv")
+
+    path.write_bytes(b"new data")
+    second, data = cache.fetch(BUCKET, "a.csv")
+    assert second != first
+    assert data == b"new data"
+    stats = cache.stats()
+    assert (stats["misses"], stats["memory_hits"]) == (2, 0)
+    assert stats["bytes_downloaded"] == len(b"old") + len(b"new data")
+
+
+def test_revalidate_interval_reuses_generation(tmp_path):
+    root, cache = make_cache(tmp_path, revalidate_seconds=3600)
+    path = put_blob(root, "a.csv", b"old")
+    cache.fetch(BUCKET, "a.csv")
+
+    # 檢查間隔內不向後端確認 generation，清除檢查紀錄後才讀到新版本
+    path.write_bytes(b"new data")
+    assert cache.get_bytes(BUCKET, "a.csv") == b"old"
+    assert cache.stats()["revalidations"] == 1
+    cache.invalidate(BUCKET, "a.csv")
+    assert cache.get_bytes(BUCKET, "a.csv") == b"new data"
+    assert cache.stats()["revalidations"] == 2
+
+
+def test_disk_eviction_by_size(tmp_path):
+    root, cache = make_cache(tmp_path, max_disk_bytes=10)
+    put_blob(root, "a.csv", b"aaaaaa")
+    put_blob(root, "b.csv", b"bbbbbb")
+
+    cache.fetch(BUCKET, "a.csv")
+    a_path = cache._object_path(cache._index[f"{BUCKET}/a.csv"]["digest"])
+    os.utime(a_path, (1, 1))
+    cache.fetch(BUCKET, "b.csv")
+
+    # 超過磁碟上限時刪除最久未使用的 a
+    assert not os.path.exists(a_path)
+    assert f"{BUCKET}/a.csv" not in cache._index
+    assert f"{BUCKET}/b.csv" in cache._index
+
+    cache.invalidate()
+    assert cache.get_bytes(BUCKET, "a.csv") == b"aaaaaa"
+    assert cache.stats()["misses"] == 3
+
+
+def test_missing_blob(tmp_path):
+    _, cache = make_cache(tmp_path)
+    assert cache.generation(BUCKET, "missing.csv") is None
+    with pytest.raises(FileNotFoundError):
+        cache.fetch(BUCKET, "missing.csv")
@@ -0,0 +1,53 @@
+from intent_router import CSV_TOOL_RULES, MAIN_RULES, IntentRouter, build_router, load_examples
+
+# 不含任何規則關鍵字的範例，模型只能從字詞判斷意圖
+EXAMPLES = {
+    "main": [
+        ("How is Apple thinking about the China market?", "rag_retrieval"),
+        ("Why was Nvidia confident about next year?", "rag_retrieval"),
+        ("What is Tencent's view on gaming regulation?", "rag_retrieval"),
+        ("Which company was largest in 2024 Q3?", "csv_agent"),
+        ("How much did Intel earn in 2023 Q1?", "csv_agent"),
+        ("What were AMD's sales in 2022 Q4?", "csv_agent"),
+    ],
+}
+
+
+def test_rules_route_keyword_prompts():
+    router = build_router("main", MAIN_RULES, EXAMPLES, model_threshold=0.6)
+    assert router.route("Plot Apple's revenue from 2020 Q1 to 2023 Q4") == ("plot_line_chart", 8 / 10.25, "rules")
+    intent, _, source = build_router("csv_tool", CSV_TOOL_RULES).route("What is the exchange rate between USD and TWD?")
+    assert (intent, source) == ("exchange_rate", "rules")
+
+
+def test_model_routes_prompt_without_rule_match():
+    router = build_router("main", MAIN_RULES, EXAMPLES, model_threshold=0.6)
+    prompt = "How is Apple thinking about gaming regulation?"
+    assert not router.score(prompt)
+    intent, confidence, source = router.route(prompt)
+    assert (intent, source) == ("rag_retrieval", "model")
+    assert confidence >= 0.6
+
+    # 模型不夠確定時仍交給 LLM
+    strict = build_router("main", MAIN_RULES, EXAMPLES, model_threshold=0.9999)
+    assert strict.route(prompt) == (None, 0.0, None)
+
+
+def test_default_router_is_rules_only():
+    # 沒有設定模型門檻時不訓練模型，規則沒命中就交給 LLM
+    router = build_router("main", MAIN_RULES, EXAMPLES)
+    assert router.model is None
+    assert router.route("How is Apple thinking about gaming regulation?") == (None, 0.0, None)
+    # 範例不足兩筆時也只用規則
+    assert build_router("main", MAIN_RULES, {"main": EXAMPLES["main"][:1]}, model_threshold=0.6).model is None
+
+
+def test_rules_route_builtin_examples():
+    # 規則命中的內建範例都必須路由正確
+    examples = load_examples()
+    for name, rules in (("main", MAIN_RULES), ("csv_tool", CSV_TOOL_RULES)):
+        router = IntentRouter(name, rules)
+        for prompt, expected in examples[name]:
+            intent, _, source = router.route(prompt)
+            assert intent in (None, expected), prompt
+            assert source in (None, "rules")
@@ -0,0 +1,105 @@
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+import local_rag
+from local_rag import FlatIndex, HashingEmbedder, IVFIndex, LocalCorpus, corpus_version, get_embedder, synthetic_corpus
+
+TRANSCRIPTS = {
+    "apple-2024-q1": "Apple 2024 Q1 earnings call. Services revenue grew on strong App Store demand.",
+    "apple-2024-q2": "Apple 2024 Q2 earnings call. iPhone sales in China declined while Mac recovered.",
+    "nvidia-2024-q1": "Nvidia 2024 Q1 earnings call. Data center revenue tripled on AI accelerator demand.",
+}
+
+
+def test_hashing_embedder_is_deterministic():
+    texts = ["Data center revenue grew", "營收成長", ""]
+    first = HashingEmbedder(128).embed(texts)
+    second = HashingEmbedder(128).embed(texts)
+    assert first.dtype == np.float32 and first.shape == (3, 128)
+    np.testing.assert_array_equal(first, second)
+    np.testing.assert_allclose(np.linalg.norm(first[:2], axis=1), 1, rtol=1e-6)
+    # 沒有字詞的文字是零向量
+    assert not first[2].any()
+    assert not np.array_equal(first[0], first[1])
+
+
+def test_flat_and_ivf_top_k_order():
+    corpus = synthetic_corpus(400, HashingEmbedder(256), seed=1)
+    query = corpus.vectors[7]
+    ids, distances = FlatIndex(corpus.vectors).search(query, 10)
+    assert ids[0] == 7 and distances[0] == pytest.approx(0, abs=1e-5)
+    assert np.all(np.diff(distances) >= 0)
+    np.testing.assert_allclose(distances, 1 - corpus.vectors[ids] @ query, rtol=1e-5)
+
+    # 比較所有群時 IVF 與 brute force 的結果相同
+    ivf = IVFIndex(corpus.vectors, nlist=16)
+    ivf_ids, ivf_distances = ivf.search(query, 10, nprobe=ivf.nlist)
+    np.testing.assert_array_equal(ivf_ids, ids)
+    np.testing.assert_allclose(ivf_distances, distances, rtol=1e-5)
+    few_ids, few_distances = ivf.search(query, 10, nprobe=1)
+    assert few_ids[0] == 7 and np.all(np.diff(few_distances) >= 0)
+
+
+def test_search_applies_threshold():
+    embedder = HashingEmbedder(256)
+    chunks = [{"company": "c", "year": 2024, "quarter": 1, "filename": name, "text": text} for name, text in TRANSCRIPTS.items()]
+    corpus = LocalCorpus(chunks, embedder.embed([chunk["text"] for chunk in chunks]), embedder)
+
+    everything = corpus.search("AI accelerator demand in the data center", top_k=3, threshold=2)
+    assert [hit["filename"] for hit in everything][0] == "nvidia-2024-q1"
+    assert len(everything) == 3
+    assert [hit["distance"] for hit in everything] == sorted(hit["distance"] for hit in everything)
+
+    threshold = (everything[0]["distance"] + everything[1]["distance"]) / 2
+    assert [hit["filename"] for hit in corpus.search("AI accelerator demand in the data center", 3, threshold)] == ["nvidia-2024-q1"]
+    assert corpus.search("AI accelerator demand in the data center", 3, threshold=-1) == []
+    assert LocalCorpus([], np.zeros((0, 256), dtype=np.float32), embedder).search("anything", 3) == []
+
+
+def test_get_embedder_reports_resolved_spec(monkeypatch):
+    assert get_embedder("hashing:64").name == "hashing-64"
+    monkeypatch.setattr(local_rag, "EMBEDDER", "word2vec")
+    with pytest.raises(ValueError, match="word2vec"):
+        get_embedder()
+
+
+def fake_catalog(version, names):
+    entries = {}
+    for name in names:
+        company, year, quarter = name.split("-")
+        entries[(company, int(year), int(quarter[1]))] = {"company": company, "year": int(year), "quarter": int(quarter[1]), "filename": name, "blob": name}
+    return SimpleNamespace(version=version, entries=entries)
+
+
+def test_corpus_version_tracks_catalog(monkeypatch, tmp_path):
+    embedder = HashingEmbedder(64)
+    base = corpus_version("v1", embedder, 512, None)
+    assert base == corpus_version("v1", HashingEmbedder(64), 512, None)
+    assert len({base, corpus_version("v2", embedder, 512, None), corpus_version("v1", HashingEmbedder(32), 512, None),
+                corpus_version("v1", embedder, 256, None), corpus_version("v1", embedder, 512, ["apple"])}) == 5
+
+    catalogs = {"current": fake_catalog("v1", ["apple-2024-q1", "nvidia-2024-q1"])}
+    builds = []
+    real_build = local_rag.build_corpus
+    monkeypatch.setattr(local_rag, "_CORPORA", {})
+    monkeypatch.setattr(local_rag, "load_catalog", lambda store_dir=None: catalogs["current"])
+    monkeypatch.setattr(local_rag, "load_transcript_text", lambda bucket, blob, store_dir=None, catalog=None: TRANSCRIPTS[blob])
+    monkeypatch.setattr(local_rag, "build_corpus", lambda *args, **kwargs: builds.append(args) or real_build(*args, **kwargs))
+
+    store_dir = str(tmp_path)
+    first = local_rag.load_corpus("Global", embedder=embedder, store_dir=store_dir)
+    assert first.version == corpus_version("v1", embedder, local_rag.CHUNK_TOKENS, None)
+    assert {chunk["filename"] for chunk in first.chunks} == {"apple-2024-q1", "nvidia-2024-q1"}
+    # 版本相同時沿用記憶體中與 store 中的向量庫
+    assert local_rag.load_corpus("Global", embedder=embedder, store_dir=store_dir) is first
+    local_rag._CORPORA.clear()
+    reread = local_rag.load_corpus("Global", embedder=embedder, store_dir=store_dir)
+    assert reread.version == first.version and len(builds) == 1
+
+    # 逐字稿目錄更新 (例如 fin_ingest 同步了新的逐字稿) 後版本改變並重建
+    catalogs["current"] = fake_catalog("v2", list(TRANSCRIPTS))
+    second = local_rag.load_corpus("Global", embedder=embedder, store_dir=store_dir)
+    assert second.version != first.version and len(builds) == 2
+    assert "apple-2024-q2" in {chunk["filename"] for chunk in second.chunks}
@@ -0,0 +1,142 @@
+import io
+import sys
+import json
+import time
+import asyncio
+import builtins
+import importlib
+from unittest import mock
+
+import pytest
+
+from chat_history import SummaryStore
+
+# chat.py 在 import 時載入 Vertex AI 與 LangChain；沒有安裝時以 mock 模組代替，
+# 串流測試只用到 StubModel，不會呼叫這些模組
+VERTEX_MODULES = [
+    "google",
+    "google.cloud",
+    "google.cloud.aiplatform",
+    "vertexai",
+    "vertexai.preview",
+    "vertexai.generative_models",
+    "langchain",
+    "langchain.agents",
+    "langchain.agents.agent_types",
+    "langchain_google_vertexai",
+    "langchain_experimental",
+    "langchain_experimental.agents",
+    "langchain_experimental.agents.agent_toolkits",
+]
+
+RAG_PROMPT = "What did management say about AI demand on the earnings call?"
+
+
+def importable(name):
+    try:
+        importlib.import_module(name)
+    except Exception:
+        return False
+    return True
+
+
+@pytest.fixture
+def chat(monkeypatch, tmp_path):
+    for name in VERTEX_MODULES:
+        if name not in sys.modules and not importable(name):
+            monkeypatch.setitem(sys.modules, name, mock.MagicMock())
+    # chat.py 的 PROJECT_ID 由部署環境提供
+    monkeypatch.setattr(builtins, "PROJECT_ID", "test-project", raising=False)
+    # chat.py 在 import 時以 TextIOWrapper 重新包裝 sys.stdout.buffer，包裝被回收時會關閉 buffer，
+    # 先換成測試自己的 stdout，不影響 pytest 的輸出擷取
+    monkeypatch.setattr(sys, "stdout", io.TextIOWrapper(io.BytesIO(), encoding="utf-8"))
+    monkeypatch.delitem(sys.modules, "chat", raising=False)
+    module = importlib.import_module("chat")
+    monkeypatch.delitem(sys.modules, "chat")
+
+    monkeypatch.setattr(module, "STUB_MODEL", True)
+    monkeypatch.setattr(module, "_MODEL_CACHE", {})
+    monkeypatch.setattr(module, "stored_data_range", lambda user_role: (2020 * 4, 2024 * 4 + 3))
+    monkeypatch.setattr(module, "get_summary_store", lambda: SummaryStore(str(tmp_path / "summaries.sqlite")))
+    return module
+
+
+def slow_dataset(user_role):
+    # RAG 路徑不等待資料集，載入會被捨棄
+    time.sleep(0.5)
+    raise AssertionError("the RAG path should not use the dataset")
+
+
+def run_stream(chat, monkeypatch, *argv):
+    monkeypatch.setattr("stub_model.STUB_DELAY", 0)
+    args = chat.build_arg_parser().parse_args(["--stream", "--no_answer_cache", *argv])
+    out = io.StringIO()
+    monkeypatch.setattr(sys, "stdout", out)
+    output = chat.ChatOutput(args.stream)
+    timings = asyncio.run(chat.run_pipeline(args, output, []))
+    output.done(timings)
+    return [json.loads(line) for line in out.getvalue().splitlines()]
+
+
+def test_stream_event_order(chat, monkeypatch):
+    monkeypatch.setattr(chat, "load_dataset", slow_dataset)
+    events = run_stream(chat, monkeypatch, "--prompt", RAG_PROMPT, "--user_role", "Global")
+    types = [event["type"] for event in events]
+
+    assert types[0] == "route"
+    assert events[0]["intent"] == "rag_retrieval"
+    assert types[-1] == "done"
+    assert len(types) > 3 and set(types[1:-1]) == {"delta"}
+    assert "".join(event["text"] for event in events[1:-1]).strip() == f"Stub answer to: {RAG_PROMPT}"
+
+    done = events[-1]
+    assert done["first_delta_ms"] is not None
+    assert [done["stages"][name]["status"] for name in ("route", "history", "answer")] == ["done", "done", "done"]
+    # 被捨棄的資料集載入沒有已知的結束時間
+    assert done["stages"]["dataset"]["status"] == "discarded"
+    assert done["stages"]["dataset"]["end_ms"] is None
+
+
+def test_output_without_stream_prints_text(chat, monkeypatch):
+    out = io.StringIO()
+    monkeypatch.setattr(sys, "stdout", out)
+    output = chat.ChatOutput(False)
+    output.route("rag_retrieval")
+    output.text("answer")
+    output.chart({"chart": "line"}, "json")
+    output.done({})
+    assert out.getvalue().splitlines() == ["Call rag_retrieval function", "answer", '{"chart":"line"}']
+
+
+def test_stream_rag_error_stays_json(chat, monkeypatch):
+    def broken_corpus(*args, **kwargs):
+        raise ValueError("unknown embedder: nope")
+
+    monkeypatch.setattr(chat, "load_local_corpus", broken_corpus)
+    monkeypatch.setattr(chat, "load_dataset", lambda user_role: (mock.Mock(companies=["Apple"], min_period=2020 * 4, max_period=2024 * 4 + 3), None))
+    events = run_stream(chat, monkeypatch, "--prompt", RAG_PROMPT, "--user_role", "Global", "--rag_backend", "local")
+
+    assert [event["type"] for event in events] == ["route", "delta", "done"]
+    assert events[1]["text"] == "生成RAG回答時發生錯誤: unknown embedder: nope"
+
+
+def test_local_answer_cache_follows_corpus_version(chat, monkeypatch, tmp_path):
+    from answer_cache import AnswerCache
+    from local_rag import HashingEmbedder, LocalCorpus
+
+    embedder = HashingEmbedder(64)
+    chunk = {"company": "Apple", "year": 2024, "quarter": 1, "filename": "apple", "text": "AI demand on the earnings call"}
+    corpus = {"current": LocalCorpus([chunk], embedder.embed([chunk["text"]]), embedder, "v1")}
+    cache = AnswerCache(str(tmp_path / "answers.sqlite"))
+    monkeypatch.setattr(chat, "load_local_corpus", lambda *args, **kwargs: corpus["current"])
+    monkeypatch.setattr(chat, "get_answer_cache", lambda: cache)
+    generated = []
+    monkeypatch.setattr(chat, "generate_text", lambda model, prompt, on_delta=None, **kwargs: generated.append(prompt) or f"answer {len(generated)}")
+    args = chat.build_arg_parser().parse_args(["--prompt", RAG_PROMPT, "--rag_backend", "local"])
+
+    assert chat.rag_agent(args, None, ["Apple"]) == "answer 1"
+    assert chat.rag_agent(args, None, ["Apple"]) == "answer 1"
+    # 向量庫重建 (新的逐字稿) 後不沿用舊的段落與答案
+    corpus["current"] = LocalCorpus([chunk], embedder.embed([chunk["text"]]), embedder, "v2")
+    assert chat.rag_agent(args, None, ["Apple"]) == "answer 2"
+    assert len(generated) == 2
@@ -0,0 +1,121 @@
+import re
+import sys
+import json
+import argparse
+
+# 沒有 tokenizer 時以字元數估計 token 數 (英文逐字稿平均約 4 字元一個 token)
+CHARS_PER_TOKEN = 4
+
+# 發言者開頭的行，例如 "Operator:"、"Tim Cook:"、"Luca Maestri - CFO:"
+SPEAKER_PATTERN = re.compile(r"^\s*([A-Z][\w.,'&\- ]{0,80}?)\s*:\s*(.*)$")
+SENTENCE_PATTERN = re.compile(r"(?<=[.!?])\s+")
+
+
+def estimate_tokens(text):
+    return (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+
+
+def speaker_turns(text):
+    """
+    將逐字稿拆成發言段落 [(speaker, text), ...]，發言者不明的開頭段落 speaker 為 None。
+    """
+    turns = []
+    speaker, lines = None, []
+    for line in text.splitlines():
+        match = SPEAKER_PATTERN.match(line)
+        # 太長的 "xxx:" 通常是句子中的冒號而不是發言者
+        if match and len(match.group(1).split()) <= 8:
+            if lines:
+                turns.append((speaker, "\n".join(lines).strip()))
+            speaker, lines = match.group(1).strip(), [match.group(2)]
+        else:
+            lines.append(line)
+    if lines:
+        turns.append((speaker, "\n".join(lines).strip()))
+    return [(speaker, body) for speaker, body in turns if body]
+
+
+def _format_turn(speaker, body):
+    return f"{speaker}: {body}" if speaker else body
+
+
+def _split_turn(speaker, body, max_tokens):
+    """單一發言超過上限時依句子切開，後續片段標上 (cont.) 保留發言者"""
+    pieces, current = [], ""
+    for sentence in SENTENCE_PATTERN.split(body):
+        candidate = f"{current} {sentence}".strip()
+        if current and estimate_tokens(_format_turn(speaker, candidate)) > max_tokens:
+            pieces.append(current)
+            current = sentence
+        else:
+            current = candidate
+    if current:
+        pieces.append(current)
+    return [_format_turn(speaker if i == 0 or not speaker else f"{speaker} (cont.)", piece) for i, piece in enumerate(pieces)]
+
+
+def split_transcript(text, max_tokens):
+    """
+    將逐字稿切成每段不超過 max_tokens (估計值) 的片段，只在發言之間切開；
+    單一發言超過上限時才在句子之間切開。max_tokens 為 0 或逐字稿不超過上限時回傳整份逐字稿。
+    """
+    if not max_tokens or estimate_tokens(text) <= max_tokens:
+        return [text]
+    chunks, current, current_tokens = [], [], 0
+    for speaker, body in speaker_turns(text):
+        for part in _split_turn(speaker, body, max_tokens):
+            tokens = estimate_tokens(part) + 1
+            if current and current_tokens + tokens > max_tokens:
+                chunks.append("\n\n".join(current))
+                current, current_tokens = [], 0
+            current.append(part)
+            current_tokens += tokens
+    if current:
+        chunks.append("\n\n".join(current))
+    return chunks
+
+
+def _normalize(text):
+    """比較用的正規化：忽略大小寫、標點與空白，保留數字中的小數點"""
+    text = re.sub(r"(?<!\d)\.|\.(?!\d)", " ", str(text).lower())
+    return " ".join(re.sub(r"[^\w%$.]+", " ", text).split())
+
+
+def merge_analyses(partials):
+    """
+    合併各片段的分析結果 (topic / critical_point 陣列)。
+    相同 topic 的重點合併在一起並依首次出現的順序排列，摘要相同的重點只保留一次並合併其 data。
+    """
+    topics = {}
+    for partial in partials:
+        for item in partial or []:
+            topic = topics.setdefault(_normalize(item.get("topic", "")), {"topic": item.get("topic", ""), "points": {}})
+            for point in item.get("critical_point", []):
+                merged = topic["points"].setdefault(_normalize(point.get("summary", "")), {"summary": point.get("summary", ""), "data": []})
+                seen = {_normalize(value) for value in merged["data"]}
+                for value in point.get("data", []):
+                    if _normalize(value) not in seen:
+                        seen.add(_normalize(value))
+                        merged["data"].append(value)
+    return [{"topic": topic["topic"], "critical_point": list(topic["points"].values())} for topic in topics.values()]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Show how a transcript is split into speaker-aware chunks.")
+    parser.add_argument("file", type=str, help="Transcript text file")
+    parser.add_argument("--chunk_tokens", type=int, default=6000, help="Maximum estimated tokens per chunk")
+    args = parser.parse_args()
+
+    with open(args.file, encoding="utf-8") as f:
+        text = f.read()
+    chunks = split_transcript(text, args.chunk_tokens)
+    print(json.dumps({
+        "tokens": estimate_tokens(text),
+        "speaker_turns": len(speaker_turns(text)),
+        "chunks": [{"tokens": estimate_tokens(chunk), "starts_with": chunk[:60]} for chunk in chunks],
+    }, indent=2, ensure_ascii=False))
+    print(f"[chunks] {len(chunks)} chunks of at most {args.chunk_tokens} tokens", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,233 @@
+import os
+import sys
+import json
+import time
+import hashlib
+import argparse
+import threading
+
+from bucket_cache import default_cache
+from fin_store import STORE_DIR, frame_version, load_frame, period_parts
+from lookup_tables import TRANSCRIPT_BLOB, TRANSCRIPT_BUCKET, FiscalCalendar
+
+TRANSCRIPT_PREFIX = "Transcript File/Transcript File/"
+
+
+def quarter_number(quarter):
+    """'Q3'、'3' 或 3 -> 3"""
+    return int(str(quarter).strip().upper().lstrip("Q"))
+
+
+def transcript_blob(filename):
+    return f"{TRANSCRIPT_PREFIX}{filename}.txt"
+
+
+class TranscriptCatalog:
+    """
+    逐字稿目錄，以 (公司, 年, 季) 查詢檔名、bucket 路徑與財年季度，
+    讀過的逐字稿另外記錄大小、內容 hash 與當時的 generation，供本機文字快取使用。
+
+    :param entries: [{company, year, quarter, filename, blob, fiscal_year, fiscal_quarter, size, sha256, generation}, ...]
+    :param version: 建立目錄的逐字稿清單版本 (TRANSCRIPT CSV 的 generation)
+    """
+
+    def __init__(self, entries, version=None):
+        self.version = version
+        # 同一個 (公司, 年, 季) 有多列時與原本的 iloc[0] 相同，使用清單中的第一列
+        self.entries = {}
+        self.by_blob = {}
+        self.duplicates = []
+        for entry in entries:
+            key = (entry["company"], entry["year"], entry["quarter"])
+            if key in self.entries:
+                self.duplicates.append((key, entry["filename"]))
+                continue
+            self.entries[key] = entry
+            self.by_blob.setdefault(entry["blob"], entry)
+
+    @classmethod
+    def from_frame(cls, df, version=None, previous=None):
+        """
+        由 store 中的逐字稿清單建立目錄，財年季度以 FiscalCalendar 換算。
+        previous 中相同 blob 的大小、hash 與 generation 會沿用，文字快取不因清單更新而失效。
+        """
+        fiscal = FiscalCalendar(df).to_fiscal(df["Company Name"].astype(str).to_numpy(), df["PERIOD"].to_numpy())
+        known = previous.by_blob if previous is not None else {}
+        entries = []
+        for company, year, quarter, filename, fiscal_key in zip(df["Company Name"].astype(str), df["CALENDAR_YEAR"], df["CALENDAR_QTR"], df["Transcript_Filename"].astype(str), fiscal):
+            fiscal_year, fiscal_quarter = period_parts(int(fiscal_key)) if fiscal_key == fiscal_key else (None, None)
+            blob = transcript_blob(filename)
+            old = known.get(blob, {})
+            entries.append({
+                "company": company,
+                "year": int(year),
+                "quarter": int(quarter),
+                "filename": filename,
+                "blob": blob,
+                "fiscal_year": fiscal_year,
+                "fiscal_quarter": fiscal_quarter,
+                "size": old.get("size"),
+                "sha256": old.get("sha256"),
+                "generation": old.get("generation"),
+            })
+        catalog = cls(entries, version)
+        for (company, year, quarter), filename in catalog.duplicates:
+            kept = catalog.entries[(company, year, quarter)]["filename"]
+            print(f"[transcripts] duplicate {company} {year} Q{quarter}: using {kept}, ignoring {filename}", file=sys.stderr)
+        return catalog
+
+    def get(self, company, year, quarter):
+        """回傳目錄中的項目，沒有時回傳 None"""
+        return self.entries.get((company, int(year), quarter_number(quarter)))
+
+    def record(self, blob_name, data, generation):
+        """記錄讀到的逐字稿大小與 hash，回傳 hash"""
+        digest = hashlib.sha256(data).hexdigest()
+        entry = self.by_blob.get(blob_name)
+        if entry is not None:
+            entry.update(size=len(data), sha256=digest, generation=generation)
+        return digest
+
+    def invalidate(self, blob_names=None):
+        """清除指定逐字稿 (或全部) 的 hash 紀錄，下次讀取時重新下載，回傳清除的筆數"""
+        entries = self.by_blob.values() if blob_names is None else [self.by_blob[name] for name in blob_names if name in self.by_blob]
+        count = 0
+        for entry in entries:
+            if entry["sha256"] is not None:
+                entry.update(size=None, sha256=None, generation=None)
+                count += 1
+        return count
+
+    def to_json(self):
+        return {"format": CATALOG_FORMAT, "version": self.version, "entries": list(self.entries.values())}
+
+
+# 目錄檔的格式，改變時舊的目錄在下次載入時重建 (2: 重複的 (公司, 年, 季) 使用第一列)
+CATALOG_FORMAT = 2
+
+
+def _catalog_path(store_dir):
+    return os.path.join(store_dir, "transcript_catalog.json")
+
+
+def _text_path(store_dir, digest):
+    return os.path.join(store_dir, "transcripts", digest[:2], f"{digest}.txt")
+
+
+def read_catalog(store_dir=None):
+    try:
+        with open(_catalog_path(store_dir or STORE_DIR), encoding="utf-8") as f:
+            data = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+    # 舊格式的目錄以 version None 表示需要重建，已知的 hash 仍會沿用
+    return TranscriptCatalog(data["entries"], data["version"] if data.get("format") == CATALOG_FORMAT else None)
+
+
+def write_catalog(catalog, store_dir=None):
+    store_dir = store_dir or STORE_DIR
+    os.makedirs(store_dir, exist_ok=True)
+    path = _catalog_path(store_dir)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(catalog.to_json(), f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+
+# 已載入的目錄: store_dir -> TranscriptCatalog
+_CATALOGS = {}
+# 報告平行產生時多個 thread 同時讀取逐字稿，目錄的建立與寫入需要互斥
+_LOCK = threading.RLock()
+
+
+def load_catalog(store_dir=None, revalidate=True):
+    """
+    取得逐字稿目錄。store 中的目錄與逐字稿清單版本相同時直接讀取，否則由清單重建並沿用已知的 hash。
+
+    :param revalidate: 是否向 bucket 檢查清單的 generation；False 時只要有目錄就使用
+    """
+    store_dir = store_dir or STORE_DIR
+    with _LOCK:
+        catalog = _CATALOGS.get(store_dir) or read_catalog(store_dir)
+        if catalog is not None and catalog.version is not None and not revalidate:
+            _CATALOGS[store_dir] = catalog
+            return catalog
+        df = load_frame(TRANSCRIPT_BUCKET, TRANSCRIPT_BLOB, store_dir)
+        version = frame_version(TRANSCRIPT_BUCKET, TRANSCRIPT_BLOB)
+        if catalog is None or catalog.version != version:
+            start = time.perf_counter()
+            catalog = TranscriptCatalog.from_frame(df, version, catalog)
+            write_catalog(catalog, store_dir)
+            print(f"[transcripts] catalog built ({len(catalog.entries)} entries) in {(time.perf_counter() - start) * 1000:.0f} ms", file=sys.stderr)
+        _CATALOGS[store_dir] = catalog
+        return catalog
+
+
+def load_transcript_text(bucket_name, blob_name, store_dir=None, catalog=None):
+    """
+    讀取逐字稿文字。目錄中已有 hash 且本機文字快取存在時直接讀檔，不向 bucket 發出任何請求；
+    否則經由 BlobCache 下載，寫入文字快取並記錄到目錄。
+    """
+    store_dir = store_dir or STORE_DIR
+    catalog = catalog or load_catalog(store_dir, revalidate=False)
+    entry = catalog.by_blob.get(blob_name)
+    if entry is not None and entry["sha256"]:
+        try:
+            with open(_text_path(store_dir, entry["sha256"]), encoding="utf-8") as f:
+                return f.read()
+        except FileNotFoundError:
+            pass
+
+    generation, data = default_cache().fetch(bucket_name, blob_name)
+    with _LOCK:
+        digest = catalog.record(blob_name, data, generation)
+        path = _text_path(store_dir, digest)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        if entry is not None:
+            write_catalog(catalog, store_dir)
+    return data.decode("utf-8")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build or query the transcript catalog and local transcript text cache.")
+    parser.add_argument("command", choices=["build", "info", "get", "prefetch"], help="build: rebuild the catalog; info: catalog summary; get: look up one transcript; prefetch: download all transcripts into the text cache")
+    parser.add_argument("--store_dir", type=str, default=STORE_DIR, help="Directory of the store")
+    parser.add_argument("--company", type=str, default="", help="Company name for get")
+    parser.add_argument("--year", type=int, default=0, help="Calendar year for get")
+    parser.add_argument("--quarter", type=str, default="Q1", help="Calendar quarter for get, e.g. Q1")
+    args = parser.parse_args()
+
+    if args.command == "build":
+        # 清除版本強制重建，已知的 hash 仍會沿用
+        previous = read_catalog(args.store_dir)
+        if previous is not None:
+            previous.version = None
+            _CATALOGS[args.store_dir] = previous
+    catalog = load_catalog(args.store_dir)
+
+    if args.command == "get":
+        start = time.perf_counter()
+        entry = catalog.get(args.company, args.year, args.quarter)
+        elapsed_us = (time.perf_counter() - start) * 1e6
+        print(json.dumps(entry, ensure_ascii=False))
+        print(f"[transcripts] lookup in {elapsed_us:.1f} us", file=sys.stderr)
+        return
+    if args.command == "prefetch":
+        failed = 0
+        for blob_name in catalog.by_blob:
+            try:
+                load_transcript_text(TRANSCRIPT_BUCKET, blob_name, args.store_dir, catalog)
+            except FileNotFoundError:
+                failed += 1
+        print(f"[transcripts] prefetched {len(catalog.by_blob) - failed} transcripts, {failed} missing", file=sys.stderr)
+    cached = sum(entry["sha256"] is not None for entry in catalog.entries.values())
+    print(json.dumps({"version": catalog.version, "entries": len(catalog.entries), "cached_text": cached}, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()